@@ -1,28 +1,66 @@
+import argparse
 import asyncio
+import contextlib
+import multiprocessing
 import sys
 import time
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+# Taken before the third-party imports, so the startup profile covers them
+_IMPORT_T0 = time.perf_counter()
 
-import ffmpeg
 import loguru
-import numpy as np
 from anyio import EndOfStream
-from numpy import ndarray
-from whisper import Whisper
 
-from submaku_stream.handlers.text_handlers import TextPreprocessorHandler, TextFormatterHandler
+from submaku_stream.handlers.text_handlers import TextFormatterHandler, TextHandlerChain
+from submaku_stream.workers.cascade import CascadeRefiner
 from submaku_stream.workers.danmaku_sender import DanmakuSendingWorker
-from .locales.i18n import gettext as _
-from .transcribers import whispers
+from submaku_stream.workers.scheduler import FairGate, TranscriptionScheduler
+from .base.transcriber import BaseTranscriber, TranscriptSegment
+from .config_models import Config
+from .constants import CONFIG_PATH, CREDENTIAL_PATH
+from .locales.i18n import I18n, gettext as _
 from .utils import network
-from .utils.audio import process_audio_segments
-from .utils.storage import ConfigStorage
+from .transcribers.swappable import SwappableTranscriber
+from .utils.audio import AudioChunk, process_audio_segments
+from .utils.config_watcher import ConfigWatcher
+from .utils.features import LogMelFrontend, n_mels_of
+from .utils.http_server import HttpResponse, HttpServer
+from .utils.feed import SubtitleFeed
+from .utils.journal import TranscriptJournal, apply_corrections, export_audio, read_journal, to_subtitles
+from .utils.metrics import ChunkTrace, MetricsRegistry, Tracer, current_trace
+from .utils.profiling import StartupProfile
+from .utils.quality import QualityController
+from .utils.text import split_text
+from .utils.vad import VoiceActivitySegmenter
+from .utils.storage import ConfigStorage, Constants, Room
+from .utils.transport import HttpTransport
+
+if TYPE_CHECKING:
+    from .transcribers.streaming import StreamingWhisper
 
 logger = loguru.logger
-config = ConfigStorage.get_instance().config
+profile = StartupProfile.get_instance()
+profile.t0 = _IMPORT_T0
+profile.record("imports", _IMPORT_T0, time.perf_counter())
+
+
+def _model_key(config: Config) -> tuple:
+    """
+    Settings the loaded model depends on, the model is reloaded when one of them changes
+    """
+    return (config.model_name, config.inference_backend, config.model_cache_dir, config.intra_op_threads,
+            config.inter_op_threads, config.inference_batch_size, config.inference_batch_wait_ms,
+            config.inference_pool)
 
 
-async def main():
-    def logger_level_setup():
+async def main(startup_profile: bool = False):
+    storage = ConfigStorage.get_instance()
+    config = storage.config
+
+    def logger_level_setup(config: Config):
         logger.remove()
         if config.debug:
             logger.warning(_("Debug mode is enabled."))
@@ -30,80 +68,677 @@ async def main():
         else:
             logger.add(sys.stderr, level=config.log_level)
 
-    def model_setup() -> Whisper:
+    def model_setup(config: Config) -> BaseTranscriber:
+        """
+        Load and warm up the model. Runs in a worker thread, concurrently with the stream setup.
+        """
         logger.info(_("Loading model..."))
         t0_perf = time.time()
-        m = whispers.LocalWhisper("base").model
+        # In cascade mode the inference pool runs the larger model, see refiner_setup()
+        if config.inference_pool.workers > 0 and config.transcription_mode != "streaming" and not cascade:
+            with profile.phase("model_load"):
+                # The workers load and warm up their own models, torch isn't imported by this process at all
+                from .transcribers.process_pool import ProcessPoolWhisper
+                pool = ProcessPoolWhisper(config, storage.config_path, storage.credential_path)
+            logger.success(_("Model loaded in {} worker processes. {:.2f}ms").format(
+                pool.workers, (time.time() - t0_perf) * 1000))
+            return pool
+        with profile.phase("model_load"):
+            # torch and whisper are imported here, so importing them overlaps with the stream setup as well
+            from .transcribers.factory import load_local_whisper
+            m = load_local_whisper(config, config.cascade.draft_model if cascade else None)
         delta_t_perf = (time.time() - t0_perf) * 1000
         logger.success(_("Model loaded. {:.2f}ms").format(delta_t_perf))
+        with profile.phase("warmup"):
+            # The first inference is much slower (lazy initialization, memory allocation), don't let a chunk pay it
+            import numpy as np
+            m.transcribe_sync(np.zeros(16000, dtype=np.float32))
+        if config.transcription_mode != "streaming" and config.inference_batch_size > 1:
+            from .transcribers.batched import BatchedWhisper
+            return BatchedWhisper(m, config.inference_batch_size, config.inference_batch_wait_ms)
         return m
 
-    logger_level_setup()
+    def refiner_setup(config: Config) -> BaseTranscriber:
+        """
+        Load and warm up the larger model of the cascade, isolated from the draft model:
+        in the inference pool's worker processes if there are any, otherwise on a thread of its own
+        """
+        logger.info(_("Loading the correction model..."))
+        t0_perf = time.time()
+        if config.inference_pool.workers > 0:
+            from .transcribers.process_pool import ProcessPoolWhisper
+            refiner = ProcessPoolWhisper(config, storage.config_path, storage.credential_path)
+        else:
+            import numpy as np
+            from .transcribers.dedicated import DedicatedThreadWhisper
+            from .transcribers.factory import load_local_whisper
+            m = load_local_whisper(config)
+            m.transcribe_sync(np.zeros(16000, dtype=np.float32))
+            refiner = DedicatedThreadWhisper(m, "cascade")
+        logger.success(_("Correction model loaded. {:.2f}ms").format((time.time() - t0_perf) * 1000))
+        return refiner
+
+    async def load_model() -> SwappableTranscriber:
+        return SwappableTranscriber(await asyncio.to_thread(model_setup, config))
+
+    async def load_refiner() -> SwappableTranscriber:
+        # Loaded once the draft model is ready, so the first chunks aren't delayed
+        await model_task
+        return SwappableTranscriber(await asyncio.to_thread(refiner_setup, config))
+
+    def replace(swappable: SwappableTranscriber, new: BaseTranscriber):
+        retire_task = asyncio.create_task(swappable.retire(swappable.swap(new)))
+        # The event loop only keeps weak references to tasks
+        retire_tasks.add(retire_task)
+        retire_task.add_done_callback(retire_tasks.discard)
+
+    async def swap_model():
+        """
+        Load the model of the new config in the background, and switch to it once it's ready
+        """
+        model = await model_task
+        while True:
+            new_config = storage.config
+            try:
+                new_model = await asyncio.to_thread(model_setup, new_config)
+            except Exception as e:
+                logger.error(_("Failed to load the new model, keeping the current one: {}").format(repr(e)))
+                return
+            replace(model, new_model)
+            logger.success(_("Switched to the new model."))
+            # Nothing to replace if the correction model failed to load in the first place
+            if refiner_task and refiner_task.done() and not refiner_task.cancelled() \
+                    and refiner_task.exception() is None:
+                refiner = refiner_task.result()
+                try:
+                    replace(refiner, await asyncio.to_thread(refiner_setup, new_config))
+                except Exception as e:
+                    logger.error(_("Failed to load the new correction model, keeping the current one: {}").format(
+                        repr(e)))
+                    return
+            # The config may have changed again while loading
+            if _model_key(storage.config) == _model_key(new_config):
+                return
+
+    swap_task: Optional[asyncio.Task] = None
+    retire_tasks: set[asyncio.Task] = set()
+
+    def on_config_change(old: Config, new: Config):
+        nonlocal swap_task
+        if (old.debug, old.log_level) != (new.debug, new.log_level):
+            logger_level_setup(new)
+        if _model_key(old) != _model_key(new) and (swap_task is None or swap_task.done()):
+            swap_task = asyncio.create_task(swap_model())
+
+    logger_level_setup(config)
+    # The draft model transcribes every chunk, model_name corrects the drafts in the background
+    cascade = config.cascade.enabled and config.transcription_mode == "chunked"
+    if config.cascade.enabled and not cascade:
+        logger.warning(_("The cascade only works in chunked mode, it's disabled."))
+
+    # One model shared by every room
+    model_task = asyncio.create_task(load_model())
+    refiner_task = asyncio.create_task(load_refiner()) if cascade else None
+    storage.subscribe(on_config_change)
+    # Kept referenced for the whole run, it owns the watching task
+    watcher = ConfigWatcher(storage, config.reload.poll_interval, config.reload.force_polling)
+    if config.reload.enabled:
+        watcher.start()
+    await metrics_setup()
+    await feed_setup()
+    # Rooms take turns on the model
+    gate = FairGate(config.scheduler.concurrency)
+    if len(Constants.rooms) > 1:
+        logger.info(_("Multi-room mode: {} rooms share one model.").format(len(Constants.rooms)))
+    journal = TranscriptJournal.get_instance()
+    if config.journal.enabled:
+        journal.open()
+    rooms = asyncio.gather(*(run_room(room, model_task, gate, startup_profile, refiner_task)
+                             for room in Constants.rooms), return_exceptions=True)
+    model_failed = False
+
+    def on_model_loaded(task: asyncio.Task):
+        nonlocal model_failed
+        # The rooms would keep ingesting while every chunk fails on the missing model
+        if not task.cancelled() and task.exception() is not None:
+            model_failed = True
+            logger.critical(_("Failed to load the model: {}").format(repr(task.exception())))
+            rooms.cancel()
 
-    stream_url = (await network.get_stream_urls())[0]
-    logger.info(_("Stream URL: {}").format(stream_url))
+    def on_refiner_loaded(task: asyncio.Task):
+        # The drafts are sent uncorrected then, the refiners of the rooms give up on their own
+        if not task.cancelled() and task.exception() is not None and not model_failed:
+            logger.error(_("Failed to load the correction model, drafts stay uncorrected: {}").format(
+                repr(task.exception())))
 
-    model = model_setup()
-    sending_worker = DanmakuSendingWorker()
+    model_task.add_done_callback(on_model_loaded)
+    if refiner_task:
+        refiner_task.add_done_callback(on_refiner_loaded)
+    try:
+        results = await rooms
+    except asyncio.CancelledError:
+        if not model_failed:
+            raise
+        results = []
+    finally:
+        watcher.stop()
+        await SubtitleFeed.get_instance().stop()
+        await HttpTransport.get_instance().close()
+        # Waits for the queued records to be written
+        journal.close()
+    if model_failed:
+        sys.exit(1)
+    for room, result in zip(Constants.rooms, results):
+        if isinstance(result, Exception):
+            logger.error(_("Room {}: {}").format(room.room_id, repr(result)))
+    logger.warning(_("Stream ended, program exiting."))
+    sys.exit(0)
 
-    asyncio.create_task(sending_worker())
+
+async def run_room(room: Room, model_task: "asyncio.Task[BaseTranscriber]", gate: FairGate,
+                   startup_profile: bool = False, refiner_task: "Optional[asyncio.Task[BaseTranscriber]]" = None):
+    """
+    Ingest, transcription scheduling and danmaku sending of one live room, until its stream ends
+    :param room: Live room
+    :param model_task: Task loading the transcriber shared by the rooms
+    :param gate: Slots of the shared transcriber the rooms take turns on
+    :param startup_profile: Print the startup profile after the first transcription
+    :param refiner_task: Task loading the larger transcriber of the cascade, shared by the rooms
+    """
+    config = ConfigStorage.get_instance().config
+    gate.set_weight(room.room_id, room.weight)
+    sending_worker = DanmakuSendingWorker(room.live_room, room.danmaku_display_mode)
+    # Built once for the room, the global chain is shared by the rooms without an override
+    handlers = TextHandlerChain(room.text_handlers) if room.text_handlers is not None \
+        else TextHandlerChain.get_instance()
+
+    sending_task = asyncio.create_task(sending_worker())
     logger.success(_("sending_worker task has been created."))
+    feed = SubtitleFeed.get_instance()
+    # Chunks are refined by the cascade in chunked mode only
+    drafts = refiner_task is not None and config.transcription_mode != "streaming"
+
+    async def deliver(_index: int, result: tuple[list[tuple[str, float, str]], ChunkTrace]):
+        danmaku, trace = result
+        trace.danmaku = [text for text, _spoken_at, _raw in danmaku]
+        # Drafts of the cascade are published again once the larger model has had its say
+        feed.publish_trace(trace, final=not drafts)
+        if profile.mark_once("first_transcription") and startup_profile:
+            logger.info(_("Startup profile:\n{}").format(profile.report()))
+        # Subtitles merged by the sender are formatted again as a whole
+        text_format = TextFormatterHandler(trace.index, room.danmaku_text_format).format
+        for text, spoken_at, raw in danmaku:
+            await sending_worker.put_danmaku(text, trace=trace, spoken_at=spoken_at, raw_text=raw,
+                                             text_format=text_format)
+        trace.delivered()
+
+    async def job(index: int, chunk: AudioChunk) -> tuple[list[tuple[str, float, str]], ChunkTrace]:
+        # The samples are given back to the ring buffer once the draft is transcribed
+        pcm = chunk.pcm.copy() if refiner else None
+        danmaku = await process_worker(await model_task, chunk, index, room.danmaku_text_format, handlers)
+        if refiner and chunk.trace.segments:
+            refiner.submit(pcm, chunk.trace)
+        return danmaku, chunk.trace
+
+    async def correct(draft: ChunkTrace, segments: list[TranscriptSegment]):
+        """
+        Journal, and send if enabled, the transcription of the larger model in place of the draft
+        """
+        trace = ChunkTrace(draft.index, draft.audio_duration)
+        trace.room, trace.status = draft.room, "corrected"
+        trace.audio_range, trace.wall_offset = draft.audio_range, draft.wall_offset
+        start_time = draft.audio_range[0]
+        trace.segments = [(start_time + s.start, start_time + s.end, s.text) for s in segments]
+        cascade = ConfigStorage.get_instance().config.cascade
+        if cascade.send_corrections or feed.subscribers:
+            token = current_trace.set(trace)
+            try:
+                danmaku = await text_to_danmaku(segments, draft.index, cascade.correction_text_format, handlers)
+            finally:
+                current_trace.reset(token)
+            feed.publish_trace(trace)
+            if cascade.send_corrections:
+                trace.danmaku = [text for text, _t, _raw in danmaku]
+                text_format = TextFormatterHandler(draft.index, cascade.correction_text_format).format
+                for text, _t, raw in danmaku:
+                    await sending_worker.put_danmaku(text, trace=trace, raw_text=raw, text_format=text_format)
+        trace.delivered()
+
+    def keep(draft: ChunkTrace):
+        feed.publish_trace(draft)
+
+    first_resolve = True
+
+    async def resolve_stream_urls() -> list[str]:
+        nonlocal first_resolve
+        if not first_resolve:
+            return await network.get_stream_urls(room.live_room)
+        first_resolve = False
+        with profile.phase("resolve_stream_urls"):
+            return await network.get_stream_urls(room.live_room)
+
+    scheduler = TranscriptionScheduler(job, deliver,
+                                       concurrency=config.scheduler.concurrency,
+                                       max_backlog=config.scheduler.max_backlog,
+                                       overload_policy=config.scheduler.overload_policy,
+                                       gate=gate, gate_key=room.room_id, max_lag=room.max_lag)
+    scheduler.start()
+    register_room_metrics(room, scheduler, sending_worker)
+    QualityController.get_instance().add_backlog(lambda: scheduler.queue_depth)
+    journal = TranscriptJournal.get_instance()
+    refiner = None
+    if refiner_task:
+        # Both tiers share the CPU unless the larger model runs in worker processes, the draft goes first then
+        draft_busy = (lambda: scheduler.queue_depth > 0 or scheduler.in_flight > 0) \
+            if config.inference_pool.workers == 0 else None
+        refiner = CascadeRefiner(refiner_task, correct, config.cascade.correction_threshold,
+                                 config.cascade.max_pending, draft_busy, keep)
+        register_cascade_metrics(room, refiner)
+    refiner_worker = asyncio.create_task(refiner()) if refiner else None
+    streaming_task = None
+    streaming_model = None
+    chunk_duration = config.segment_time_length
+    # Chunks alive at the same time: the backlog, the ones being transcribed and the one being read
+    buffer_slots = config.scheduler.max_backlog + config.scheduler.concurrency + 1
+    frontend = None
+    # Inference workers compute their features themselves, the draft model of the cascade runs in this process
+    if config.frontend.enabled and (config.transcription_mode == "streaming" or config.inference_pool.workers == 0
+                                    or refiner):
+        ring_seconds = config.frontend.ring_seconds
+        if not ring_seconds:
+            # Long enough for every chunk that may still be waiting to be transcribed
+            if config.transcription_mode == "streaming":
+                ring_seconds = config.streaming.max_window_length + 2 * config.streaming.hop_length
+            elif config.segmentation_mode == "vad":
+                ring_seconds = buffer_slots * config.vad.max_utterance_length
+            else:
+                ring_seconds = buffer_slots * chunk_duration
+        frontend = LogMelFrontend(n_mels_of(config.cascade.draft_model if refiner else config.model_name),
+                                  ring_seconds)
+    if config.transcription_mode == "streaming":
+        from .transcribers.streaming import StreamingWhisper
+
+        async def streaming_setup() -> StreamingWhisper:
+            # The sliding window is per room, the model underneath is shared
+            return StreamingWhisper(await model_task, config.streaming, frontend)
+
+        def on_streaming_done(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(_("Room {}: streaming worker failed: {}").format(room.room_id, repr(task.exception())))
+
+        streaming_model = asyncio.create_task(streaming_setup())
+        streaming_task = asyncio.create_task(streaming_worker(streaming_model, deliver, room, gate, handlers))
+        streaming_task.add_done_callback(on_streaming_done)
+        chunk_duration = config.streaming.hop_length
+
+    segmenter = VoiceActivitySegmenter(config.vad) \
+        if config.segmentation_mode == "vad" and not streaming_task else None
+    if segmenter:
+        def on_config_change(old: Config, new: Config):
+            if new.vad != old.vad:
+                segmenter.set_params(new.vad)
+
+        ConfigStorage.get_instance().subscribe(on_config_change)
+    try:
+        # Stream URLs are resolved by the ingest, which fails over between them and reconnects on errors.
+        # The model keeps loading meanwhile, chunks wait in the scheduler backlog until it is ready.
+        async for audio_chunk in process_audio_segments(resolve_stream_urls, chunk_duration=chunk_duration,
+                                                        segmenter=segmenter, buffer_slots=buffer_slots,
+                                                        ingest_params=config.ingest, frontend=frontend):
+            profile.mark_once("first_audio_chunk")
+            audio_chunk.trace.room = room.room_id
+            if journal.archive_audio:
+                # The samples are given back to the ring buffer once transcribed, before the trace finishes
+                audio_chunk.trace.audio = audio_chunk.pcm.copy()
+            if streaming_task:
+                if streaming_task.done():
+                    # Nothing transcribes the window anymore, it would only grow
+                    raise RuntimeError(_("Streaming worker stopped."))
+                model = await streaming_model
+                with audio_chunk.as_float32() as audio:
+                    model.insert_audio(audio, audio_chunk.trace.stamps.get("captured"))
+                continue
+            await scheduler.submit(audio_chunk)
+            logger.debug(scheduler.stats())
+    except EndOfStream:
+        logger.warning(_("Room {}: stream ended.").format(room.room_id))
+        if streaming_task and not streaming_task.done():
+            # Transcribes the last window and delivers the words not committed yet
+            (await streaming_model).close()
+            await asyncio.wait([streaming_task])
+        await scheduler.join()
+        if refiner:
+            await refiner.join()
+    finally:
+        if streaming_task:
+            streaming_task.cancel()
+        if refiner_worker:
+            refiner_worker.cancel()
+        await scheduler.stop()
+        sending_task.cancel()
+
 
+async def metrics_setup():
+    """
+    Start the metrics endpoint and the trace sink if enabled
+    """
+    config = ConfigStorage.get_instance().config
+    registry = MetricsRegistry.get_instance()
+    registry.window = config.metrics.quantile_window
+    tracer = Tracer.get_instance()
+    quality = QualityController.get_instance()
+    registry.gauge("submaku_quality_tier", "Decoding quality tier, 0 is whisper_params as configured",
+                   lambda: quality.tier)
+    registry.counter("submaku_quality_tier_changes_total", "Decoding quality tier changes", lambda: quality.changes)
+    registry.gauge("submaku_quality_real_time_factor", "Smoothed real-time factor the quality tier is chosen by",
+                   lambda: quality.rtf)
+    if config.metrics.jsonl_path:
+        tracer.open_sink(config.metrics.jsonl_path)
+    if config.metrics.enabled:
+        async def serve_metrics(_request) -> HttpResponse:
+            return HttpResponse(body=registry.render().encode(), content_type="text/plain; version=0.0.4")
+
+        server = HttpServer(config.metrics.host, config.metrics.port)
+        server.route("/metrics", serve_metrics)
+        await server.start()
+
+
+async def feed_setup():
+    """
+    Start the subtitle feed if enabled
+    """
+    config = ConfigStorage.get_instance().config
+    if not config.feed.enabled:
+        return
+    registry = MetricsRegistry.get_instance()
+    feed = SubtitleFeed.get_instance()
+    registry.gauge("submaku_feed_subscribers", "Subscribers of the subtitle feed", lambda: feed.subscribers)
+    registry.counter("submaku_feed_events_total", "Events published to the subtitle feed", lambda: feed.published)
+    registry.counter("submaku_feed_evicted_total", "Subtitle feed subscribers disconnected for falling behind",
+                     lambda: feed.evicted)
+    await feed.start()
+
+
+def register_room_metrics(room: Room, scheduler: TranscriptionScheduler, sending_worker: DanmakuSendingWorker):
+    """
+    Export the scheduler and sender state of a room
+    """
+    registry = MetricsRegistry.get_instance()
+    labels = {"room": str(room.room_id)}
+    registry.gauge("submaku_scheduler_queue_depth", "Chunks waiting to be transcribed",
+                   lambda: scheduler.queue_depth, labels)
+    registry.gauge("submaku_scheduler_in_flight", "Chunks being transcribed", lambda: scheduler.in_flight, labels)
+    registry.gauge("submaku_scheduler_reorder_depth", "Finished chunks waiting for earlier chunks",
+                   lambda: scheduler.reorder_depth, labels)
+    registry.gauge("submaku_scheduler_lag_seconds", "Age of the oldest unfinished chunk", lambda: scheduler.lag,
+                   labels)
+    registry.counter("submaku_scheduler_dropped_chunks_total", "Chunks dropped by the overload policy or lag limit",
+                     lambda: scheduler.dropped_chunks, labels)
+    registry.gauge("submaku_sender_queue_depth", "Danmaku waiting to be sent", lambda: sending_worker.queue_depth,
+                   labels)
+    registry.gauge("submaku_sender_queue_age_seconds", "Age of the oldest queued danmaku",
+                   lambda: sending_worker.queue_age, labels)
+    registry.counter("submaku_danmaku_sent_total", "Danmaku sent", lambda: sending_worker.sent_danmaku_amount,
+                     labels)
+    registry.counter("submaku_danmaku_dropped_total", "Danmaku dropped because they were stale or failed",
+                     lambda: sending_worker.dropped_danmaku_amount, labels)
+    registry.counter("submaku_sender_retries_total", "Retries of failed danmaku",
+                     lambda: sending_worker.retried_danmaku_amount, labels)
+    registry.counter("submaku_sender_shed_total", "Danmaku shed because the queue was full or sending was paused",
+                     lambda: sending_worker.shed_danmaku_amount, labels)
+    registry.counter("submaku_sender_dead_letters_total", "Danmaku given up on",
+                     lambda: sending_worker.dead_letter_amount, labels)
+    registry.gauge("submaku_sender_circuit_open", "1 while sending is paused by the circuit breaker",
+                   lambda: int(sending_worker.circuit_open), labels)
+
+
+def register_cascade_metrics(room: Room, refiner: CascadeRefiner):
+    """
+    Export the state of the cascade's second tier in a room
+    """
+    registry = MetricsRegistry.get_instance()
+    labels = {"room": str(room.room_id)}
+    registry.gauge("submaku_cascade_queue_depth", "Chunks waiting for the larger model", lambda: refiner.queue_depth,
+                   labels)
+    registry.counter("submaku_cascade_refined_total", "Chunks transcribed again by the larger model",
+                     lambda: refiner.refined, labels)
+    registry.counter("submaku_cascade_corrections_total", "Drafts corrected by the larger model",
+                     lambda: refiner.corrected, labels)
+    registry.counter("submaku_cascade_skipped_total", "Chunks left uncorrected because the larger model was behind",
+                     lambda: refiner.skipped, labels)
+
+
+async def streaming_worker(model_task: "asyncio.Task[StreamingWhisper]", deliver, room: Optional[Room] = None,
+                           gate: Optional[FairGate] = None, handlers: Optional[TextHandlerChain] = None):
+    """
+    Transcribe the sliding window whenever new audio arrives, and deliver the committed text.
+    Once the transcriber is closed, the last window is transcribed and the words still pending are delivered too.
+    :param model_task: Task loading the streaming transcriber fed by the ingest loop
+    :param deliver: Coroutine function receiving (index, ([(danmaku text, spoken at, text before formatting)], trace))
+    :param room: Live room the audio comes from
+    :param gate: Slots of the shared transcriber, taken for every transcription of the window
+    :param handlers: Text handler chain of the room, defaults to the one of config.text_handlers
+    """
+    model = await model_task
     total_chunks = 0
-    while 1:
+    while True:
+        await model.wait_for_audio()
+        closed = model.closed
+        trace = ChunkTrace(total_chunks, model.buffer_duration)
+        trace.room = room.room_id if room else None
         try:
-            async for audio_chunk in process_audio_segments(stream_url, chunk_duration=config.segment_time_length):
-                asyncio.create_task(process_worker(model, audio_chunk, sending_worker, total_chunks))
+            text = await _transcribe_window(model, trace, gate)
+            if closed:
+                text += model.finish()
+            if text.strip():
+                logger.debug(text)
+                await _deliver_words(model, text, trace, deliver, room, handlers)
                 total_chunks += 1
-        except EndOfStream:
-            logger.warning(_("Stream ended, program exiting."))
-            sys.exit(0)
-        except ffmpeg.Error as e:
-            logger.error(_("Error occurred while processing the audio stream:"), e)
-            logger.error(e.stderr.decode())
-
-
-async def process_worker(model: Whisper, audio_chunk: ndarray, sending_worker: DanmakuSendingWorker, total_chunks: int):
-    def text_segmentation(txt: str) -> list[str]:
-        res = []
-        if config.max_chars_per_danmaku and len(txt) > config.max_chars_per_danmaku:
-            logger.info(_("Text is trimmed due to exceeding char limits."))
-            mcpd = config.max_chars_per_danmaku
-            mcpas = config.max_chars_per_audio_segment if config.max_chars_per_audio_segment != 0 else len(txt)
-            txt = txt[:mcpas]
-            i = 0
-            end = 0
-            for end in range(mcpd, len(txt) + 1, mcpd):
-                seg = txt[end - mcpd:end]
-                logger.info(_("Segment{i}: {segment}").format(i=i, segment=seg))
-                res.append(seg)
-                i += 1
-            txt = txt[end: end + mcpd - 1]
-            if txt:
-                logger.info(_("Segment{i}: {formatted_text}").format(i=i, formatted_text=txt))
-        if txt:
-            res.append(txt)
-        return res
-
-    async def transcribe(audio_arr: np.ndarray):
+        except Exception as e:
+            # A failed window doesn't end the stream, the audio keeps being transcribed with the next window
+            logger.error(repr(e))
+        if closed:
+            return
+
+
+async def _transcribe_window(model: "StreamingWhisper", trace: ChunkTrace, gate: Optional[FairGate]) -> str:
+    t0_perf = time.time()
+    async with gate.slot(trace.room, model.buffer_duration) if gate else contextlib.nullcontext():
+        trace.mark("inference_start")
+        text = await model.process_iter()
+    trace.mark("inference_end")
+    logger.debug(_("Transcription costs: {:.2f}ms").format((time.time() - t0_perf) * 1000))
+    # The window has to be transcribed again every hop
+    QualityController.get_instance().observe(trace.stage("inference_start", "inference_end"),
+                                             ConfigStorage.get_instance().config.streaming.hop_length)
+    return text
+
+
+async def _deliver_words(model: "StreamingWhisper", text: str, trace: ChunkTrace, deliver,
+                         room: Optional[Room], handlers: Optional[TextHandlerChain]):
+    words = model.last_committed
+    segment = TranscriptSegment(words[0].start, words[-1].end, text, words)
+    trace.audio_range = (segment.start, segment.end)
+    trace.segments = [(segment.start, segment.end, text)]
+    trace.wall_offset = model.wall_time(0.0)
+    token = current_trace.set(trace)
+    try:
+        danmaku = await text_to_danmaku([segment], trace.index, room.danmaku_text_format if room else None,
+                                        handlers)
+    finally:
+        current_trace.reset(token)
+    # Word timestamps are stream time
+    await deliver(trace.index, ([(txt, model.wall_time(t), raw) for txt, t, raw in danmaku], trace))
+
+
+async def process_worker(model: BaseTranscriber, audio_chunk: AudioChunk, total_chunks: int,
+                         text_format: str = None,
+                         handlers: Optional[TextHandlerChain] = None) -> list[tuple[str, float, str]]:
+    """
+    Transcribe an audio chunk and turn it into danmaku texts
+    :param model: Transcriber
+    :param audio_chunk: Audio chunk
+    :param total_chunks: Index of the chunk
+    :param text_format: Danmaku text format, defaults to config.danmaku_text_format
+    :param handlers: Text handler chain, defaults to the one of config.text_handlers
+    :return: Danmaku texts to be sent, with the wall clock time their audio was received and the text before
+        formatting
+    """
+    trace = audio_chunk.trace
+    duration = audio_chunk.duration
+
+    async def transcribe(chunk: AudioChunk):
         t0_perf = time.time()
+        trace.mark("inference_start", t0_perf)
         try:
-            res = await asyncio.to_thread(model.transcribe, audio_arr, **config.whisper_params)
+            # Convert to float32 only now, the chunk has waited in the backlog as int16
+            with chunk.as_float32() as audio_arr:
+                if getattr(model, "accepts_log_mel", False):
+                    # Features computed by the ingest, the samples stay available to fall back on
+                    audio_arr = chunk.log_mel(audio_arr) or audio_arr
+                res = await model.transcribe_segments(audio_arr)
         except RuntimeError as e:
             logger.error(repr(e))
-            return
+            return None, 0
+        trace.mark("inference_end")
         dt = (time.time() - t0_perf) * 1000
-        return res["text"], dt
+        return res, dt
 
-    text, dt_perf = await transcribe(audio_chunk)
+    segments, dt_perf = await transcribe(audio_chunk)
+    if segments is None:
+        return []
+    QualityController.get_instance().observe(dt_perf / 1000, duration)
+    start_time = audio_chunk.start_time
+    trace.segments = [(start_time + s.start, start_time + s.end, s.text) for s in segments]
     logger.info(_("Transcription costs: {:.2f}ms").format(dt_perf))
-    logger.debug(text)
-    chains = TextPreprocessorHandler().set_next(TextFormatterHandler(total_chunks))
-    product = await chains.handle(text)
-    for segment in text_segmentation(product):
-        await sending_worker.put_danmaku(segment)
+    logger.debug("".join(s.text for s in segments))
+    token = current_trace.set(trace)
+    try:
+        danmaku = await text_to_danmaku(segments, total_chunks, text_format, handlers)
+    finally:
+        current_trace.reset(token)
+    # The chunk was captured when its last sample arrived
+    captured_at = trace.stamps.get("captured", time.time())
+    trace.wall_offset = captured_at - (start_time + duration)
+    return [(text, captured_at - (duration - t), raw) for text, t, raw in danmaku]
+
+
+async def text_to_danmaku(segments: list[TranscriptSegment], total_chunks: int,
+                          text_format: str = None,
+                          handlers: Optional[TextHandlerChain] = None) -> list[tuple[str, float, str]]:
+    """
+    Run the text handlers and split the transcription into danmaku-sized texts.
+    Texts are split at segment and punctuation boundaries, and keep the timestamp of their first character.
+    :param segments: Transcribed segments
+    :param total_chunks: Index of the chunk
+    :param text_format: Danmaku text format, defaults to config.danmaku_text_format
+    :param handlers: Text handler chain, defaults to the one of config.text_handlers
+    :return: Danmaku texts to be sent, with the timestamp of their audio (same time base as the segments)
+        and the text before formatting
+    """
+    config = ConfigStorage.get_instance().config
+    trace = current_trace.get()
+    if trace:
+        trace.mark("handlers_start")
+    text_format = text_format or config.danmaku_text_format
+    formatter = TextFormatterHandler(total_chunks, text_format)
+    # Room left for the text once it's formatted
+    overhead = len(text_format.format(transcription_text="", sent_danmaku_amount=total_chunks,
+                                                     danmaku_order_num=total_chunks % config.max_order_num))
+    max_chars = max(1, config.max_chars_per_danmaku - overhead) if config.max_chars_per_danmaku else 0
+    # Total text length allowed for the chunk
+    budget = config.max_chars_per_audio_segment or float("inf")
+
+    res = []
+    handled = []
+    for segment in segments:
+        text = await (handlers or TextHandlerChain.get_instance()).handle(segment.text)
+        handled.append(text)
+        for start, end in split_text(text, max_chars):
+            piece = text[start:end]
+            if len(piece) > budget:
+                logger.info(_("Text is trimmed due to exceeding char limits."))
+                # Whole pieces only, unless not even the first one fits
+                if res:
+                    budget = 0
+                    break
+                piece = piece[:int(budget)]
+            budget -= len(piece)
+            logger.info(_("Segment{i}: {segment}").format(i=len(res), segment=piece))
+            if trace:
+                trace.enter_handlers()
+            res.append((await formatter.handle(piece), segment.time_at(start), piece))
+        if budget <= 0:
+            break
+    if trace:
+        trace.mark("handlers_end")
+        trace.text = "".join(handled)
+    return res
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="submaku_stream")
+    parser.add_argument("-c", "--config", help="Path to the config base folder")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Print a per-phase timing breakdown once the first chunk is transcribed")
+    subparsers = parser.add_subparsers(dest="command")
+    export = subparsers.add_parser("export", help="Export a range of the transcript journal to SRT/VTT subtitles")
+    export.add_argument("-o", "--output", help="Subtitle file, defaults to stdout")
+    export.add_argument("-f", "--format", choices=("srt", "vtt"), help="Defaults to the suffix of the output, or srt")
+    export.add_argument("--journal", help="Journal folder, defaults to journal.path of the config")
+    export.add_argument("--room", type=int, help="Only export this room")
+    export.add_argument("--since", type=datetime.fromisoformat,
+                        help="Local time the range starts at, e.g. 2024-05-01T20:00. Also the origin of the timestamps")
+    export.add_argument("--until", type=datetime.fromisoformat, help="Local time the range ends at")
+    export.add_argument("--time-base", choices=("wall", "stream"), default="wall",
+                        help="Place the cues by when their audio was received (default), or by the stream time")
+    export.add_argument("--audio", help="Also write the archived audio of the range to this WAV file")
+    return parser.parse_args(argv)
+
+
+def export_journal(args: argparse.Namespace, config: Config):
+    """
+    The export subcommand
+    """
+    folder = Path(args.journal or config.journal.path)
+    since = args.since.timestamp() if args.since else None
+    until = args.until.timestamp() if args.until else None
+    records = list(read_journal(folder, since, until, args.room))
+    fmt = args.format or ("vtt" if args.output and args.output.lower().endswith(".vtt") else "srt")
+    subtitles = to_subtitles(apply_corrections(records), fmt, args.time_base, since)
+    if args.output:
+        Path(args.output).write_text(subtitles, encoding="utf-8")
+    else:
+        sys.stdout.write(subtitles)
+    logger.info(_("Exported {} records from {}").format(len(records), folder))
+    if args.audio:
+        try:
+            # Including the chunks dropped under load, a replay should get the same audio
+            duration = export_audio(records, folder, Path(args.audio), args.time_base, since)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        logger.info(_("Audio saved to {}").format(args.audio) + f" ({duration:.1f}s)")
+
+
+def cli(argv: list[str] = None):
+    args = parse_args(argv)
+    with profile.phase("config"):
+        if args.config:
+            storage = ConfigStorage.load(Path(args.config) / CONFIG_PATH.name, Path(args.config) / CREDENTIAL_PATH.name)
+        else:
+            storage = ConfigStorage.load()
+        I18n.get_instance().set_locale(storage.config.program_display_language)
+    if args.command == "export":
+        export_journal(args, storage.config)
+        return
+    with profile.phase("room_setup"):
+        Constants.setup(storage)
+    asyncio.run(main(args.startup_profile), debug=storage.config.debug)
 
 
 if __name__ == '__main__':
     # TODO add exit handler
-    asyncio.run(main(), debug=config.debug)
+    # Inference worker processes of frozen builds start through the executable as well
+    multiprocessing.freeze_support()
+    cli()
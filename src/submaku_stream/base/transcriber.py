@@ -1,10 +1,58 @@
 """
 Base Transcriber
 """
+import bisect
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+
+SAMPLE_RATE = 16000
+
+
+@dataclass
+class TranscriptWord:
+    # Seconds
+    start: float
+    end: float
+    text: str
+
+
+@dataclass
+class TranscriptSegment:
+    # Seconds, relative to the start of the transcribed audio
+    start: float
+    end: float
+    text: str
+    # Word timestamps, if the transcriber provides them
+    words: list[TranscriptWord] = field(default_factory=list)
+
+    def time_at(self, offset: int) -> float:
+        """
+        Timestamp of the character at the offset in text,
+        from the word timestamps if available, otherwise interpolated over the segment
+        """
+        if self.words:
+            # Word texts concatenate to the segment text, up to whitespace
+            starts, position = [], 0
+            for word in self.words:
+                starts.append(position)
+                position += len(word.text)
+            return self.words[max(0, bisect.bisect_right(starts, offset) - 1)].start
+        if not self.text:
+            return self.start
+        return self.start + (self.end - self.start) * min(1.0, offset / len(self.text))
 
 
 class BaseTranscriber(ABC):
     @abstractmethod
     async def transcribe(self, audio_segments):
         raise NotImplementedError
+
+    async def transcribe_segments(self, audio_segment, translate=False) -> list[TranscriptSegment]:
+        """
+        Transcribe with timestamps. Transcribers without timestamps return the text as one segment
+        spanning the whole audio.
+        """
+        text = await self.transcribe(audio_segment, translate)
+        if not text.strip():
+            return []
+        return [TranscriptSegment(0.0, audio_segment.shape[-1] / SAMPLE_RATE, text)]
@@ -1,7 +1,7 @@
 from pathlib import Path
-from typing import TypeVar, Type, Literal
+from typing import Annotated, TypeVar, Type, Literal, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 T = TypeVar('T')
 
@@ -14,22 +14,334 @@ class MyBaseModel(BaseModel):
             return cls.model_validate_json(json_data)
 
 
+class VadConfig(BaseModel):
+    # Analysis frame length in milliseconds
+    frame_ms: int = 30
+    # Frames quieter than this RMS level (dBFS) are treated as silence
+    energy_threshold_db: float = -40.0
+    # Frames with a higher zero-crossing rate are treated as noise unless they are clearly loud
+    zcr_threshold: float = 0.35
+    # Seconds. A chunk is only closed at a silence once it is at least this long
+    min_utterance_length: float = 1.0
+    # Seconds. A chunk is forcibly closed at this length
+    max_utterance_length: float = 15.0
+    # Seconds of silence tolerated inside an utterance before it's considered ended
+    hangover: float = 0.3
+    # Seconds of audio kept before the detected speech onset
+    pre_roll: float = 0.2
+    # Seconds. Utterances with less speech than this are discarded
+    min_speech_length: float = 0.2
+
+
+class SchedulerConfig(BaseModel):
+    # Max number of chunks transcribed at the same time
+    concurrency: int = 1
+    # Max number of chunks waiting to be transcribed
+    max_backlog: int = 4
+    # What to do with a new chunk when the backlog is full
+    overload_policy: Literal["block", "drop_oldest", "drop_newest"] = "drop_oldest"
+    # Seconds. Chunks which have waited longer than this when their turn comes are dropped, 0 means never
+    max_lag: float = 0.0
+
+
+class StreamingConfig(BaseModel):
+    # Seconds of new audio between two transcriptions of the window
+    hop_length: float = 1.0
+    # Seconds. Once the window is longer, it is trimmed at the last committed word
+    trim_length: float = 10.0
+    # Seconds. The pending hypothesis is committed without agreement once the window is longer
+    max_window_length: float = 25.0
+    # Characters of committed text passed to whisper as the prompt of the next window
+    prompt_chars: int = 200
+
+
+class IngestConfig(BaseModel):
+    ffmpeg_path: str = "ffmpeg"
+    # Bytes / microseconds ffmpeg may spend probing the input before decoding starts
+    probesize: int = 32768
+    analyzeduration: int = 500000
+    # Seconds without audio after which the stream is considered stalled and the next URL is tried
+    stall_timeout: float = 5.0
+    # Seconds. Backoff before resolving the stream URLs again once all of them failed
+    reconnect_backoff_base: float = 1.0
+    reconnect_backoff_max: float = 30.0
+    # Give up after this many rounds in a row without any audio, 0 means never
+    max_resolve_attempts: int = 0
+    # Extra HTTP headers sent to the stream server
+    http_headers: dict[str, str] = {"Referer": "https://live.bilibili.com/"}
+    # Read the input at its native rate (ffmpeg -re), to replay a local file as if it was live
+    realtime: bool = False
+
+
+class SenderConfig(BaseModel):
+    # Danmaku per second the platform accepts, 0 derives it from sending_delay
+    rate_limit: float = 0.0
+    # Danmaku that may be sent back to back after being idle
+    burst: int = 1
+    # Seconds. Subtitles waiting longer than this are dropped instead of sent, 0 means never
+    max_age: float = 10.0
+    # Merge short adjacent subtitles into one danmaku of at most max_chars_per_danmaku
+    coalesce: bool = True
+    # Seconds. A subtitle is released this long after its audio was received, so subtitles are paced with the speech.
+    # Should cover the pipeline latency, later subtitles are sent right away. 0 sends every subtitle when ready
+    release_offset: float = 8.0
+    # Seconds before the first retry of a failed danmaku, doubled for every further retry up to retry_backoff_max,
+    # minus up to half of it at random. max_retry_times is the number of retries
+    retry_backoff_base: float = 1.0
+    retry_backoff_max: float = 30.0
+    # Failed sends in a row after which sending pauses for breaker_cooldown seconds. Then a single danmaku is tried,
+    # and the pause doubles up to breaker_max_cooldown while that fails as well
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 15.0
+    breaker_max_cooldown: float = 300.0
+    # Danmaku queued at most per room, new ones are shed beyond this. New subtitles are shed while sending is paused
+    max_queue: int = 200
+    # Danmaku given up on are appended to this JSONL file, null only logs them
+    dead_letter_path: Optional[str] = "dead_letter.jsonl"
+
+
+class TransportConfig(BaseModel):
+    # Send danmaku and resolve streams through one shared keep-alive connection pool instead of bilibili_api.
+    # Opt-in, danmaku are then posted to the send API directly rather than through bilibili_api's send path
+    pooled: bool = False
+    # Needs the h2 package
+    http2: bool = False
+    # Base URL of the live APIs, e.g. a local mock server for benchmarks
+    api_base: str = "https://api.live.bilibili.com"
+    max_connections: int = 10
+    max_keepalive_connections: int = 5
+    # Seconds an idle connection is kept open
+    keepalive_expiry: float = 60.0
+    # Seconds
+    connect_timeout: float = 3.0
+    read_timeout: float = 5.0
+    write_timeout: float = 5.0
+    # Seconds to wait for a free connection of the pool
+    pool_timeout: float = 2.0
+
+
+class MetricsConfig(BaseModel):
+    # Serve the metrics in the Prometheus text format on http://host:port/metrics
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9464
+    # Append every chunk's trace as a JSON line to this file, null disables it
+    jsonl_path: Optional[str] = None
+    # Recent samples the p50/p95/p99 are computed from
+    quantile_window: int = 1024
+
+
+class FeedConfig(BaseModel):
+    # Publish every transcription to local subscribers, e.g. a browser source overlay in OBS:
+    # WebSocket on ws://host:port/ws, Server-Sent Events on http://host:port/events, ?room=<room id> picks one room.
+    # http://host:port/overlay is a minimal overlay page
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9465
+    # Events buffered per subscriber, a subscriber falling this far behind is disconnected
+    buffer_size: int = 256
+    # Seconds. A subscriber not reading for this long is disconnected, 0 waits forever
+    write_timeout: float = 5.0
+    # Seconds between keep-alive pings to idle subscribers, 0 disables them
+    ping_interval: float = 15.0
+
+
+class RepeatFilterConfig(BaseModel):
+    # A word, character or phrase repeated at least this many times in a row is collapsed into one occurrence
+    min_repeats: int = 3
+    # Repeated units shorter than this many characters are kept
+    min_unit_chars: int = 1
+    # Longest repeated phrase searched for, in words / CJK characters
+    max_unit_tokens: int = 32
+
+
+class RepeatFilterHandlerConfig(BaseModel):
+    # Collapses looping whisper output, see repeat_filter
+    type: Literal["repeat_filter"] = "repeat_filter"
+    # Name of the handler in the traces and metrics, defaults to the handler class
+    name: Optional[str] = None
+
+
+class GlossaryHandlerConfig(BaseModel):
+    # Replaces and masks the entries of glossaries in a single pass over the text, e.g. streamer names, game terms,
+    # known mis-hearings and banned words
+    type: Literal["glossary"] = "glossary"
+    name: Optional[str] = None
+    # Glossary files, relative to the config folder. One entry per line: "pattern => replacement" replaces the
+    # pattern, a pattern alone is masked. Lines starting with # are comments. Later entries override earlier ones
+    files: list[str] = []
+    # Entries in the same format, after the ones of the files
+    entries: list[str] = []
+    ignore_case: bool = True
+    # Patterns starting or ending with a letter or digit only match whole words. CJK characters always match
+    whole_words: bool = True
+    # Masked patterns are replaced with this character, once per character
+    mask_char: str = "*"
+    # Seconds between two checks of the files for changes, 0 never reloads them
+    reload_interval: float = 5.0
+
+
+TextHandlerConfig = Annotated[Union[RepeatFilterHandlerConfig, GlossaryHandlerConfig], Field(discriminator="type")]
+
+
+class QualityConfig(BaseModel):
+    # Step down the decoding quality while transcription can't keep up, and back up once it has caught up
+    adaptive: bool = False
+    # whisper_params overrides of the tiers below the configured whisper_params, from the best to the fastest
+    tiers: list[dict] = [{"beam_size": 2, "best_of": 2, "temperature": 0.0},
+                         {"beam_size": None, "best_of": None, "temperature": 0.0}]
+    # Real-time factor (inference time / audio duration per inference slot) above which a tier is dropped
+    rtf_high: float = 0.8
+    # Below this, and with at most backlog_low chunks waiting, the load is considered low
+    rtf_low: float = 0.5
+    # Chunks waiting in a scheduler from which a tier is dropped
+    backlog_high: int = 2
+    backlog_low: int = 0
+    # Seconds between two step downs
+    step_down_interval: float = 5.0
+    # Seconds the load has to stay low before stepping up a tier
+    step_up_after: float = 30.0
+    # Weight of the latest chunk in the smoothed real-time factor
+    rtf_smoothing: float = 0.3
+    # Without a language in whisper_params, reuse the detected language instead of detecting it for every chunk
+    language_cache: bool = True
+    # Seconds after which the language is detected again, 0 means never
+    language_ttl: float = 600.0
+
+
+class FrontendConfig(BaseModel):
+    # Compute the log-mel features while the audio is received, instead of for every transcription on the
+    # inference thread. Not used by inference_pool workers
+    enabled: bool = True
+    # Seconds of features kept, chunks waiting longer are computed from their samples. 0 sizes it from the backlog
+    ring_seconds: float = 0.0
+
+
+class InferencePoolConfig(BaseModel):
+    # Worker processes running the inference, each with its own copy of the model. 0 runs it in threads instead.
+    # Chunks only run in parallel up to scheduler.concurrency
+    workers: int = 0
+    # Seconds of audio the shared memory buffer of a worker holds, grown for longer chunks
+    buffer_seconds: float = 30.0
+    # Seconds between two health checks of the workers
+    health_check_interval: float = 5.0
+    # Seconds. A worker is restarted when a transcription takes longer, 0 means never
+    task_timeout: float = 120.0
+    # MiB. A worker is restarted once its resident memory grows beyond this, 0 means never
+    max_rss_mb: float = 0.0
+    # Seconds a worker may take to load its model
+    start_timeout: float = 300.0
+
+
+class CascadeConfig(BaseModel):
+    # Two-tier transcription, chunked mode only: draft_model transcribes every chunk and its danmaku are sent right
+    # away, model_name transcribes the same audio in the background and corrects the draft where they differ.
+    # model_name runs in the inference_pool workers if there are any, otherwise on a thread of its own
+    enabled: bool = False
+    draft_model: Literal["tiny", "base", "small", "medium", "large", "turbo"] = "tiny"
+    # Share of differing words / CJK characters (0 to 1) from which the draft is corrected
+    correction_threshold: float = 0.3
+    # Send corrections as danmaku, otherwise they are only written to the transcript journal
+    send_corrections: bool = True
+    # Format of the correction danmaku, same fields as danmaku_text_format
+    correction_text_format: str = "*{transcription_text}"
+    # Chunks waiting for model_name per room, the oldest are left uncorrected beyond this
+    max_pending: int = 4
+
+
+class ReloadConfig(BaseModel):
+    # Watch the config file and apply changes without restarting
+    enabled: bool = True
+    # Seconds between two checks of the file where inotify isn't available
+    poll_interval: float = 2.0
+    # Check periodically even where inotify is available, e.g. for network file systems
+    force_polling: bool = False
+
+
+class JournalConfig(BaseModel):
+    # Append every chunk (audio time range, text, stage timings, send status) to JSONL files in this folder.
+    # Export them with: python -m submaku_stream export
+    enabled: bool = False
+    path: str = "journal"
+    # Bytes. A new file is started once the current one is this large, 0 means never
+    max_bytes: int = 64 * 1024 * 1024
+    # Seconds after which a new file is started, 0 means never
+    rotate_interval: float = 86400.0
+    # Files kept, the oldest ones are deleted together with their audio. 0 keeps all of them
+    max_files: int = 0
+    # Seconds between two fsyncs, the records written meanwhile are synced together
+    fsync_interval: float = 1.0
+    # Keep the audio of every chunk as FLAC next to its journal file, e.g. to replay it in benchmarks.
+    # Chunked mode only
+    archive_audio: bool = False
+
+
+class RoomConfig(BaseModel):
+    room_id: int
+    # Overrides of the global settings for this room, null keeps the global ones
+    danmaku_text_format: Optional[str] = None
+    danmaku_display_mode: Optional[Literal["FLY", "TOP", "BOTTOM"]] = None
+    max_lag: Optional[float] = None
+    # Credential file used for this room, relative to the config folder. null uses credential.json
+    credential_path: Optional[str] = None
+    # Share of the transcriber this room gets while several rooms are waiting for it
+    weight: float = 1.0
+    text_handlers: Optional[list[TextHandlerConfig]] = None
+
+
 class Config(MyBaseModel):
     program_display_language: Literal["zh_CN", "en"]
     log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
     platform: str
     room_id: int
+    # Multi-room mode: every room gets its own ingest and sender, and all of them share one transcriber.
+    # Empty runs room_id only
+    rooms: list[RoomConfig] = []
     danmaku_display_mode: Literal["FLY", "TOP", "BOTTOM"]
     sending_delay: int
     segment_time_length: int
+    segmentation_mode: Literal["fixed", "vad"] = "fixed"
+    vad: VadConfig = VadConfig()
+    scheduler: SchedulerConfig = SchedulerConfig()
+    ingest: IngestConfig = IngestConfig()
+    # "chunked" transcribes every chunk once, "streaming" re-transcribes a sliding window (see streaming)
+    transcription_mode: Literal["chunked", "streaming"] = "chunked"
+    streaming: StreamingConfig = StreamingConfig()
     model_name: Literal["tiny", "base", "small", "medium", "large", "turbo"]
+    # "torch" runs the original model, "torch_int8" runs it with int8 Linear layers on CPU
+    inference_backend: Literal["torch", "torch_int8"] = "torch"
+    # torch CPU threads, 0 keeps the torch default
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    # Folder of the cached quantized models, defaults to ~/.cache/submaku_stream
+    model_cache_dir: Optional[str] = None
     whisper_params: dict
+    # Chunks transcribed at the same time are decoded as one batch of at most this many chunks.
+    # Only takes effect with scheduler.concurrency > 1
+    inference_batch_size: int = 1
+    # Max milliseconds a chunk waits for the batch to fill up
+    inference_batch_wait_ms: int = 200
+    # Run the inference in worker processes instead of threads, chunked mode only
+    inference_pool: InferencePoolConfig = InferencePoolConfig()
+    frontend: FrontendConfig = FrontendConfig()
+    cascade: CascadeConfig = CascadeConfig()
+    quality: QualityConfig = QualityConfig()
     danmaku_text_format: str
     max_order_num: int
     should_send_danmaku: bool
+    sender: SenderConfig = SenderConfig()
+    transport: TransportConfig = TransportConfig()
     max_retry_times: int
     max_chars_per_danmaku: int
     max_chars_per_audio_segment: int
+    repeat_filter: RepeatFilterConfig = RepeatFilterConfig()
+    # Handler chain every transcribed text goes through, in order, before it's formatted with danmaku_text_format.
+    # Built once, and rebuilt when it's changed
+    text_handlers: list[TextHandlerConfig] = [RepeatFilterHandlerConfig()]
+    metrics: MetricsConfig = MetricsConfig()
+    feed: FeedConfig = FeedConfig()
+    journal: JournalConfig = JournalConfig()
+    reload: ReloadConfig = ReloadConfig()
     debug: bool
 
 
@@ -1,43 +1,165 @@
 from __future__ import annotations
 
+import asyncio
+from pathlib import Path
+from typing import Optional, Type, TypeVar
+
 import loguru
 
 from submaku_stream.base.handler import Handler
+from submaku_stream.config_models import (Config, GlossaryHandlerConfig, RepeatFilterConfig,
+                                          RepeatFilterHandlerConfig, TextHandlerConfig)
+from submaku_stream.locales.i18n import gettext as _
 from submaku_stream.utils import text as text_tools
+from submaku_stream.utils.glossary import Glossary
+from submaku_stream.utils.metrics import current_trace
 from submaku_stream.utils.storage import ConfigStorage
 
 logger = loguru.logger
 
+T = TypeVar('T')
+
 
 class TextHandler(Handler):
     _next_handler: Handler = None
+    # Stage of the handler in the traces and metrics, defaults to the class name
+    name: Optional[str] = None
 
     def set_next(self, handler: TextHandler) -> TextHandler:
         self._next_handler = handler
         return handler
 
     async def handle(self, text: str) -> str:
+        # Subclasses call this once they are done, which adds their time to the chunk's trace
+        if trace := current_trace.get():
+            trace.handler_done(self.name or type(self).__name__)
         if self._next_handler:
             return await self._next_handler.handle(text)
         return text
 
 
 class TextPreprocessorHandler(TextHandler):
+    def __init__(self, params: Optional[RepeatFilterConfig] = None, name: Optional[str] = None):
+        """
+        :param params: Repeat filter parameters, defaults to config.repeat_filter when the text is handled
+        :param name: Stage name
+        """
+        super().__init__()
+        self.params = params
+        self.name = name
+
+    async def handle(self, text: str) -> str:
+        params = self.params or ConfigStorage.get_instance().config.repeat_filter
+        return await super().handle(text_tools.remove_redundant_repeats(text, params.min_repeats,
+                                                                        params.min_unit_chars,
+                                                                        params.max_unit_tokens))
+
+
+class GlossaryHandler(TextHandler):
+    """
+    Replaces and masks the entries of a glossary, reloading its files once they have changed
+    """
+
+    def __init__(self, params: GlossaryHandlerConfig, base_folder: Path):
+        """
+        :param params: Glossary handler config
+        :param base_folder: Folder the glossary files are relative to
+        """
+        super().__init__()
+        self.glossary = Glossary(params, base_folder)
+        self.name = params.name
+
     async def handle(self, text: str) -> str:
-        return await super().handle(text_tools.remove_redundant_repeats(text))
+        if self.glossary.stale():
+            try:
+                await asyncio.to_thread(self.glossary.load)
+            except (OSError, UnicodeDecodeError) as e:
+                if self.glossary.automaton is None:
+                    raise
+                logger.error(_("Failed to reload the glossary, keeping the current one: {}").format(repr(e)))
+        return await super().handle(self.glossary.apply(text))
 
 
 class TextFormatterHandler(TextHandler):
-    def __init__(self, total_chunks: int):
+    def __init__(self, total_chunks: int, text_format: str = None):
+        """
+        :param total_chunks: Index of the chunk
+        :param text_format: Defaults to config.danmaku_text_format
+        """
         super().__init__()
         self.total_chunks = total_chunks
+        self.text_format = text_format
 
-    async def handle(self, text: str) -> str:
+    def format(self, text: str) -> str:
         config = ConfigStorage.get_instance().config
-        formatted_text = config.danmaku_text_format.format(
+        return (self.text_format or config.danmaku_text_format).format(
             transcription_text=text,
             sent_danmaku_amount=self.total_chunks,
             danmaku_order_num=self.total_chunks % config.max_order_num
         )
+
+    async def handle(self, text: str) -> str:
+        formatted_text = self.format(text)
         logger.info(formatted_text)
         return await super().handle(formatted_text)
+
+
+def build_text_handlers(params: list[TextHandlerConfig], base_folder: Path,
+                        repeat_filter: Optional[RepeatFilterConfig] = None) -> Optional[TextHandler]:
+    """
+    Build a handler chain from its config
+    :param params: Handlers in order
+    :param base_folder: Folder the files of the handlers are relative to
+    :param repeat_filter: Parameters of the repeat filters
+    :return: First handler of the chain, None for an empty chain
+    """
+    handlers = []
+    for handler_params in params:
+        if isinstance(handler_params, RepeatFilterHandlerConfig):
+            handlers.append(TextPreprocessorHandler(repeat_filter, handler_params.name))
+        elif isinstance(handler_params, GlossaryHandlerConfig):
+            handlers.append(GlossaryHandler(handler_params, base_folder))
+    for handler, next_handler in zip(handlers, handlers[1:]):
+        handler.set_next(next_handler)
+    return handlers[0] if handlers else None
+
+
+class TextHandlerChain:
+    """
+    The handler chain of config.text_handlers, or of a room's override. Built once and rebuilt when the config of
+    the chain changes, so glossaries aren't compiled again for every chunk.
+    """
+    __instance = None
+
+    def __init__(self, params: Optional[list[TextHandlerConfig]] = None):
+        """
+        :param params: Fixed handler config, None follows config.text_handlers
+        """
+        storage = ConfigStorage.get_instance()
+        self._base_folder = storage.config_path.parent
+        self._params = params
+        self.head = self._build(storage.config)
+        storage.subscribe(self._on_config_change)
+
+    def _build(self, config: Config) -> Optional[TextHandler]:
+        return build_text_handlers(config.text_handlers if self._params is None else self._params,
+                                   self._base_folder, config.repeat_filter)
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not TextHandlerChain.__instance:
+            TextHandlerChain.__instance = TextHandlerChain()
+        return TextHandlerChain.__instance
+
+    def _on_config_change(self, old: Config, new: Config):
+        if new.repeat_filter != old.repeat_filter or (self._params is None and new.text_handlers != old.text_handlers):
+            # Glossaries whose files and entries haven't changed are taken from the cache
+            self.head = self._build(new)
+            logger.info(_("Text handlers rebuilt."))
+
+    async def handle(self, text: str) -> str:
+        if not self.head:
+            return text
+        if trace := current_trace.get():
+            trace.enter_handlers()
+        return await self.head.handle(text)
@@ -2,7 +2,6 @@ import gettext as gt
 from typing import Type, TypeVar
 
 from ..constants import LOCALE_PATH
-from ..utils.storage import ConfigStorage
 
 T = TypeVar('T')
 
@@ -12,7 +11,8 @@ class I18n:
 
     def __init__(self):
         self.__locale = "zh_CN"
-        self.__translation = gt.translation('messages', localedir=LOCALE_PATH, languages=[self.__locale])
+        # Catalogs are loaded on the first lookup, so importing a module doesn't touch the disk
+        self.__translation = None
 
     @classmethod
     def get_instance(cls: Type[T]) -> T:
@@ -22,12 +22,15 @@ class I18n:
 
     def set_locale(self, locale: str):
         self.__locale = locale
-        self.__translation = gt.translation('messages', localedir=LOCALE_PATH, languages=[self.__locale])
+        self.__translation = None
 
     def gettext(self, message: str) -> str:
+        if self.__translation is None:
+            # Without a compiled catalog, the messages are shown untranslated
+            self.__translation = gt.translation('messages', localedir=LOCALE_PATH, languages=[self.__locale],
+                                                fallback=True)
         return self.__translation.gettext(message)
 
 
-I18n.get_instance().set_locale(ConfigStorage.get_instance().config.program_display_language)
-
-gettext = I18n.get_instance().gettext
+def gettext(message: str) -> str:
+    return I18n.get_instance().gettext(message)
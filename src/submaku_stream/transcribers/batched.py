@@ -0,0 +1,207 @@
+"""
+Batched inference on top of the local whisper model
+"""
+import asyncio
+import time
+from typing import Union
+
+import loguru
+import numpy as np
+import torch
+import whisper
+from whisper.decoding import DecodingResult, DecodingTask
+from whisper.tokenizer import Tokenizer
+
+from .whispers import LocalWhisper, build_decoding_options
+from ..base.transcriber import SAMPLE_RATE, BaseTranscriber, TranscriptSegment
+from ..locales.i18n import gettext as _
+from ..utils.features import LogMelWindow
+from ..utils.quality import QualityController
+
+logger = loguru.logger
+
+
+class _BatchDecodingTask(DecodingTask):
+    """
+    whisper only expands the encoder output to every beam / best-of sample when the batch size is 1,
+    so batched beam search fails with a shape mismatch. Expand it here instead.
+    """
+
+    def _get_audio_features(self, mel: torch.Tensor) -> torch.Tensor:
+        return super()._get_audio_features(mel).repeat_interleave(self.n_group, dim=0)
+
+    def _detect_language(self, audio_features: torch.Tensor, tokens: torch.Tensor):
+        return super()._detect_language(audio_features[::self.n_group], tokens)
+
+
+class BatchedWhisper(BaseTranscriber):
+    """
+    Collects concurrently requested transcriptions and decodes them in one batch,
+    so the encoder forward pass and the decoding loop run once for several chunks.
+
+    Segments are cut at the timestamp tokens of the batched decode. Word timestamps aren't computed,
+    times within a segment are interpolated.
+    """
+    accepts_log_mel = True
+
+    def __init__(self, local_whisper: LocalWhisper, max_batch_size: int = 4, max_wait_ms: int = 200):
+        """
+        :param local_whisper: Loaded local whisper model
+        :param max_batch_size: A batch is decoded as soon as this many chunks are pending
+        :param max_wait_ms: Or when the oldest pending chunk has waited this long
+        """
+        self.local_whisper = local_whisper
+        self.model = local_whisper.model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        # Pending requests: (audio, translate, future of the segments, arrival timestamp)
+        self._pending: list[tuple[np.ndarray, bool, asyncio.Future, float]] = []
+        self._wakeup = asyncio.Event()
+        self._collector: asyncio.Task = None
+
+    async def transcribe(self, audio_segment: Union[np.ndarray, torch.Tensor], translate=False) -> str:
+        """
+        Transcribe audio segment as part of the next batch
+        :param audio_segment: numpy array or torch tensor
+        :param translate: Should translate to English?
+        :return: Transcribed or translated text
+        """
+        return "".join(s.text for s in await self.transcribe_segments(audio_segment, translate))
+
+    async def transcribe_segments(self, audio_segment: Union[np.ndarray, torch.Tensor],
+                                  translate=False) -> list[TranscriptSegment]:
+        """
+        Transcribe audio segment with timestamps as part of the next batch
+        :param audio_segment: numpy array or torch tensor
+        :param translate: Should translate to English?
+        :return: Segments of the chunk
+        """
+        if audio_segment.shape[-1] > whisper.audio.N_SAMPLES:
+            # A batch only holds one 30-second window per chunk
+            return await self.local_whisper.transcribe_segments(audio_segment, translate)
+        if not self._collector or self._collector.done():
+            self._collector = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((audio_segment, translate, future, time.time()))
+        self._wakeup.set()
+        return await future
+
+    async def _collect(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                deadline = self._pending[0][3] + self.max_wait
+                while len(self._pending) < self.max_batch_size and (timeout := deadline - time.time()) > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    self._wakeup.clear()
+                batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+                try:
+                    results = await asyncio.to_thread(self.transcribe_segments_batch,
+                                                      [b[0] for b in batch], [b[1] for b in batch])
+                except Exception as e:
+                    for *_rest, future, _t in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (*_rest, future, _t), segments in zip(batch, results):
+                    if not future.done():
+                        future.set_result(segments)
+
+    def transcribe_batch(self, audio_segments: list[Union[np.ndarray, torch.Tensor]],
+                         translate: list[bool] = None) -> list[str]:
+        """
+        Transcribe several audio segments (at most 30 seconds each) with one batched decoding pass
+        :param audio_segments: numpy arrays or torch tensors
+        :param translate: Should translate to English? One flag per segment
+        :return: Transcribed or translated texts
+        """
+        return ["".join(s.text for s in segments)
+                for segments in self.transcribe_segments_batch(audio_segments, translate)]
+
+    def transcribe_segments_batch(self, audio_segments: list[Union[np.ndarray, torch.Tensor]],
+                                  translate: list[bool] = None) -> list[list[TranscriptSegment]]:
+        """
+        Transcribe several audio segments (at most 30 seconds each) with timestamps, in one batched decoding pass
+        :param audio_segments: numpy arrays or torch tensors
+        :param translate: Should translate to English? One flag per segment
+        :return: Segments of every audio segment
+        """
+        translate = translate or [False] * len(audio_segments)
+        t0_perf = time.time()
+        mel = torch.stack([self._log_mel(a) for a in audio_segments]).to(self.model.device)
+        results: list[list[TranscriptSegment]] = [[] for _a in audio_segments]
+        # Chunks may ask for different tasks, decode each task group as one batch
+        for task in ("transcribe", "translate"):
+            idx = [i for i, t in enumerate(translate) if (task == "translate") == t]
+            if not idx:
+                continue
+            for i, segments in zip(idx, self._decode(mel[idx], audio_segments, idx, task)):
+                results[i] = segments
+        logger.debug(_("Batch of {} chunks decoded. {:.2f}ms").format(len(audio_segments),
+                                                                     (time.time() - t0_perf) * 1000))
+        return results
+
+    def _log_mel(self, audio_segment: Union[np.ndarray, torch.Tensor, LogMelWindow]) -> torch.Tensor:
+        """
+        Features of one 30-second window
+        """
+        audio_segment = self.local_whisper.features(audio_segment)
+        if isinstance(audio_segment, LogMelWindow):
+            return whisper.pad_or_trim(torch.from_numpy(audio_segment.mel), whisper.audio.N_FRAMES)
+        return whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.as_tensor(audio_segment)),
+                                          self.model.dims.n_mels)
+
+    def _decode(self, mel: torch.Tensor, audio_segments: list, idx: list[int],
+                task: str) -> list[list[TranscriptSegment]]:
+        params = self.local_whisper.effective_params
+        options = build_decoding_options(self.model, params, task=task, without_timestamps=False)
+        decoding_task = _BatchDecodingTask(self.model, options)
+        results = decoding_task.run(mel)
+
+        temperatures = params.get("temperature", 0.0)
+        has_fallback = isinstance(temperatures, (list, tuple)) and len(temperatures) > 1
+        compression_ratio_threshold = params.get("compression_ratio_threshold", 2.4)
+        logprob_threshold = params.get("logprob_threshold", -1.0)
+        no_speech_threshold = params.get("no_speech_threshold", 0.6)
+        segments = []
+        for i, res in zip(idx, results):
+            QualityController.get_instance().observe_language(res.language)
+            low_logprob = logprob_threshold is not None and res.avg_logprob < logprob_threshold
+            if no_speech_threshold is not None and res.no_speech_prob > no_speech_threshold and low_logprob:
+                # Silence, same as whisper.transcribe() skipping the window
+                segments.append([])
+            elif has_fallback and (low_logprob or (compression_ratio_threshold is not None
+                                                   and res.compression_ratio > compression_ratio_threshold)):
+                # Rare case: decode this chunk again with the full temperature fallback
+                segments.append(self.local_whisper.transcribe_segments_sync(audio_segments[i], task == "translate"))
+            else:
+                segments.append(self._segments(res, decoding_task.tokenizer,
+                                               audio_segments[i].shape[-1] / SAMPLE_RATE))
+        return segments
+
+    @staticmethod
+    def _segments(res: DecodingResult, tokenizer: Tokenizer, duration: float) -> list[TranscriptSegment]:
+        """
+        Cut a decoded window into segments at its timestamp tokens, the way whisper.transcribe() does:
+        a timestamp after text ends a segment, one at the start or after another timestamp starts the next
+        :param duration: Seconds of audio in the window, the last segment ends there if it isn't closed
+        """
+        seconds_per_token = whisper.audio.N_SAMPLES_PER_TOKEN / SAMPLE_RATE
+        segments = []
+        start, text_tokens = 0.0, []
+        for token in res.tokens:
+            if token < tokenizer.timestamp_begin:
+                text_tokens.append(token)
+                continue
+            t = min((token - tokenizer.timestamp_begin) * seconds_per_token, duration)
+            if text_tokens:
+                segments.append(TranscriptSegment(start, max(start, t), tokenizer.decode(text_tokens)))
+                text_tokens = []
+            start = t
+        if text_tokens:
+            segments.append(TranscriptSegment(start, max(start, duration), tokenizer.decode(text_tokens)))
+        return [s for s in segments if s.text.strip()]
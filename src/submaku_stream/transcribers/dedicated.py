@@ -0,0 +1,45 @@
+"""
+A local transcriber running on a thread of its own
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+import numpy as np
+import torch
+
+from .whispers import LocalWhisper
+from ..base.transcriber import BaseTranscriber, TranscriptSegment
+
+
+class DedicatedThreadWhisper(BaseTranscriber):
+    """
+    Runs the transcriptions of a local whisper model one after another on its own thread instead of the event
+    loop's default executor, so a slow model doesn't hold up the threads other transcribers and to_thread() use.
+    """
+
+    def __init__(self, local_whisper: LocalWhisper, name: str = "dedicated-whisper"):
+        """
+        :param local_whisper: Loaded local whisper model
+        :param name: Prefix of the thread name
+        """
+        self.local_whisper = local_whisper
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def __getattr__(self, name: str):
+        return getattr(self.__dict__["local_whisper"], name)
+
+    async def transcribe(self, audio_segment: Union[np.ndarray, torch.Tensor], translate=False) -> str:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.local_whisper.transcribe_sync, audio_segment, translate)
+
+    async def transcribe_segments(self, audio_segment: Union[np.ndarray, torch.Tensor],
+                                  translate=False) -> list[TranscriptSegment]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.local_whisper.transcribe_segments_sync, audio_segment, translate)
+
+    def close(self):
+        """
+        Wait for the running transcription and stop the thread
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,20 @@
+"""
+Create the local transcription backend selected in the config
+"""
+from .whispers import LocalWhisper, configure_threads
+from ..config_models import Config
+
+
+def load_local_whisper(config: Config, model_name: str = None) -> LocalWhisper:
+    """
+    Load a local whisper model with the configured inference backend
+    :param config: Program config
+    :param model_name: Model types, defaults to config.model_name
+    :return: Loaded transcriber
+    """
+    model_name = model_name or config.model_name
+    configure_threads(config.intra_op_threads, config.inter_op_threads)
+    if config.inference_backend == "torch_int8":
+        from .quantized import QuantizedWhisper
+        return QuantizedWhisper(model_name, config.model_cache_dir)
+    return LocalWhisper(model_name)
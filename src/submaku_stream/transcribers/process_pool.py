@@ -0,0 +1,396 @@
+"""
+Inference in worker processes, each holding its own copy of the model.
+Audio is handed over through shared memory, the results come back through a pipe.
+"""
+import asyncio
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Union
+
+import loguru
+import numpy as np
+
+from ..base.transcriber import SAMPLE_RATE, BaseTranscriber, TranscriptSegment
+from ..config_models import Config, InferencePoolConfig
+from ..locales.i18n import gettext as _
+from ..utils.quality import QualityController
+from ..utils.storage import ConfigStorage
+
+if TYPE_CHECKING:
+    import torch
+
+logger = loguru.logger
+
+# torch and CUDA don't survive a fork
+_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _rss_mb() -> float:
+    """
+    Resident memory of the current process in MiB
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+        except ImportError:
+            return 0.0
+        # Peak instead of current, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _worker_main(conn: Connection, config_json: str, config_path: Path, credential_path: Path):
+    """
+    Entry point of a worker process: load the model once, then transcribe the audio found in shared memory
+    until asked to stop.
+
+    Messages received: ("transcribe", request id, shared memory name, samples, translate, quality tier),
+    ("config", config json), ("ping",), ("stop",)
+    Messages sent: ("ready", pid, rss), ("result", request id, segments, rss), ("error", request id, error, rss),
+    ("pong", rss)
+    """
+    from .factory import load_local_whisper
+
+    storage = ConfigStorage.load(config_path, credential_path)
+    # The config of the main process, including changes not saved to the file
+    storage.config = Config.model_validate_json(config_json)
+    model = load_local_whisper(storage.config)
+    model.transcribe_sync(np.zeros(SAMPLE_RATE, dtype=np.float32))
+    conn.send(("ready", os.getpid(), _rss_mb()))
+
+    shm: Optional[SharedMemory] = None
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == "stop":
+                break
+            if message[0] == "ping":
+                conn.send(("pong", _rss_mb()))
+                continue
+            if message[0] == "config":
+                storage.publish(Config.model_validate_json(message[1]))
+                continue
+            _kind, request_id, shm_name, samples, translate, tier = message
+            # The tier is chosen by the main process, the detected language is cached per worker
+            QualityController.get_instance().set_tier(tier)
+            if shm is None or shm.name != shm_name:
+                # The buffer was reallocated for a longer chunk
+                if shm:
+                    shm.close()
+                shm = SharedMemory(shm_name)
+            # Copied out, so no view of the buffer outlives the request
+            audio = np.frombuffer(shm.buf, dtype=np.float32, count=samples).copy()
+            try:
+                segments = model.transcribe_segments_sync(audio, translate)
+            except Exception as e:
+                conn.send(("error", request_id, repr(e), _rss_mb()))
+                continue
+            conn.send(("result", request_id, segments, _rss_mb()))
+    finally:
+        if shm:
+            shm.close()
+
+
+class _Worker:
+    """
+    A worker slot. The process is replaced on restarts, the shared memory buffer is kept.
+    """
+
+    def __init__(self, index: int, buffer_samples: int):
+        self.index = index
+        self.shm = SharedMemory(create=True, size=buffer_samples * 4)
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+        self.alive = False
+        # Restart the worker once it's idle
+        self.retiring = False
+        self.rss = 0.0
+        self.request_id = 0
+        self.future: Optional[asyncio.Future] = None
+        self.busy_since: Optional[float] = None
+
+    def ensure_capacity(self, samples: int):
+        if samples * 4 > self.shm.size:
+            old = self.shm
+            self.shm = SharedMemory(create=True, size=samples * 4)
+            old.close()
+            old.unlink()
+
+
+class ProcessPoolWhisper(BaseTranscriber):
+    """
+    Transcribes on a pool of worker processes, so the decoding doesn't compete for the GIL with the event loop
+    and several chunks are decoded in parallel. Each worker transcribes one chunk at a time.
+
+    Workers which crash, hang longer than task_timeout or grow beyond max_rss_mb are restarted,
+    the chunk they were transcribing fails with a RuntimeError.
+    """
+
+    def __init__(self, config: Config, config_path: Path, credential_path: Path):
+        """
+        Start the workers and wait until all of them have loaded the model. Blocking.
+        :param config: Program config, passed on to the workers
+        :param config_path: Config file, the workers load it as the main process did
+        :param credential_path: Credential file
+        """
+        self.params: InferencePoolConfig = config.inference_pool
+        self._config_json = config.model_dump_json()
+        self._paths = (config_path, credential_path)
+        buffer_samples = int(self.params.buffer_seconds * SAMPLE_RATE)
+        self._workers = [_Worker(i, buffer_samples) for i in range(max(1, self.params.workers))]
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: Optional[asyncio.Queue[_Worker]] = None
+        self._health_task: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to tasks
+        self._respawn_tasks: set[asyncio.Task] = set()
+        self._request_id = 0
+        self._closed = False
+        self.restarts = 0
+        atexit.register(self.close)
+        ConfigStorage.get_instance().subscribe(self._on_config_change)
+        # Load the models in parallel
+        for worker in self._workers:
+            self._spawn(worker)
+        for worker in self._workers:
+            self._wait_ready(worker)
+
+    @property
+    def workers(self) -> int:
+        return len(self._workers)
+
+    @property
+    def alive_workers(self) -> int:
+        return sum(w.alive for w in self._workers)
+
+    def _on_config_change(self, _old: Config, new: Config):
+        # Restarted workers start with the current config as well
+        self._config_json = new.model_dump_json()
+        for worker in self._workers:
+            if worker.alive:
+                try:
+                    worker.conn.send(("config", self._config_json))
+                except OSError:
+                    pass
+
+    def _spawn(self, worker: _Worker):
+        parent_conn, child_conn = _CONTEXT.Pipe()
+        worker.process = _CONTEXT.Process(target=_worker_main, name=f"inference-worker-{worker.index}", daemon=True,
+                                          args=(child_conn, self._config_json, *self._paths))
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.retiring = False
+
+    def _wait_ready(self, worker: _Worker):
+        try:
+            if not worker.conn.poll(self.params.start_timeout):
+                raise RuntimeError(_("Inference worker {} didn't start in time").format(worker.index))
+            _kind, pid, worker.rss = worker.conn.recv()
+        except (EOFError, OSError):
+            raise RuntimeError(_("Inference worker {} failed to start, exit code {}").format(
+                worker.index, worker.process.exitcode))
+        worker.alive = True
+        logger.success(_("Inference worker {} started, pid {}, {:.0f}MiB").format(worker.index, pid, worker.rss))
+
+    def _bind(self):
+        """
+        Attach to the running event loop on first use
+        """
+        if self._loop:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._idle = asyncio.Queue()
+        for worker in self._workers:
+            self._start_reader(worker)
+            self._idle.put_nowait(worker)
+        self._health_task = asyncio.create_task(self._health_check())
+
+    def _start_reader(self, worker: _Worker):
+        # A thread per worker instead of loop.add_reader, which the Windows event loop lacks for pipes
+        threading.Thread(target=self._read, args=(worker, worker.conn), daemon=True,
+                         name=f"inference-reader-{worker.index}").start()
+
+    def _read(self, worker: _Worker, conn: Connection):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+            try:
+                if message is None:
+                    self._loop.call_soon_threadsafe(self._lost, worker, conn)
+                    return
+                self._loop.call_soon_threadsafe(self._on_message, worker, message)
+            except RuntimeError:
+                # The event loop has been closed, the program is exiting
+                return
+
+    def _on_message(self, worker: _Worker, message: tuple):
+        worker.rss = message[-1]
+        if self.params.max_rss_mb and worker.rss > self.params.max_rss_mb and not worker.retiring:
+            logger.warning(_("Inference worker {} uses {:.0f}MiB, restarting it").format(worker.index, worker.rss))
+            worker.retiring = True
+        if message[0] not in ("result", "error"):
+            return
+        future = worker.future
+        if future is None or future.done() or message[1] != worker.request_id:
+            return
+        if message[0] == "result":
+            future.set_result(message[2])
+        else:
+            future.set_exception(RuntimeError(message[2]))
+
+    def _lost(self, worker: _Worker, conn: Connection):
+        if conn is not worker.conn or not worker.alive or self._closed:
+            # A process which is being replaced
+            return
+        worker.alive = False
+        logger.error(_("Inference worker {} exited, exit code {}").format(worker.index, worker.process.exitcode))
+        if worker.future and not worker.future.done():
+            worker.future.set_exception(RuntimeError(_("Inference worker {} exited").format(worker.index)))
+        self._check_idle()
+
+    def _check_idle(self):
+        """
+        Restart the idle workers which are dead or retiring
+        """
+        for _i in range(self._idle.qsize()):
+            worker = self._idle.get_nowait()
+            if worker.alive and not worker.retiring:
+                self._idle.put_nowait(worker)
+            else:
+                self._restart(worker)
+
+    def _restart(self, worker: _Worker):
+        worker.alive = False
+        task = asyncio.create_task(self._respawn(worker))
+        self._respawn_tasks.add(task)
+        task.add_done_callback(self._respawn_tasks.discard)
+
+    async def _respawn(self, worker: _Worker):
+        self.restarts += 1
+        old_process, old_conn = worker.process, worker.conn
+        delay = 1.0
+        while not self._closed:
+            try:
+                await asyncio.to_thread(self._replace, worker, old_process, old_conn)
+                break
+            except RuntimeError as e:
+                logger.error(repr(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+        else:
+            return
+        self._start_reader(worker)
+        self._idle.put_nowait(worker)
+
+    def _replace(self, worker: _Worker, old_process: multiprocessing.Process, old_conn: Connection):
+        if old_process and old_process.is_alive():
+            try:
+                old_conn.send(("stop",))
+            except OSError:
+                pass
+            old_process.join(5)
+            if old_process.is_alive():
+                old_process.kill()
+                old_process.join()
+        old_conn.close()
+        self._spawn(worker)
+        self._wait_ready(worker)
+
+    async def _health_check(self):
+        while not self._closed:
+            await asyncio.sleep(self.params.health_check_interval)
+            now = time.time()
+            for worker in self._workers:
+                if not worker.alive:
+                    continue
+                if worker.busy_since and self.params.task_timeout and now - worker.busy_since > self.params.task_timeout:
+                    logger.error(_("Inference worker {} is stuck, killing it").format(worker.index))
+                    # The reader sees the pipe closing and fails the request
+                    worker.process.kill()
+                    continue
+                try:
+                    worker.conn.send(("ping",))
+                except OSError:
+                    pass
+            self._check_idle()
+
+    async def transcribe_segments(self, audio_segment: Union[np.ndarray, "torch.Tensor"],
+                                  translate=False) -> list[TranscriptSegment]:
+        """
+        Transcribe audio segment on the next idle worker
+        :param audio_segment: numpy array or torch tensor
+        :param translate: Should translate to English?
+        :return: Segments with timestamps relative to the start of the audio
+        """
+        self._bind()
+        audio = np.asarray(audio_segment, dtype=np.float32).reshape(-1)
+        while True:
+            worker = await self._idle.get()
+            if worker.alive and not worker.retiring:
+                break
+            self._restart(worker)
+        try:
+            worker.ensure_capacity(audio.size)
+            np.ndarray(audio.shape, dtype=np.float32, buffer=worker.shm.buf)[:] = audio
+            self._request_id += 1
+            worker.request_id = self._request_id
+            worker.future = self._loop.create_future()
+            worker.busy_since = time.time()
+            worker.conn.send(("transcribe", worker.request_id, worker.shm.name, audio.size, translate,
+                              QualityController.get_instance().tier))
+            return await worker.future
+        except OSError as e:
+            raise RuntimeError(repr(e))
+        finally:
+            worker.future = None
+            worker.busy_since = None
+            if worker.alive and not worker.retiring:
+                self._idle.put_nowait(worker)
+            elif not self._closed:
+                self._restart(worker)
+
+    async def transcribe(self, audio_segment: Union[np.ndarray, "torch.Tensor"], translate=False) -> str:
+        """
+        Transcribe audio segment on the next idle worker
+        :param audio_segment: numpy array or torch tensor
+        :param translate: Should translate to English?
+        :return: Transcribed or translated text
+        """
+        return "".join(s.text for s in await self.transcribe_segments(audio_segment, translate))
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory
+        """
+        if self._closed:
+            return
+        self._closed = True
+        ConfigStorage.get_instance().unsubscribe(self._on_config_change)
+        if self._health_task:
+            self._health_task.cancel()
+        for worker in self._workers:
+            try:
+                worker.conn.send(("stop",))
+            except (OSError, AttributeError):
+                pass
+        for worker in self._workers:
+            if worker.process:
+                worker.process.join(5)
+                if worker.process.is_alive():
+                    worker.process.kill()
+            worker.alive = False
+            worker.shm.close()
+            worker.shm.unlink()
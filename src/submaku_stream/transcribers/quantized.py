@@ -0,0 +1,69 @@
+"""
+OpenAI whisper with int8 dynamic quantization, for CPU-only machines
+"""
+import os
+from pathlib import Path
+from typing import Literal, Optional
+
+import loguru
+import torch
+import whisper
+from torch import nn
+
+from .whispers import LocalWhisper
+from ..locales.i18n import gettext as _
+
+logger = loguru.logger
+
+DEFAULT_CACHE_DIR = Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "submaku_stream"
+
+
+def quantize_whisper(model: whisper.Whisper) -> whisper.Whisper:
+    """
+    Quantize the Linear layers of a whisper model to int8 (dynamic quantization)
+    :param model: fp32 model on CPU
+    :return: Quantized model
+    """
+    for module in model.modules():
+        # whisper's Linear only adds a dtype cast to nn.Linear, which torch's quantization doesn't recognize
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = nn.Linear
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+class QuantizedWhisper(LocalWhisper):
+    def __init__(self, model_name: Literal["tiny", "base", "small", "medium", "large", "turbo"] = "base",
+                 cache_dir: Optional[Path] = None):
+        """
+        Whisper on local CPU with int8 Linear layers.
+        The quantized model is cached on disk, so later starts skip the quantization.
+        :param model_name: Model types
+        :param cache_dir: Folder of the quantized models, defaults to ~/.cache/submaku_stream
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+        super().__init__(model_name)
+
+    @property
+    def cache_path(self) -> Path:
+        # Pickled quantized modules are tied to the torch version
+        return self.cache_dir / f"whisper-{self.model_name}-int8-torch{torch.__version__}.pt"
+
+    def _load_model(self) -> whisper.Whisper:
+        if self.cache_path.exists():
+            try:
+                model = torch.load(self.cache_path, map_location="cpu", weights_only=False)
+                logger.info(_("Quantized model loaded from {}").format(self.cache_path))
+                return model.eval()
+            except Exception as e:
+                logger.warning(_("Failed to load the cached quantized model, quantizing again: {}").format(repr(e)))
+
+        model = quantize_whisper(whisper.load_model(self.model_name, device="cpu")).eval()
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_suffix(".tmp")
+            torch.save(model, tmp_path)
+            os.replace(tmp_path, self.cache_path)
+            logger.info(_("Quantized model cached to {}").format(self.cache_path))
+        except OSError as e:
+            logger.warning(repr(e))
+        return model
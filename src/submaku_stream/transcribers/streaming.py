@@ -0,0 +1,219 @@
+"""
+Sliding-window streaming transcription with local agreement
+"""
+import asyncio
+import time
+from typing import Optional, Union
+
+import loguru
+import numpy as np
+
+from .whispers import LocalWhisper
+from ..base.transcriber import BaseTranscriber, TranscriptWord
+from ..config_models import StreamingConfig
+from ..locales.i18n import gettext as _
+from ..utils.features import HOP_LENGTH, LogMelFrontend, LogMelWindow
+from ..utils.quality import QualityController
+
+logger = loguru.logger
+
+SAMPLE_RATE = 16000
+
+
+class Word(TranscriptWord):
+    # start / end: seconds since the stream started
+
+    @property
+    def key(self) -> str:
+        return self.text.strip().lower()
+
+
+class HypothesisBuffer:
+    """
+    Keeps the not yet committed tail of the transcription,
+    and commits the words that two consecutive hypotheses agree on (local agreement).
+    """
+
+    # Longest n-gram at the start of a new hypothesis compared with the committed tail
+    MAX_OVERLAP_NGRAM = 5
+
+    def __init__(self):
+        self.committed: list[Word] = []
+        self.last_committed_time = 0.0
+        self._previous: list[Word] = []
+        self._new: list[Word] = []
+
+    def insert(self, words: list[Word]):
+        """
+        Insert a new hypothesis. Words that have been committed already are skipped.
+        """
+        # Small tolerance, whisper timestamps of the same word jitter between windows
+        new = [w for w in words if w.start > self.last_committed_time - 0.1]
+        if new and self.committed and abs(new[0].start - self.last_committed_time) < 1:
+            # The window still contains committed words, drop the n-gram that repeats the committed tail
+            for n in range(min(len(self.committed), len(new), self.MAX_OVERLAP_NGRAM), 0, -1):
+                if [w.key for w in self.committed[-n:]] == [w.key for w in new[:n]]:
+                    new = new[n:]
+                    break
+        self._new = new
+
+    def flush(self) -> list[Word]:
+        """
+        Commit the longest common prefix of the current and the previous hypothesis
+        :return: Newly committed words
+        """
+        committed = []
+        for new, prev in zip(self._new, self._previous):
+            if new.key != prev.key:
+                break
+            committed.append(new)
+        if committed:
+            self.last_committed_time = committed[-1].end
+            self.committed.extend(committed)
+        self._previous = self._new[len(committed):]
+        self._new = []
+        return committed
+
+    def force_commit(self) -> list[Word]:
+        """
+        Commit the pending hypothesis without waiting for an agreement
+        """
+        committed, self._previous = self._previous, []
+        if committed:
+            self.last_committed_time = committed[-1].end
+            self.committed.extend(committed)
+        return committed
+
+    def pop_committed_before(self, t: float):
+        self.committed = [w for w in self.committed if w.end > t]
+
+
+class StreamingWhisper(BaseTranscriber):
+    """
+    Keeps a rolling audio buffer which is re-transcribed every hop,
+    and only emits words confirmed by two consecutive transcriptions.
+    """
+
+    def __init__(self, local_whisper: LocalWhisper, params: StreamingConfig, frontend: Optional[LogMelFrontend] = None):
+        """
+        :param local_whisper: Loaded local whisper model
+        :param params: Window parameters
+        :param frontend: Frontend fed with the same audio, the window's features are taken from it
+        """
+        self.local_whisper = local_whisper
+        self.params = params
+        self.frontend = frontend
+        self._audio = np.empty(0, dtype=np.float32)
+        # Stream time (seconds) of the first sample in the audio buffer
+        self._buffer_offset = 0.0
+        self._hypothesis = HypothesisBuffer()
+        # Text committed before the current buffer, used as the prompt of the next window
+        self._context = ""
+        self._new_audio = asyncio.Event()
+        # (stream time, wall clock time) of the end of the latest audio, to map stream time to wall clock time
+        self._clock: Optional[tuple[float, float]] = None
+        # Words committed by the latest process_iter(), and finish()
+        self.last_committed: list[Word] = []
+        # Set once no more audio follows
+        self.closed = False
+
+    @property
+    def buffer_duration(self) -> float:
+        return self._audio.size / SAMPLE_RATE
+
+    def insert_audio(self, audio_chunk: np.ndarray, captured_at: Optional[float] = None):
+        """
+        :param audio_chunk: float32 samples following the previously inserted ones
+        :param captured_at: Wall clock time the chunk was received
+        """
+        self._audio = np.concatenate((self._audio, audio_chunk))
+        self._clock = (self._buffer_offset + self.buffer_duration, captured_at or time.time())
+        self._new_audio.set()
+
+    def wall_time(self, t: float) -> float:
+        """
+        Wall clock time the audio at stream time t was received
+        """
+        if self._clock is None:
+            return time.time()
+        stream_time, wall = self._clock
+        return wall - (stream_time - t)
+
+    def close(self):
+        """
+        No more audio follows, wakes up wait_for_audio() for the last window
+        """
+        self.closed = True
+        self._new_audio.set()
+
+    async def wait_for_audio(self):
+        """
+        Wait until new audio has been inserted since the last call, or the transcriber is closed
+        """
+        await self._new_audio.wait()
+        self._new_audio.clear()
+
+    async def transcribe(self, audio_segment: np.ndarray, translate=False) -> str:
+        """
+        Insert audio segment and process the window
+        :return: Newly committed text
+        """
+        self.insert_audio(audio_segment)
+        return await self.process_iter(translate)
+
+    async def process_iter(self, translate=False) -> str:
+        """
+        Transcribe the current window and commit the agreed words
+        :return: Newly committed text
+        """
+        self.last_committed = []
+        if not self._audio.size:
+            return ""
+        audio, offset = self._audio, self._buffer_offset
+        window = self.frontend.window(round(offset * SAMPLE_RATE), audio.size, audio) if self.frontend else None
+        words = await asyncio.to_thread(self._transcribe_words, window or audio, offset, translate)
+        self._hypothesis.insert(words)
+        committed = self._hypothesis.flush()
+        if self.buffer_duration > self.params.max_window_length:
+            # Nothing agreed for too long, the window must not outgrow whisper's 30-second context
+            logger.warning(_("Streaming window exceeds {}s, committing the pending hypothesis.")
+                           .format(self.params.max_window_length))
+            committed += self._hypothesis.force_commit()
+            self._trim(self._hypothesis.last_committed_time if committed else offset + audio.size / SAMPLE_RATE)
+        elif self.buffer_duration > self.params.trim_length and self._hypothesis.last_committed_time > offset:
+            self._trim(self._hypothesis.last_committed_time)
+        self.last_committed = committed
+        return "".join(w.text for w in committed)
+
+    def finish(self) -> str:
+        """
+        Flush the uncommitted words, e.g. when the stream ends. They are appended to last_committed
+        """
+        words = self._hypothesis.force_commit()
+        self.last_committed = self.last_committed + words
+        return "".join(w.text for w in words)
+
+    def _transcribe_words(self, audio: Union[np.ndarray, LogMelWindow], offset: float, translate: bool) -> list[Word]:
+        params = {**self.local_whisper.effective_params,
+                  "task": "translate" if translate else "transcribe",
+                  "word_timestamps": True,
+                  "condition_on_previous_text": False,
+                  "initial_prompt": self._context[-self.params.prompt_chars:] or None}
+        res = self.local_whisper.run_transcribe(audio, **params)
+        QualityController.get_instance().observe_language(res.get("language"))
+        return [Word(offset + w["start"], offset + w["end"], w["word"])
+                for segment in res["segments"] for w in segment.get("words", [])]
+
+    def _trim(self, t: float):
+        """
+        Drop the audio before stream time t
+        """
+        # On a frame boundary, so the window stays aligned with the frontend's frames
+        cut = int((t - self._buffer_offset) * SAMPLE_RATE) // HOP_LENGTH * HOP_LENGTH
+        if cut <= 0:
+            return
+        self._audio = self._audio[cut:]
+        self._buffer_offset += cut / SAMPLE_RATE
+        self._context += "".join(w.text for w in self._hypothesis.committed if w.end <= self._buffer_offset)
+        self._context = self._context[-self.params.prompt_chars:]
+        self._hypothesis.pop_committed_before(self._buffer_offset)
@@ -0,0 +1,62 @@
+"""
+A transcriber which can be replaced while the program runs
+"""
+import asyncio
+from collections import Counter
+from typing import TYPE_CHECKING, Union
+
+import numpy as np
+
+from ..base.transcriber import BaseTranscriber, TranscriptSegment
+
+if TYPE_CHECKING:
+    import torch
+
+
+class SwappableTranscriber(BaseTranscriber):
+    """
+    Delegates to the current transcriber, e.g. to load a new model in the background and switch to it
+    once it's ready. Transcriptions already running finish on the transcriber they started on.
+    """
+
+    def __init__(self, transcriber: BaseTranscriber):
+        self.transcriber = transcriber
+        # Running transcriptions per transcriber
+        self._in_flight: Counter = Counter()
+
+    def __getattr__(self, name: str):
+        # Other attributes, e.g. model and effective_params used by the streaming transcriber
+        return getattr(self.__dict__["transcriber"], name)
+
+    def swap(self, transcriber: BaseTranscriber) -> BaseTranscriber:
+        """
+        :return: The previous transcriber
+        """
+        old, self.transcriber = self.transcriber, transcriber
+        return old
+
+    async def retire(self, transcriber: BaseTranscriber):
+        """
+        Close a swapped-out transcriber once its running transcriptions are done
+        """
+        while self._in_flight[transcriber]:
+            await asyncio.sleep(0.1)
+        if close := getattr(transcriber, "close", None):
+            await asyncio.to_thread(close)
+
+    async def transcribe(self, audio_segment: Union[np.ndarray, "torch.Tensor"], translate=False) -> str:
+        transcriber = self.transcriber
+        self._in_flight[transcriber] += 1
+        try:
+            return await transcriber.transcribe(audio_segment, translate)
+        finally:
+            self._in_flight[transcriber] -= 1
+
+    async def transcribe_segments(self, audio_segment: Union[np.ndarray, "torch.Tensor"],
+                                  translate=False) -> list[TranscriptSegment]:
+        transcriber = self.transcriber
+        self._in_flight[transcriber] += 1
+        try:
+            return await transcriber.transcribe_segments(audio_segment, translate)
+        finally:
+            self._in_flight[transcriber] -= 1
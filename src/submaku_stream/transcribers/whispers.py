@@ -1,33 +1,202 @@
 """
 OpenAI whisper
 """
+import asyncio
+import contextlib
+import dataclasses
+import sys
+import threading
 from typing import Literal, Union
 
 import numpy as np
 import torch
 import whisper
+from whisper.decoding import DecodingOptions
 
-from ..base.transcriber import BaseTranscriber
+from ..base.transcriber import BaseTranscriber, TranscriptSegment, TranscriptWord
+from ..utils.features import LogMelWindow
+from ..utils.quality import QualityController
 from ..utils.storage import ConfigStorage
 
+_DECODING_OPTION_FIELDS = {f.name for f in dataclasses.fields(DecodingOptions)}
+
+# whisper.transcribe() computes the features with the log_mel_spectrogram() of its module,
+# the function of the same name shadows the module as an attribute of the package
+_transcribe_module = sys.modules.get("whisper.transcribe")
+_log_mel_spectrogram = getattr(_transcribe_module, "log_mel_spectrogram", None)
+# Transcriptions of a LogMelWindow in progress, the module function is replaced while there are any
+_precomputed_users = 0
+_precomputed_lock = threading.Lock()
+
+
+def _precomputed_log_mel_spectrogram(audio, n_mels: int = 80, padding: int = 0, device=None) -> torch.Tensor:
+    """
+    Take a LogMelWindow in place of the samples, compute the features of anything else
+    """
+    if isinstance(audio, LogMelWindow):
+        # Normalized and padded with 30 seconds of silence already, like padding=N_SAMPLES
+        return torch.from_numpy(audio.mel)
+    return _log_mel_spectrogram(audio, n_mels, padding, device)
+
+
+@contextlib.contextmanager
+def _precomputed_features():
+    """
+    Let whisper.transcribe() take a LogMelWindow within the block. Other threads transcribing samples meanwhile
+    still get their features computed, and the original function is restored once the last block exits.
+    """
+    global _precomputed_users
+    with _precomputed_lock:
+        if _precomputed_users == 0:
+            _transcribe_module.log_mel_spectrogram = _precomputed_log_mel_spectrogram
+        _precomputed_users += 1
+    try:
+        yield
+    finally:
+        with _precomputed_lock:
+            _precomputed_users -= 1
+            if _precomputed_users == 0:
+                _transcribe_module.log_mel_spectrogram = _log_mel_spectrogram
+
+
+def configure_threads(intra_op_threads: int = 0, inter_op_threads: int = 0):
+    """
+    Set the number of threads torch uses on CPU, 0 keeps the torch default
+    :param intra_op_threads: Threads used inside one operator, e.g. a matrix multiplication
+    :param inter_op_threads: Threads used to run independent operators in parallel
+    """
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work has started
+            pass
+
+
+def build_decoding_options(model: whisper.Whisper, params: dict, temperature: float = None,
+                           **overrides) -> DecodingOptions:
+    """
+    Convert whisper.transcribe() style parameters into DecodingOptions for a single decoding pass
+    :param model: Model the options are used with
+    :param params: whisper.transcribe() keyword arguments, e.g. config.whisper_params
+    :param temperature: Sampling temperature, defaults to the first temperature in params
+    :param overrides: DecodingOptions fields that take precedence over params
+    :return: Decoding options
+    """
+    kwargs = {k: v for k, v in params.items() if k in _DECODING_OPTION_FIELDS}
+    if params.get("initial_prompt") and "prompt" not in kwargs:
+        kwargs["prompt"] = params["initial_prompt"]
+    kwargs.update(overrides)
+    if temperature is None:
+        temperature = kwargs.get("temperature", 0.0)
+        if isinstance(temperature, (list, tuple)):
+            temperature = temperature[0]
+    kwargs["temperature"] = float(temperature)
+    # Same rules as whisper.transcribe(): beam search for greedy decoding, best-of-N for sampling
+    if kwargs["temperature"] > 0:
+        kwargs.pop("beam_size", None)
+        kwargs.pop("patience", None)
+    else:
+        kwargs.pop("best_of", None)
+    if model.device == torch.device("cpu"):
+        kwargs["fp16"] = False
+    return DecodingOptions(**kwargs)
+
 
 class LocalWhisper(BaseTranscriber):
+    # Transcribes a LogMelWindow of precomputed features as well as samples
+    accepts_log_mel = True
+
     def __init__(self, model_name: Literal["tiny", "base", "small", "medium", "large", "turbo"] = "base"):
         """
         Whisper on local machine
         :param model_name: Model types
         """
         self.model_name = model_name
-        self.model = whisper.load_model(model_name)
-        self.params = ConfigStorage.get_instance().config.whisper_params
+        self.model = self._load_model()
+
+    def _load_model(self) -> whisper.Whisper:
+        return whisper.load_model(self.model_name)
+
+    @property
+    def params(self) -> dict:
+        # Read on every transcription, so edits of whisper_params apply to the next chunk
+        return ConfigStorage.get_instance().config.whisper_params
+
+    @property
+    def effective_params(self) -> dict:
+        """
+        whisper_params with the overrides of the current quality tier, adjusted to the device:
+        fp16 is not supported on CPU
+        """
+        params = {**self.params, **QualityController.get_instance().overrides}
+        if self.model.device == torch.device("cpu") and params.get("fp16", True):
+            params["fp16"] = False
+        return params
+
+    def features(self, audio_segment: Union[str, np.ndarray, torch.Tensor, LogMelWindow]):
+        """
+        The input whisper is given: precomputed features if they have the model's mel bands, else the samples
+        """
+        if isinstance(audio_segment, LogMelWindow) and audio_segment.n_mels != self.model.dims.n_mels:
+            return audio_segment.audio
+        return audio_segment
+
+    def run_transcribe(self, audio_segment: Union[str, np.ndarray, torch.Tensor, LogMelWindow], **params) -> dict:
+        """
+        model.transcribe() of the features() of the audio
+        :param params: whisper.transcribe() keyword arguments
+        """
+        audio_segment = self.features(audio_segment)
+        if not isinstance(audio_segment, LogMelWindow):
+            return self.model.transcribe(audio_segment, **params)
+        if _log_mel_spectrogram is None:
+            # A whisper version whose transcribe() computes the features elsewhere, it only gets the samples
+            return self.model.transcribe(audio_segment.audio, **params)
+        with _precomputed_features():
+            return self.model.transcribe(audio_segment, **params)
+
+    def transcribe_sync(self, audio_segment: Union[str, np.ndarray, torch.Tensor], translate=False) -> str:
+        """
+        Blocking version of transcribe()
+        """
+        res = self.run_transcribe(audio_segment,
+                                  task="translate" if translate else "transcribe",
+                                  **self.effective_params)
+        QualityController.get_instance().observe_language(res.get("language"))
+        return res["text"]
+
+    def transcribe_segments_sync(self, audio_segment: Union[str, np.ndarray, torch.Tensor],
+                                 translate=False) -> list[TranscriptSegment]:
+        """
+        Blocking version of transcribe_segments()
+        """
+        res = self.run_transcribe(audio_segment,
+                                  task="translate" if translate else "transcribe",
+                                  **self.effective_params)
+        QualityController.get_instance().observe_language(res.get("language"))
+        return [TranscriptSegment(s["start"], s["end"], s["text"],
+                                  [TranscriptWord(w["start"], w["end"], w["word"]) for w in s.get("words", [])])
+                for s in res["segments"]]
 
     async def transcribe(self, audio_segment: Union[str, np.ndarray, torch.Tensor], translate=False) -> str:
         """
-        Transcribe audio segment
+        Transcribe audio segment in a worker thread
         :param audio_segment: File path or numpy array or torch tensor
         :param translate: Should translate to English?
         :return: Transcribed or translated text
         """
-        return self.model.transcribe(audio_segment,
-                                     task="translate" if translate else "transcribe",
-                                     **self.params)["text"]
+        return await asyncio.to_thread(self.transcribe_sync, audio_segment, translate)
+
+    async def transcribe_segments(self, audio_segment: Union[str, np.ndarray, torch.Tensor],
+                                  translate=False) -> list[TranscriptSegment]:
+        """
+        Transcribe audio segment in a worker thread, keeping whisper's segment timestamps
+        (and word timestamps if word_timestamps is set in whisper_params)
+        :param audio_segment: File path or numpy array or torch tensor
+        :param translate: Should translate to English?
+        :return: Segments with timestamps relative to the start of the audio
+        """
+        return await asyncio.to_thread(self.transcribe_segments_sync, audio_segment, translate)
@@ -0,0 +1,128 @@
+"""
+Multi-pattern search and replacement with an Aho-Corasick automaton
+"""
+from collections import deque
+from typing import Callable, Iterable, Optional
+
+
+class AhoCorasick:
+    """
+    Automaton matching any number of patterns in one pass over the text, however many patterns there are.
+
+    Replacements use leftmost-longest semantics: scanning from the left, the longest pattern starting at a
+    position wins, and the text it covers isn't searched again.
+    """
+
+    def __init__(self, patterns: Iterable[tuple[str, str]], ignore_case: bool = False,
+                 accept: Optional[Callable[[str, int, int], bool]] = None):
+        """
+        :param patterns: (pattern, replacement). Of duplicate patterns the last one counts
+        :param ignore_case: Match regardless of case
+        :param accept: Called with (text, start, end) of every match, matches it returns False for are skipped,
+            e.g. to only match whole words
+        """
+        self.ignore_case = ignore_case
+        self._accept = accept
+        # Per state: transitions, fail link, index of the pattern ending here, next state on the fail chain where
+        # a pattern ends
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[int] = [-1]
+        self._dict: list[int] = [0]
+        self._lengths: list[int] = []
+        self.replacements: list[str] = []
+        for pattern, replacement in patterns:
+            if pattern:
+                self._add(self._fold(pattern), replacement)
+        self._link()
+
+    def __len__(self):
+        return len(self.replacements)
+
+    def _fold(self, text: str) -> str:
+        if not self.ignore_case:
+            return text
+        folded = text.lower()
+        if len(folded) == len(text):
+            return folded
+        # A few characters lower-case into several, keep those as they are so positions stay the same
+        return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+    def _add(self, pattern: str, replacement: str):
+        state = 0
+        for c in pattern:
+            nxt = self._goto[state].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(-1)
+                self._dict.append(0)
+            state = nxt
+        if self._out[state] >= 0:
+            self.replacements[self._out[state]] = replacement
+            return
+        self._out[state] = len(self.replacements)
+        self._lengths.append(len(pattern))
+        self.replacements.append(replacement)
+
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                # Children of the root fail back to the root
+                self._fail[nxt] = self._goto[fail].get(c, 0) if state else 0
+                target = self._fail[nxt]
+                self._dict[nxt] = target if self._out[target] >= 0 else self._dict[target]
+
+    def find(self, text: str) -> list[tuple[int, int, int]]:
+        """
+        :return: (start, end, pattern index) of every accepted match, overlapping ones included, by end position
+        """
+        goto, fail, out, dict_link, lengths = self._goto, self._fail, self._out, self._dict, self._lengths
+        folded = self._fold(text)
+        matches = []
+        state = 0
+        for end, c in enumerate(folded, 1):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            hit = state if out[state] >= 0 else dict_link[state]
+            while hit:
+                index = out[hit]
+                start = end - lengths[index]
+                if self._accept is None or self._accept(text, start, end):
+                    matches.append((start, end, index))
+                hit = dict_link[hit]
+        return matches
+
+    def replace(self, text: str) -> tuple[str, int]:
+        """
+        Replace the matches, leftmost-longest
+        :return: New text, number of replacements
+        """
+        if not self.replacements:
+            return text, 0
+        # End of the longest match starting at each position
+        longest: dict[int, tuple[int, int]] = {}
+        for start, end, index in self.find(text):
+            if start not in longest or end > longest[start][0]:
+                longest[start] = (end, index)
+        if not longest:
+            return text, 0
+        pieces = []
+        copied = 0
+        for start in sorted(longest):
+            if start < copied:
+                continue
+            end, index = longest[start]
+            pieces += [text[copied:start], self.replacements[index]]
+            copied = end
+        pieces.append(text[copied:])
+        return "".join(pieces), len(pieces) // 2
@@ -1,58 +1,201 @@
-import asyncio.subprocess
-from subprocess import Popen
+import asyncio
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional, Union
 
-import ffmpeg
 import loguru
 import numpy as np
-import soundfile as sf
 from anyio import EndOfStream
 
+from .features import LogMelFrontend, LogMelWindow
+from .ingest import FFmpegIngest
+from .metrics import ChunkTrace
+from .ring_buffer import INT16_SCALE, Float32BufferPool, PcmRingBuffer
+from .vad import VoiceActivitySegmenter
+from ..config_models import IngestConfig
 from ..locales.i18n import gettext as _
 
 logger = loguru.logger
 
 
-async def process_audio_segments(stream_url, chunk_duration=10, sample_rate=16000, cookie=None):
+class AudioChunk:
     """
-    Processes a live audio stream in consecutive fixed-length chunks.
+    A chunk of int16 PCM audio.
+
+    The samples stay int16 (half the size of float32) while the chunk waits in the backlog,
+    and are only converted when inference starts.
+    """
+
+    def __init__(self, pcm: np.ndarray, start_sample: int = 0, sample_rate: int = 16000,
+                 ring: Optional[PcmRingBuffer] = None, slot: int = -1,
+                 float_pool: Optional[Float32BufferPool] = None, frontend: Optional[LogMelFrontend] = None,
+                 end_sample: Optional[int] = None):
+        """
+        :param pcm: int16 PCM samples, possibly a view into a ring buffer slot
+        :param start_sample: Position of the first sample in the stream
+        :param sample_rate: Sample rate of the audio
+        :param ring: Ring buffer owning the samples, the slot is given back on release()
+        :param slot: Slot index in the ring buffer
+        :param float_pool: Pool providing the float32 buffers used by as_float32()
+        :param frontend: Frontend which computed the log-mel features of the stream
+        :param end_sample: Position right after the last sample in the stream, defaults to start_sample plus the
+            number of samples. Any other value means the samples aren't contiguous stream audio
+        """
+        self.pcm = pcm
+        self.start_sample = start_sample
+        self.end_sample = start_sample + pcm.size if end_sample is None else end_sample
+        self.sample_rate = sample_rate
+        self._ring = ring
+        self._slot = slot
+        self._float_pool = float_pool
+        self._frontend = frontend
+        self.trace = ChunkTrace(audio_duration=self.duration)
+        self.trace.audio_range = (self.start_time, self.end_sample / sample_rate)
+
+    def __len__(self):
+        return self.pcm.size
+
+    @property
+    def duration(self) -> float:
+        return self.pcm.size / self.sample_rate
+
+    @property
+    def start_time(self) -> float:
+        """
+        Seconds since the stream started
+        """
+        return self.start_sample / self.sample_rate
+
+    @property
+    def contiguous(self) -> bool:
+        """
+        Whether the samples are the stream audio [start_sample, end_sample), without gaps
+        """
+        return self.end_sample - self.start_sample == self.pcm.size
+
+    def to_float32(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Convert the samples to float32 normalized to [-1.0, 1.0) in a single pass
+        :param out: Optional buffer to convert into, at least as long as the chunk
+        :return: float32 samples
+        """
+        if out is None:
+            out = np.empty(self.pcm.size, dtype=np.float32)
+        out = out[:self.pcm.size]
+        np.multiply(self.pcm, INT16_SCALE, out=out)
+        return out
+
+    @contextmanager
+    def as_float32(self):
+        """
+        Convert the samples into a pooled float32 buffer, which is given back together with the chunk on exit
+        """
+        buffer = self._float_pool.acquire(self.pcm.size) if self._float_pool else None
+        try:
+            yield self.to_float32(buffer)
+        finally:
+            if buffer is not None:
+                self._float_pool.release(buffer)
+            self.release()
+
+    def log_mel(self, audio: np.ndarray) -> Optional[LogMelWindow]:
+        """
+        The precomputed log-mel features of the chunk, None if there are none
+        :param audio: float32 samples of the chunk, for transcribers using the samples
+        """
+        # The features are those of the stream, they only match samples which are a contiguous span of it
+        if self._frontend is None or not self.contiguous:
+            return None
+        return self._frontend.window(self.start_sample, self.pcm.size, audio)
+
+    def release(self):
+        """
+        Give the samples back to the ring buffer. The chunk must not be used afterwards.
+        """
+        if self._ring is not None:
+            self._ring.release(self._slot)
+            self._ring = None
+
+
+async def process_audio_segments(stream_url: Union[str, Callable[[], Awaitable[list[str]]]], chunk_duration=10,
+                                 sample_rate=16000, cookie=None, segmenter: Optional[VoiceActivitySegmenter] = None,
+                                 buffer_slots: int = 8, ingest_params: IngestConfig = IngestConfig(),
+                                 ingest: Optional[FFmpegIngest] = None, frontend: Optional[LogMelFrontend] = None):
+    """
+    Processes a live audio stream in consecutive fixed-length chunks,
+    or in utterance-sized chunks if a voice activity segmenter is given.
+    Stream failures are handled by reconnecting, without interrupting the chunk sequence.
 
     Args:
-        stream_url (str): URL of the live audio stream.
-        chunk_duration (int): Duration of each chunk in seconds.
+        stream_url (str | Callable): URL of the live audio stream,
+            or a coroutine function resolving the URLs to fail over between.
+        chunk_duration (float): Duration of each chunk in seconds. Ignored when segmenter is given.
         sample_rate (int): Sample rate of the audio (e.g., 16000 Hz).
         cookie (str): Optional authorization cookie.
+        segmenter (VoiceActivitySegmenter): Optional VAD that decides where chunks start and end.
+        buffer_slots (int): Chunks preallocated in the ring buffer, should cover the chunks not released yet.
+        ingest_params (IngestConfig): ffmpeg input and reconnect parameters.
+        ingest (FFmpegIngest): Optional PCM source used instead of ffmpeg,
+            anything with async readinto(buffer) and close(). stream_url is ignored then.
+        frontend (LogMelFrontend): Optional frontend computing the log-mel features of the audio as it arrives,
+            in a worker thread while the next audio is awaited.
 
     Yields:
-        np.ndarray: A NumPy array containing raw audio data for each chunk.
+        AudioChunk: int16 audio of each chunk, which must be released once it's no longer used.
     """
     # Calculate the number of samples per chunk
-    samples_per_chunk = chunk_duration * sample_rate
-
-    # Prepare FFmpeg input arguments with optional headers
-    input_args = {}
-    if cookie:
-        input_args['headers'] = f"Cookie: {cookie}"
-
-    # Start the FFmpeg process
-    process: Popen = (
-        ffmpeg.input(stream_url, **input_args).output("pipe:1", format="s16le", acodec="pcm_s16le", ar=sample_rate,
-                                                      ac=1)  # 16kHz, mono
-        .run_async(pipe_stdout=True, pipe_stderr=True, quiet=True))
-    logger.success(_("FFmpeg process has been launched."))
-
-    while True:
-        # Read fixed-length audio chunks from the stream
-        chunk_size = samples_per_chunk * 2  # 2 bytes per sample (16-bit PCM)
-        raw_audio = await asyncio.to_thread(process.stdout.read, chunk_size)
-
-        if not raw_audio:
-            raise EndOfStream(_("Stream ended."))
-        if len(raw_audio) < chunk_size:
-            logger.warning(_("The input raw_audio's size is less than chunk_size."))
-
-        # Convert raw_audio to NumPy array
-        audio_array = np.frombuffer(raw_audio, dtype=np.int16).astype(np.float32) / 32768.0  # Normalize
-        yield audio_array
+    samples_per_chunk = int(chunk_duration * sample_rate)
+    if segmenter:
+        # Read in small blocks so a chunk can be closed soon after the speech ends
+        samples_per_chunk = segmenter.frame_length * 10
+    ring = PcmRingBuffer(samples_per_chunk, buffer_slots if not segmenter else 1)
+    float_pool = Float32BufferPool(samples_per_chunk if not segmenter else segmenter.max_samples)
+
+    if ingest is None:
+        if isinstance(stream_url, str):
+            url = stream_url
+
+            async def resolve_urls():
+                return [url]
+        else:
+            resolve_urls = stream_url
+        ingest = FFmpegIngest(resolve_urls, ingest_params, sample_rate, cookie)
+
+    position = 0
+    try:
+        while True:
+            # Read fixed-length audio chunks from the stream into a ring buffer slot
+            slot = ring.acquire()
+            n_samples = await ingest.readinto(ring.buffer(slot)) // 2
+
+            ended = n_samples < samples_per_chunk
+            pcm = ring.view(slot)[:n_samples]
+            if frontend:
+                await asyncio.to_thread(frontend.feed, pcm)
+            if not segmenter:
+                if n_samples:
+                    if ended:
+                        logger.warning(_("The input raw_audio's size is less than chunk_size."))
+                    chunk = AudioChunk(pcm, position, sample_rate, ring, slot, float_pool, frontend)
+                    chunk.trace.mark("captured")
+                    yield chunk
+                else:
+                    ring.release(slot)
+            else:
+                utterances = segmenter.feed(pcm)
+                ring.release(slot)
+                if ended and (utterance := segmenter.flush()) is not None:
+                    utterances.append(utterance)
+                for start, end, utterance in utterances:
+                    logger.debug(_("Utterance detected: {:.2f}s").format(utterance.size / sample_rate))
+                    chunk = AudioChunk(utterance, start, sample_rate, float_pool=float_pool, frontend=frontend,
+                                       end_sample=end)
+                    chunk.trace.mark("captured")
+                    yield chunk
+            position += n_samples
+            if ended:
+                raise EndOfStream(_("Stream ended."))
+    finally:
+        await ingest.close()
 
 
 def save_audio_to_wav(audio_array, sample_rate, output_file):
@@ -67,6 +210,8 @@ def save_audio_to_wav(audio_array, sample_rate, output_file):
     Returns:
         None
     """
+    import soundfile as sf
+
     # Ensure the audio array is in the correct range and format
     audio_array = (audio_array * 32768).astype('int16')  # Convert back to 16-bit PCM format
     sf.write(output_file, audio_array, samplerate=sample_rate)
@@ -0,0 +1,82 @@
+"""
+Circuit breaker pausing the calls to a failing service
+"""
+import asyncio
+import time
+
+
+class CircuitBreaker:
+    """
+    After `threshold` failures in a row the circuit opens: calls wait for `cooldown` seconds instead of hitting
+    the failing service. Then a single trial call is let through (half-open). A success closes the circuit,
+    a failure opens it again for twice as long, up to max_cooldown.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = 5, cooldown: float = 15.0, max_cooldown: float = 300.0):
+        """
+        :param threshold: Failures in a row which open the circuit
+        :param cooldown: Seconds the circuit stays open the first time
+        :param max_cooldown: Longest cooldown after repeated failed trials
+        """
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        # Times the circuit was opened
+        self.opened = 0
+        self._current_cooldown = cooldown
+        self._open_until = 0.0
+        self._open = False
+
+    @property
+    def state(self) -> str:
+        if not self._open:
+            return self.CLOSED
+        return self.OPEN if time.monotonic() < self._open_until else self.HALF_OPEN
+
+    @property
+    def remaining(self) -> float:
+        """
+        Seconds until the next trial call is let through, 0 if calls may be made
+        """
+        return max(0.0, self._open_until - time.monotonic()) if self._open else 0.0
+
+    async def wait(self):
+        """
+        Wait until calls may be made
+        """
+        while (remaining := self.remaining) > 0:
+            await asyncio.sleep(remaining)
+
+    def success(self) -> bool:
+        """
+        A call succeeded
+        :return: Whether this closed the circuit
+        """
+        closed = self._open
+        self.failures = 0
+        self._open = False
+        self._current_cooldown = self.cooldown
+        return closed
+
+    def failure(self, fatal: bool = False) -> bool:
+        """
+        A call failed
+        :param fatal: The failure can't be recovered from by retrying right away, open the circuit now
+        :return: Whether this opened the circuit
+        """
+        self.failures += 1
+        if self._open:
+            # The trial call failed, wait longer this time
+            self._current_cooldown = min(self.max_cooldown, self._current_cooldown * 2)
+        elif not fatal and self.failures < self.threshold:
+            return False
+        else:
+            self._current_cooldown = self.cooldown
+        self._open = True
+        self._open_until = time.monotonic() + self._current_cooldown
+        self.opened += 1
+        return True
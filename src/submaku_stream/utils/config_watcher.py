@@ -0,0 +1,135 @@
+"""
+Watch the config file and reload it on changes, with inotify on Linux and polling elsewhere
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+from typing import Optional
+
+import loguru
+
+from ..locales.i18n import gettext as _
+from .storage import ConfigStorage
+
+logger = loguru.logger
+
+# <sys/inotify.h>
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    """
+    Reloads the config through ConfigStorage.reload() whenever its file changes.
+    The folder is watched instead of the file, so editors replacing the file by renaming are noticed too.
+    """
+
+    # Seconds. Editors and scripts often write a file in several steps, reload once they're done
+    DEBOUNCE = 0.3
+
+    def __init__(self, storage: ConfigStorage, poll_interval: float = 2.0, force_polling: bool = False):
+        """
+        :param storage: Storage whose config file is watched
+        :param poll_interval: Seconds between two checks of the file when polling
+        :param force_polling: Poll even if inotify is available
+        """
+        self.storage = storage
+        self.poll_interval = poll_interval
+        self.force_polling = force_polling
+        self._task: Optional[asyncio.Task] = None
+        self._fd: Optional[int] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self):
+        path = self.storage.config_path
+        self._fd = None if self.force_polling else _inotify_watch(str(path.parent))
+        try:
+            if self._fd is not None:
+                logger.info(_("Watching {} for changes").format(path))
+                await self._watch_inotify(path.name)
+            else:
+                logger.info(_("Checking {} for changes every {}s").format(path, self.poll_interval))
+                await self._watch_polling()
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    async def _watch_inotify(self, name: str):
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        encoded_name = name.encode()
+
+        def on_readable():
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _wd, _mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                event_name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += _EVENT_HEADER.size + length
+                if event_name == encoded_name:
+                    changed.set()
+
+        loop.add_reader(self._fd, on_readable)
+        try:
+            while True:
+                await changed.wait()
+                await asyncio.sleep(self.DEBOUNCE)
+                changed.clear()
+                self.storage.reload()
+        finally:
+            loop.remove_reader(self._fd)
+
+    async def _watch_polling(self):
+        last = _file_signature(self.storage.config_path)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            signature = _file_signature(self.storage.config_path)
+            if signature != last:
+                last = signature
+                await asyncio.sleep(self.DEBOUNCE)
+                self.storage.reload()
+
+
+def _file_signature(path) -> Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _inotify_watch(directory: str) -> Optional[int]:
+    """
+    :return: Non-blocking inotify file descriptor watching the folder, None if inotify isn't available
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
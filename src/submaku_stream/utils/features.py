@@ -0,0 +1,140 @@
+"""
+Streaming log-mel frontend: whisper's input features computed while the audio is received
+"""
+import threading
+from typing import Optional
+
+import numpy as np
+
+from .ring_buffer import INT16_SCALE
+
+SAMPLE_RATE = 16000
+# whisper.audio constants
+N_FFT = 400
+HOP_LENGTH = 160
+N_FRAMES = 3000
+# Whisper's log-mel floor: log10 of the clamped power of silence
+SILENCE_LOG = -10.0
+
+
+def n_mels_of(model_name: str) -> int:
+    """
+    Mel bands the model expects, known before the model is loaded
+    """
+    return 128 if model_name in ("large", "large-v3", "turbo", "large-v3-turbo") else 80
+
+
+class LogMelWindow:
+    """
+    Log-mel features of a chunk, normalized like whisper.log_mel_spectrogram() and followed by 30 seconds of
+    silence, in place of the samples. Transcribers which can't use them (or expect another number of mel bands)
+    use the samples.
+    """
+
+    def __init__(self, mel: np.ndarray, audio: np.ndarray):
+        """
+        :param mel: (n_mels, frames + N_FRAMES) features
+        :param audio: float32 samples of the chunk
+        """
+        self.mel = mel
+        self.audio = audio
+
+    @property
+    def n_mels(self) -> int:
+        return self.mel.shape[0]
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.audio.shape
+
+
+class LogMelFrontend:
+    """
+    Computes the log-mel frames of a stream as its PCM arrives, into a ring of frames aligned with the stream's
+    sample positions: frame k is centered on sample k * HOP_LENGTH, like whisper's STFT.
+
+    Every frame is computed once. A window of any chunk (overlapping ones included) is sliced out of the ring and
+    only normalized, which is cheap. The last frames before the end of the received audio see silence after it,
+    as whisper does at the end of a chunk, and are computed again once the audio after them arrives.
+    """
+
+    def __init__(self, n_mels: int = 80, ring_seconds: float = 120.0):
+        """
+        :param n_mels: Mel bands of the model
+        :param ring_seconds: Seconds of frames kept. Older windows aren't available anymore
+        """
+        self.n_mels = n_mels
+        self.capacity = int(ring_seconds * SAMPLE_RATE / HOP_LENGTH)
+        self._ring = np.zeros((n_mels, self.capacity), dtype=np.float32)
+        # Samples received so far
+        self.position = 0
+        # Frames [0, _final) are computed from complete audio, [_final, _computed) were padded with silence
+        self._final = 0
+        self._computed = 0
+        # Samples from the start of the first frame not final yet
+        self._tail = np.zeros(N_FFT // 2, dtype=np.float32)
+        self._tail_start = -(N_FFT // 2)
+        self._filters: Optional[np.ndarray] = None
+        self._window = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+        self._lock = threading.Lock()
+        self.frames_computed = 0
+
+    def _mel_filters(self) -> np.ndarray:
+        if self._filters is None:
+            # Imported when the first audio arrives, in the ingest's thread, not at startup
+            from whisper.audio import mel_filters
+
+            self._filters = mel_filters("cpu", self.n_mels).numpy()
+        return self._filters
+
+    def feed(self, pcm: np.ndarray):
+        """
+        Compute the frames of newly received audio. Blocking, meant for a worker thread
+        :param pcm: int16 samples following the previously fed ones
+        """
+        if not pcm.size:
+            return
+        samples = np.concatenate((self._tail, pcm.astype(np.float32) * INT16_SCALE))
+        self.position += pcm.size
+        first = self._final
+        last = -(-self.position // HOP_LENGTH)
+        if last <= first:
+            self._tail = samples
+            return
+        # Silence after the received audio, up to the end of the window of the last frame
+        end = last * HOP_LENGTH + N_FFT // 2 - HOP_LENGTH
+        padded = np.pad(samples, (0, max(0, end - self._tail_start - samples.size)))
+        offset = first * HOP_LENGTH - N_FFT // 2 - self._tail_start
+        frames = np.lib.stride_tricks.sliding_window_view(padded[offset:], N_FFT)[::HOP_LENGTH][:last - first]
+        power = np.abs(np.fft.rfft(frames * self._window, axis=-1)) ** 2
+        log_mel = np.log10(np.maximum(self._mel_filters() @ power.T.astype(np.float32), 1e-10))
+        columns = np.arange(first, last) % self.capacity
+        with self._lock:
+            self._ring[:, columns] = log_mel
+            self._computed = last
+            # Frames whose window ends within the received audio don't change anymore
+            self._final = max(first, (self.position - N_FFT // 2) // HOP_LENGTH + 1)
+        self.frames_computed += last - first
+        keep_from = self._final * HOP_LENGTH - N_FFT // 2
+        self._tail = samples[keep_from - self._tail_start:]
+        self._tail_start = keep_from
+
+    def window(self, start_sample: int, n_samples: int, audio: np.ndarray) -> Optional[LogMelWindow]:
+        """
+        Features of the audio [start_sample, start_sample + n_samples) of the stream
+        :param audio: float32 samples of the window, for transcribers using the samples
+        :return: None if the window isn't aligned with the frames, or isn't in the ring (anymore)
+        """
+        if start_sample % HOP_LENGTH:
+            return None
+        first = start_sample // HOP_LENGTH
+        n_frames = n_samples // HOP_LENGTH
+        with self._lock:
+            if n_frames <= 0 or first + n_frames > self._computed or first < self._computed - self.capacity:
+                return None
+            log_mel = self._ring[:, np.arange(first, first + n_frames) % self.capacity]
+        # Same normalization as whisper.log_mel_spectrogram() over the chunk and its 30 seconds of padding
+        floor = max(float(log_mel.max()), SILENCE_LOG) - 8.0
+        mel = np.full((self.n_mels, n_frames + N_FRAMES), (max(SILENCE_LOG, floor) + 4.0) / 4.0, dtype=np.float32)
+        mel[:, :n_frames] = (np.maximum(log_mel, floor) + 4.0) / 4.0
+        return LogMelWindow(mel, audio)
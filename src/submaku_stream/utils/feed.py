@@ -0,0 +1,287 @@
+"""
+Local subtitle feed: every transcription published to WebSocket and Server-Sent Events subscribers
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+from typing import Optional, Type, TypeVar
+
+import loguru
+
+from ..config_models import FeedConfig
+from ..locales.i18n import gettext as _
+from .http_server import HttpRequest, HttpResponse, HttpServer
+from .metrics import ChunkTrace
+from .storage import ConfigStorage
+
+logger = loguru.logger
+
+T = TypeVar('T')
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT = 0x1
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+# Largest frame accepted from a client, subscribers only send control frames
+WS_MAX_PAYLOAD = 1 << 16
+
+OVERLAY_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+body { margin: 0; background: transparent; font: bold 36px sans-serif; color: #fff; text-shadow: 0 0 4px #000; }
+#subtitles { position: fixed; bottom: 5%; width: 100%; text-align: center; }
+</style></head><body><div id="subtitles"></div><script>
+const lines = new Map(), box = document.getElementById("subtitles");
+const source = new EventSource("/events" + location.search);
+source.addEventListener("subtitle", e => {
+  const event = JSON.parse(e.data);
+  lines.set(event.room + ":" + event.index, event.text);
+  while (lines.size > 2) lines.delete(lines.keys().next().value);
+  box.innerText = [...lines.values()].join("\\n");
+});
+</script></body></html>
+"""
+
+
+def _ws_frame(opcode: int, payload: bytes) -> bytes:
+    # Server frames are never masked
+    length = len(payload)
+    if length < 126:
+        head = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return head + payload
+
+
+async def _read_ws_frame(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    """
+    :return: (opcode, unmasked payload) of the next frame of a client
+    """
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > WS_MAX_PAYLOAD:
+        raise ConnectionError("WebSocket frame too large")
+    mask = await reader.readexactly(4) if second & 0x80 else b""
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return first & 0x0F, payload
+
+
+class _Subscriber:
+    def __init__(self, request: HttpRequest, room: Optional[int], buffer_size: int, websocket: bool):
+        self.request = request
+        self.room = room
+        self.websocket = websocket
+        # Encoded events, None ends the subscription
+        self.queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(max(1, buffer_size))
+        self.closed = False
+
+    def encode(self, seq: int, event: str, data: str) -> bytes:
+        if self.websocket:
+            return _ws_frame(WS_TEXT, data.encode())
+        return f"id: {seq}\nevent: {event}\ndata: {data}\n\n".encode()
+
+    def ping(self) -> bytes:
+        return _ws_frame(WS_PING, b"") if self.websocket else b": ping\n\n"
+
+    def close(self):
+        """
+        End the subscription, dropping the events it hasn't been sent yet
+        """
+        if self.closed:
+            return
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class SubtitleFeed:
+    """
+    Publishes every transcription to any number of local subscribers, e.g. a browser source overlay in OBS or
+    other consumers of the subtitles, without the rate limits and length caps of danmaku.
+
+    Subscribers connect over WebSocket (/ws) or Server-Sent Events (/events), optionally for a single room with
+    ?room=<room id>. /overlay is a minimal overlay page. Publishing never waits: every subscriber has a bounded
+    buffer, and a subscriber which falls behind by a full buffer or stops reading is disconnected.
+
+    Events are JSON objects: room, chunk index, stream time range (start, end), wall clock time of the start,
+    text after the text handlers, final and corrected. In cascade mode a chunk is published as a draft (final false),
+    then once more with final true, corrected true if the larger model's transcription replaced the draft.
+    """
+    __instance = None
+
+    def __init__(self, params: Optional[FeedConfig] = None):
+        self.params = params or ConfigStorage.get_instance().config.feed
+        self._subscribers: set[_Subscriber] = set()
+        self._server: Optional[HttpServer] = None
+        self._seq = 0
+        self.published = 0
+        self.evicted = 0
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not SubtitleFeed.__instance:
+            SubtitleFeed.__instance = SubtitleFeed()
+        return SubtitleFeed.__instance
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    async def start(self):
+        self._server = HttpServer(self.params.host, self.params.port)
+        self._server.route("/ws", self._serve_websocket)
+        self._server.route("/events", self._serve_events)
+        self._server.route("/overlay", self._serve_overlay)
+        await self._server.start()
+
+    async def stop(self):
+        for subscriber in list(self._subscribers):
+            subscriber.close()
+        if self._server:
+            await self._server.stop()
+            self._server = None
+
+    def publish_trace(self, trace: ChunkTrace, final: bool = True):
+        """
+        Publish the transcription of a chunk
+        :param trace: Trace of the chunk, with the text after the text handlers
+        :param final: False for a draft of the cascade which may still be corrected
+        """
+        if not self._subscribers or not trace.text.strip():
+            return
+        start, end = trace.audio_range or (None, None)
+        self.publish({
+            "room": trace.room,
+            "index": trace.index,
+            "start": start,
+            "end": end,
+            "wall_time": trace.wall_offset + start if trace.wall_offset is not None and start is not None else None,
+            "text": trace.text,
+            "final": final,
+            "corrected": trace.status == "corrected",
+        })
+
+    def publish(self, event: dict, name: str = "subtitle"):
+        """
+        Queue an event for every subscriber of its room, disconnecting the ones whose buffer is full
+        """
+        if not self._subscribers:
+            return
+        self._seq += 1
+        self.published += 1
+        data = json.dumps(event, ensure_ascii=False)
+        for subscriber in list(self._subscribers):
+            if subscriber.closed or subscriber.room is not None and subscriber.room != event.get("room"):
+                continue
+            try:
+                subscriber.queue.put_nowait(subscriber.encode(self._seq, name, data))
+            except asyncio.QueueFull:
+                self._evict(subscriber, _("fell behind by {} events").format(subscriber.queue.maxsize))
+
+    def _evict(self, subscriber: _Subscriber, reason: str):
+        if subscriber.closed:
+            return
+        self.evicted += 1
+        logger.warning(_("Subtitle feed subscriber {} disconnected: {}").format(
+            subscriber.request.writer.get_extra_info("peername"), reason))
+        subscriber.close()
+
+    def _subscribe(self, request: HttpRequest, websocket: bool) -> Optional[_Subscriber]:
+        room = request.query.get("room", [None])[0]
+        try:
+            room = int(room) if room else None
+        except ValueError:
+            return None
+        return _Subscriber(request, room, self.params.buffer_size, websocket)
+
+    async def _serve_events(self, request: HttpRequest) -> Optional[HttpResponse]:
+        subscriber = self._subscribe(request, websocket=False)
+        if subscriber is None:
+            return HttpResponse(400)
+        head = ["HTTP/1.1 200 OK", "Content-Type: text/event-stream; charset=utf-8", "Cache-Control: no-cache",
+                "Connection: keep-alive", "Access-Control-Allow-Origin: *"]
+        request.writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        await self._run(subscriber)
+        return None
+
+    async def _serve_websocket(self, request: HttpRequest) -> Optional[HttpResponse]:
+        key = request.headers.get("sec-websocket-key")
+        if request.headers.get("upgrade", "").lower() != "websocket" or not key:
+            return HttpResponse(400, b"Expected a WebSocket upgrade")
+        subscriber = self._subscribe(request, websocket=True)
+        if subscriber is None:
+            return HttpResponse(400)
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        head = ["HTTP/1.1 101 Switching Protocols", "Upgrade: websocket", "Connection: Upgrade",
+                f"Sec-WebSocket-Accept: {accept}"]
+        request.writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        await self._run(subscriber)
+        return None
+
+    async def _serve_overlay(self, _request: HttpRequest) -> HttpResponse:
+        return HttpResponse(body=OVERLAY_PAGE.encode(), content_type="text/html; charset=utf-8")
+
+    async def _run(self, subscriber: _Subscriber):
+        """
+        Write the events of a subscriber until it disconnects or is evicted
+        """
+        self._subscribers.add(subscriber)
+        writer = subscriber.request.writer
+        listener = asyncio.create_task(self._listen(subscriber))
+        logger.info(_("Subtitle feed subscriber {} connected").format(writer.get_extra_info("peername")))
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(subscriber.queue.get(), self.params.ping_interval or None)
+                except asyncio.TimeoutError:
+                    data = subscriber.ping()
+                if data is None:
+                    break
+                writer.write(data)
+                try:
+                    await asyncio.wait_for(writer.drain(), self.params.write_timeout or None)
+                except asyncio.TimeoutError:
+                    self._evict(subscriber, _("not reading"))
+                    break
+            if subscriber.websocket and not writer.is_closing():
+                writer.write(_ws_frame(WS_CLOSE, struct.pack("!H", 1000)))
+        except ConnectionError:
+            pass
+        finally:
+            self._subscribers.discard(subscriber)
+            subscriber.closed = True
+            listener.cancel()
+            writer.close()
+
+    @staticmethod
+    async def _listen(subscriber: _Subscriber):
+        """
+        Answer the pings of a WebSocket client, and notice when a client goes away
+        """
+        reader, writer = subscriber.request.reader, subscriber.request.writer
+        try:
+            if not subscriber.websocket:
+                # Event stream clients don't send anything, only the end of the connection is of interest
+                while await reader.read(4096):
+                    pass
+            else:
+                while True:
+                    opcode, payload = await _read_ws_frame(reader)
+                    if opcode == WS_CLOSE:
+                        break
+                    if opcode == WS_PING:
+                        writer.write(_ws_frame(WS_PONG, payload))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        subscriber.close()
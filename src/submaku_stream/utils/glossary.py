@@ -0,0 +1,142 @@
+"""
+Glossaries: replacement and mask entries from files, compiled into one Aho-Corasick automaton
+"""
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import loguru
+
+from ..config_models import GlossaryHandlerConfig
+from ..locales.i18n import gettext as _
+from .aho_corasick import AhoCorasick
+from .text import is_word_char
+
+logger = loguru.logger
+
+SEPARATOR = "=>"
+
+# Parsed files shared by every glossary: path -> ((mtime_ns, size), entries)
+_file_cache: dict[Path, tuple[tuple[int, int], list[tuple[str, Optional[str]]]]] = {}
+# Compiled automatons shared by glossaries with the same files, entries and options
+_automaton_cache: dict[tuple, AhoCorasick] = {}
+_cache_lock = threading.Lock()
+
+
+def parse_entry(line: str) -> Optional[tuple[str, Optional[str]]]:
+    """
+    :return: (pattern, replacement), replacement None for a masked pattern. None for comments and empty lines
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    pattern, separator, replacement = line.partition(SEPARATOR)
+    pattern = pattern.strip()
+    if not pattern:
+        return None
+    return pattern, replacement.strip() if separator else None
+
+
+def _stat(path: Path) -> tuple[int, int]:
+    try:
+        st = path.stat()
+    except OSError:
+        return 0, -1
+    return st.st_mtime_ns, st.st_size
+
+
+def read_glossary_file(path: Path) -> list[tuple[str, Optional[str]]]:
+    """
+    Entries of a glossary file, parsed again only when the file has changed. A missing file has no entries
+    """
+    stat = _stat(path)
+    with _cache_lock:
+        cached = _file_cache.get(path)
+    if cached and cached[0] == stat:
+        return cached[1]
+    entries = []
+    if stat[1] >= 0:
+        with open(path, encoding="utf-8") as f:
+            entries = [entry for line in f if (entry := parse_entry(line))]
+    else:
+        logger.warning(_("Glossary file {} not found").format(path))
+    with _cache_lock:
+        _file_cache[path] = (stat, entries)
+    return entries
+
+
+class Glossary:
+    """
+    The entries of a glossary handler, compiled into one automaton which replaces and masks them all in a single
+    pass over the text. The files are checked for changes at most every reload_interval seconds.
+    """
+
+    def __init__(self, params: GlossaryHandlerConfig, base_folder: Path):
+        """
+        :param params: Glossary handler config
+        :param base_folder: Folder the file paths are relative to
+        """
+        self.params = params
+        self.paths = [base_folder / file for file in params.files]
+        self._stats: list[tuple[int, int]] = []
+        self._checked_at = 0.0
+        self.automaton: Optional[AhoCorasick] = None
+        self.replaced = 0
+
+    def stale(self) -> bool:
+        """
+        Whether the glossary has to be (re)loaded
+        """
+        if self.automaton is None:
+            return True
+        if not self.params.reload_interval or time.monotonic() - self._checked_at < self.params.reload_interval:
+            return False
+        self._checked_at = time.monotonic()
+        return [_stat(path) for path in self.paths] != self._stats
+
+    def load(self):
+        """
+        Read the files and compile the automaton. Blocking, glossaries with thousands of entries take a while
+        """
+        self._checked_at = time.monotonic()
+        stats = [_stat(path) for path in self.paths]
+        key = (tuple(zip(self.paths, stats)), tuple(self.params.entries), self.params.ignore_case,
+               self.params.whole_words, self.params.mask_char)
+        with _cache_lock:
+            automaton = _automaton_cache.get(key)
+        if automaton is None:
+            t0_perf = time.time()
+            entries = [entry for path in self.paths for entry in read_glossary_file(path)]
+            entries += [entry for line in self.params.entries if (entry := parse_entry(line))]
+            mask_char = self.params.mask_char
+            automaton = AhoCorasick(
+                ((pattern, mask_char * len(pattern) if replacement is None else replacement)
+                 for pattern, replacement in entries),
+                self.params.ignore_case, self._whole_word if self.params.whole_words else None)
+            with _cache_lock:
+                # Outdated versions of the same glossary aren't needed anymore
+                for old in [k for k in _automaton_cache if k[1:] == key[1:] and [p for p, _s in k[0]] == self.paths]:
+                    del _automaton_cache[old]
+                _automaton_cache[key] = automaton
+            logger.info(_("Glossary of {} entries compiled. {:.2f}ms").format(len(automaton),
+                                                                             (time.time() - t0_perf) * 1000))
+        self._stats = stats
+        self.automaton = automaton
+
+    @staticmethod
+    def _whole_word(text: str, start: int, end: int) -> bool:
+        # A match starting or ending inside a word is part of another word
+        if start > 0 and is_word_char(text[start]) and is_word_char(text[start - 1]):
+            return False
+        if end < len(text) and is_word_char(text[end - 1]) and is_word_char(text[end]):
+            return False
+        return True
+
+    def apply(self, text: str) -> str:
+        """
+        Replace and mask the entries in the text
+        """
+        text, n = self.automaton.replace(text)
+        self.replaced += n
+        return text
@@ -0,0 +1,160 @@
+"""
+Minimal asyncio HTTP/1.1 server for the local endpoints (metrics, subtitle feeds)
+"""
+import asyncio
+import weakref
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import loguru
+
+from ..locales.i18n import gettext as _
+
+logger = loguru.logger
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            500: "Internal Server Error"}
+
+
+@dataclass
+class HttpRequest:
+    method: str
+    path: str
+    query: dict[str, list[str]]
+    # Lower-case header names
+    headers: dict[str, str]
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    body: bytes = b""
+
+    @property
+    def keep_alive(self) -> bool:
+        # HTTP/1.1 connections are persistent unless the client says otherwise
+        return self.headers.get("connection", "").lower() != "close"
+
+
+@dataclass
+class HttpResponse:
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers: dict[str, str] = field(default_factory=dict)
+
+    def encode(self, keep_alive: bool = False) -> bytes:
+        head = [f"HTTP/1.1 {self.status} {_REASONS.get(self.status, '')}",
+                f"Content-Type: {self.content_type}",
+                f"Content-Length: {len(self.body)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        head += [f"{k}: {v}" for k, v in self.headers.items()]
+        return ("\r\n".join(head) + "\r\n\r\n").encode() + self.body
+
+
+# A handler either returns a response, or None once it has taken over the connection (e.g. a long-lived stream),
+# closing the connection is then up to the handler
+RequestHandler = Callable[[HttpRequest], Awaitable[Optional[HttpResponse]]]
+
+
+class HttpServer:
+    """
+    Routes requests by path and method. Connections are kept alive between requests unless the client closes them
+    """
+
+    # Seconds an idle kept-alive connection stays open
+    KEEP_ALIVE_TIMEOUT = 10
+    MAX_BODY = 1 << 20
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self._routes: dict[str, tuple[RequestHandler, tuple[str, ...]]] = {}
+        self._server: Optional[asyncio.Server] = None
+        # Every open connection, including those taken over by handlers
+        self._connections: weakref.WeakSet[asyncio.StreamWriter] = weakref.WeakSet()
+        self._tasks: set[asyncio.Task] = set()
+
+    def route(self, path: str, handler: RequestHandler, methods: tuple[str, ...] = ("GET",)):
+        self._routes[path] = (handler, methods)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # The actual port if 0 was given
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.success(_("HTTP server is listening on http://{}:{}").format(self.host, self.port))
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            # Let the connections see their end instead of being cancelled at shutdown
+            if self._tasks:
+                await asyncio.wait(self._tasks, timeout=1)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        keep_open = False
+        self._connections.add(writer)
+        self._tasks.add(asyncio.current_task())
+        try:
+            first = True
+            while True:
+                request = await self._read_request(reader, writer)
+                if request is None and not first:
+                    # Idle timeout of a kept-alive connection
+                    return
+                first = False
+                keep_alive = request is not None and request.keep_alive
+                if request is None:
+                    response = HttpResponse(400)
+                elif (route := self._routes.get(request.path)) is None:
+                    response = HttpResponse(404)
+                elif request.method not in route[1]:
+                    response = HttpResponse(405)
+                else:
+                    try:
+                        response = await route[0](request)
+                    except Exception as e:
+                        logger.error(repr(e))
+                        response = HttpResponse(500)
+                if response is None:
+                    keep_open = True
+                    return
+                writer.write(response.encode(keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._tasks.discard(asyncio.current_task())
+            if not keep_open:
+                writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[HttpRequest]:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HttpServer.KEEP_ALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError):
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+        body = b""
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            return None
+        if length > HttpServer.MAX_BODY:
+            return None
+        if length > 0:
+            body = await reader.readexactly(length)
+        url = urlsplit(parts[1])
+        return HttpRequest(parts[0].upper(), url.path, parse_qs(url.query), headers, reader, writer, body)
@@ -0,0 +1,180 @@
+"""
+ffmpeg ingest running as an asyncio subprocess, with automatic reconnect and stream URL failover
+"""
+import asyncio
+import random
+import re
+import time
+from typing import Awaitable, Callable, Optional
+
+import loguru
+from anyio import EndOfStream
+
+from ..config_models import IngestConfig
+from ..locales.i18n import gettext as _
+
+logger = loguru.logger
+
+# ffmpeg stderr lines worth a warning, everything else is logged at debug level
+_ERROR_PATTERN = re.compile(r"error|failed|refused|forbidden|timed out|reset|invalid|end of file|\b[45]\d\d\b",
+                            re.IGNORECASE)
+
+
+# Inputs without a scheme (or file:) are local files
+_URL_SCHEME = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+
+class FFmpegIngest:
+    """
+    Decodes a live stream into mono s16le PCM with ffmpeg.
+
+    When ffmpeg exits or stops producing audio, the next stream URL is tried.
+    Once every URL failed, the URL list is resolved again with exponential backoff.
+    Readers only see a continuous PCM byte stream.
+    """
+
+    def __init__(self, resolve_urls: Callable[[], Awaitable[list[str]]], params: IngestConfig = IngestConfig(),
+                 sample_rate: int = 16000, cookie: Optional[str] = None):
+        """
+        :param resolve_urls: Coroutine function returning the stream URLs (CDN mirrors) to try in order
+        :param params: Reconnect and ffmpeg input parameters
+        :param sample_rate: Sample rate of the output PCM
+        :param cookie: Optional authorization cookie
+        """
+        self.resolve_urls = resolve_urls
+        self.params = params
+        self.sample_rate = sample_rate
+        self.cookie = cookie
+
+        self._urls: list[str] = []
+        self._url_index = 0
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._stderr_task: Optional[asyncio.Task] = None
+        # Consecutive rounds in which no URL produced any audio
+        self._failed_rounds = 0
+        self.reconnects = 0
+
+    def _build_args(self, url: str) -> list[str]:
+        args = [self.params.ffmpeg_path, "-hide_banner", "-nostdin", "-nostats", "-loglevel", "warning",
+                # Low-latency input profile: start decoding as soon as possible and don't buffer the input
+                "-fflags", "nobuffer", "-flags", "low_delay",
+                "-probesize", str(self.params.probesize), "-analyzeduration", str(self.params.analyzeduration)]
+        if url.startswith("http"):
+            # Let ffmpeg fail quickly on a dead connection, reconnecting is done here
+            args += ["-rw_timeout", str(int(self.params.stall_timeout * 1_000_000))]
+            headers = "".join(f"{k}: {v}\r\n" for k, v in self.params.http_headers.items())
+            if self.cookie:
+                headers += f"Cookie: {self.cookie}\r\n"
+            if headers:
+                args += ["-headers", headers]
+        if self.params.realtime:
+            args.append("-re")
+        # Audio only: skip video, subtitle and data streams entirely
+        args += ["-i", url, "-vn", "-sn", "-dn", "-map", "0:a:0",
+                 "-ac", "1", "-ar", str(self.sample_rate), "-acodec", "pcm_s16le", "-f", "s16le", "pipe:1"]
+        return args
+
+    async def _current_url(self) -> str:
+        """
+        The URL to connect to, resolving the URL list again (with backoff after failures) once every URL was tried
+        """
+        while self._url_index >= len(self._urls):
+            if 0 < self.params.max_resolve_attempts <= self._failed_rounds:
+                raise EndOfStream(_("Stream ended."))
+            if self._failed_rounds:
+                delay = min(self.params.reconnect_backoff_max,
+                            self.params.reconnect_backoff_base * 2 ** min(self._failed_rounds - 1, 16))
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning(_("All stream URLs failed, resolving them again in {:.1f}s.").format(delay))
+                await asyncio.sleep(delay)
+            try:
+                self._urls = list(await self.resolve_urls())
+            except Exception as e:
+                logger.error(repr(e))
+                self._urls = []
+            self._url_index = 0
+            if not self._urls:
+                self._failed_rounds += 1
+        return self._urls[self._url_index]
+
+    def _fail_current_url(self):
+        self.reconnects += 1
+        self._url_index += 1
+        if self._url_index >= len(self._urls):
+            self._failed_rounds += 1
+
+    async def _start(self):
+        url = await self._current_url()
+        logger.info(_("Stream URL: {}").format(url))
+        self._process = await asyncio.create_subprocess_exec(*self._build_args(url),
+                                                             stdin=asyncio.subprocess.DEVNULL,
+                                                             stdout=asyncio.subprocess.PIPE,
+                                                             stderr=asyncio.subprocess.PIPE)
+        self._stderr_task = asyncio.create_task(self._watch_stderr(self._process))
+        logger.success(_("FFmpeg process has been launched."))
+
+    async def _watch_stderr(self, process: asyncio.subprocess.Process):
+        while line := await process.stderr.readline():
+            text = line.decode(errors="replace").rstrip()
+            if _ERROR_PATTERN.search(text):
+                logger.warning("ffmpeg: {}", text)
+            else:
+                logger.debug("ffmpeg: {}", text)
+
+    async def _stop(self):
+        process, self._process = self._process, None
+        if process and process.returncode is None:
+            process.kill()
+            await process.wait()
+        if self._stderr_task:
+            self._stderr_task.cancel()
+            self._stderr_task = None
+
+    async def _finished_local_file(self) -> bool:
+        """
+        Whether ffmpeg exited after reading a local file to the end, which is not worth reconnecting
+        """
+        url = self._urls[self._url_index]
+        if _URL_SCHEME.match(url) and not url.startswith("file:"):
+            return False
+        try:
+            return await asyncio.wait_for(self._process.wait(), 1) == 0
+        except asyncio.TimeoutError:
+            return False
+
+    async def readinto(self, buffer: memoryview) -> int:
+        """
+        Fill the buffer with PCM bytes, reconnecting as often as needed.
+        asyncio pipes only hand out bytes objects, so each read is copied once into the buffer.
+        :param buffer: Writable byte buffer
+        :return: Number of bytes read, which is only less than the buffer size if the stream has ended for good
+        """
+        filled = 0
+        try:
+            while filled < len(buffer):
+                if not self._process:
+                    await self._start()
+                t0 = time.time()
+                try:
+                    data = await asyncio.wait_for(self._process.stdout.read(len(buffer) - filled),
+                                                  self.params.stall_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(_("No audio received for {:.1f}s, reconnecting.").format(time.time() - t0))
+                    data = b""
+                if not data:
+                    if await self._finished_local_file():
+                        raise EndOfStream(_("Stream ended."))
+                    await self._stop()
+                    self._fail_current_url()
+                    # The new process starts at a sample boundary, drop the dangling byte of a half-read sample
+                    filled -= filled % 2
+                    continue
+                self._failed_rounds = 0
+                buffer[filled:filled + len(data)] = data
+                filled += len(data)
+        except EndOfStream:
+            return filled
+        return filled
+
+    async def close(self):
+        await self._stop()
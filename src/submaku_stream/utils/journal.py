@@ -0,0 +1,334 @@
+"""
+Append-only transcript journal, written by a background thread, and its export to SRT/VTT subtitles
+"""
+import json
+import os
+import queue
+import threading
+import time
+import wave
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Iterator, Optional, Type, TypeVar
+
+import loguru
+import numpy as np
+
+from ..config_models import JournalConfig
+from ..locales.i18n import gettext as _
+from .metrics import ChunkTrace, Tracer
+from .storage import ConfigStorage
+
+logger = loguru.logger
+
+T = TypeVar('T')
+
+# Sample rate of the chunks, and of the archived audio
+SAMPLE_RATE = 16000
+FILE_PREFIX = "transcript-"
+
+
+class TranscriptJournal:
+    """
+    Appends a JSON line for every finished chunk trace: room, chunk index, audio time range, transcribed segments,
+    danmaku, send status and stage timings. Optionally the audio of the chunk is appended to a FLAC file next to
+    the journal file, and the record points at its samples there.
+
+    The event loop only snapshots the trace, serializing, writing and syncing happen in a writer thread.
+    Records are fsynced together at most every fsync_interval seconds.
+    """
+    __instance = None
+
+    def __init__(self, params: Optional[JournalConfig] = None):
+        self.params = params or ConfigStorage.get_instance().config.journal
+        self.folder = Path(self.params.path)
+        self.records = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._file: Optional[IO[bytes]] = None
+        self._file_bytes = 0
+        self._opened_at = 0.0
+        self._audio_file: Optional[IO[bytes]] = None
+        self._audio = None
+        self._audio_name = ""
+        self._audio_samples = 0
+        self._last_sync = 0.0
+        self._unsynced = False
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not TranscriptJournal.__instance:
+            TranscriptJournal.__instance = TranscriptJournal()
+        return TranscriptJournal.__instance
+
+    def open(self):
+        """
+        Start the writer thread, and write every trace finishing from now on
+        """
+        if self._thread:
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        if self.params.archive_audio:
+            try:
+                import soundfile  # noqa: F401
+            except ImportError:
+                logger.warning(_("Archiving audio needs the soundfile package, the journal is written without it"))
+                self.params = self.params.model_copy(update={"archive_audio": False})
+        self._thread = threading.Thread(target=self._run, name="transcript-journal", daemon=True)
+        self._thread.start()
+        Tracer.get_instance().subscribe(self.write)
+        logger.info(_("Writing the transcript journal to {}").format(self.folder))
+
+    def close(self):
+        """
+        Write the records still queued, sync and close the files
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def archive_audio(self) -> bool:
+        return self._thread is not None and self.params.archive_audio
+
+    def write(self, trace: ChunkTrace):
+        """
+        Queue the record of a finished trace
+        """
+        if not self._thread:
+            return
+        record = {
+            "time": time.time(),
+            "room": trace.room,
+            "index": trace.index,
+            "status": trace.status,
+            "audio_range": trace.audio_range,
+            "wall_offset": trace.wall_offset,
+            "segments": trace.segments,
+            "danmaku": trace.danmaku,
+            "sent": trace.sent,
+            "dropped": trace.dropped,
+            "timings": {name.removeprefix("submaku_").removesuffix("_seconds"): dt
+                        for name, (_description, start, end) in Tracer.STAGES.items()
+                        if (dt := trace.stage(start, end)) is not None},
+        }
+        self._queue.put((record, trace.audio))
+        # The samples are owned by the writer from now on
+        trace.audio = None
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._unsynced:
+                timeout = max(0.0, self._last_sync + self.params.fsync_interval - time.monotonic())
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            # Everything queued meanwhile is written with a single flush
+            while not self._queue.empty() and len(batch) < 256:
+                batch.append(self._queue.get())
+            stop = None in batch
+            try:
+                for item in batch:
+                    if item is not None:
+                        self._write_record(*item)
+                if self._unsynced and (stop or time.monotonic() - self._last_sync >= self.params.fsync_interval):
+                    self._sync()
+            except (OSError, RuntimeError) as e:
+                logger.error(_("Failed to write the transcript journal: {}").format(repr(e)))
+            if stop:
+                self._close_files()
+                return
+
+    def _write_record(self, record: dict, audio: Optional[np.ndarray]):
+        now = time.time()
+        if self._file is None or (self.params.max_bytes and self._file_bytes >= self.params.max_bytes) or \
+                (self.params.rotate_interval and now - self._opened_at >= self.params.rotate_interval):
+            self._rotate(now)
+        if audio is not None and self._audio is not None:
+            self._audio.write(audio)
+            record["audio_file"] = self._audio_name
+            record["audio_offset"] = self._audio_samples
+            record["audio_samples"] = int(audio.size)
+            self._audio_samples += audio.size
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._file.write(line)
+        self._file_bytes += len(line)
+        self._unsynced = True
+        self.records += 1
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._audio is not None:
+            self._audio.flush()
+            self._audio_file.flush()
+            os.fsync(self._audio_file.fileno())
+        self._last_sync = time.monotonic()
+        self._unsynced = False
+
+    def _rotate(self, now: float):
+        if self._file is not None:
+            self._close_files()
+        # Sortable by name, microseconds keep quick rotations apart
+        stem = FILE_PREFIX + datetime.fromtimestamp(now).strftime("%Y%m%d-%H%M%S-%f")
+        self._file = open(self.folder / f"{stem}.jsonl", "ab")
+        self._file_bytes = 0
+        self._opened_at = now
+        if self.params.archive_audio:
+            import soundfile as sf
+
+            self._audio_name = f"{stem}.flac"
+            self._audio_file = open(self.folder / self._audio_name, "w+b")
+            self._audio = sf.SoundFile(self._audio_file, "w", samplerate=SAMPLE_RATE, channels=1, format="FLAC",
+                                       subtype="PCM_16")
+            self._audio_samples = 0
+        logger.debug(_("Transcript journal file: {}").format(self._file.name))
+        if self.params.max_files:
+            for path in journal_files(self.folder)[:-self.params.max_files]:
+                path.unlink(missing_ok=True)
+                path.with_suffix(".flac").unlink(missing_ok=True)
+
+    def _close_files(self):
+        if self._unsynced:
+            self._sync()
+        if self._audio is not None:
+            self._audio.close()
+            self._audio_file.close()
+            self._audio = self._audio_file = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def journal_files(folder: Path) -> list[Path]:
+    """
+    :return: Journal files in the folder, oldest first
+    """
+    return sorted(folder.glob(f"{FILE_PREFIX}*.jsonl"))
+
+
+def read_journal(folder: Path, since: Optional[float] = None, until: Optional[float] = None,
+                 room: Optional[int] = None) -> Iterator[dict]:
+    """
+    Read the journal records in the order they were written
+    :param folder: Journal folder
+    :param since: Only records whose audio ends after this wall clock time
+    :param until: Only records whose audio starts before this wall clock time
+    :param room: Only records of this room
+    """
+    for path in journal_files(folder):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a file may have been cut off by a crash
+                    continue
+                if room is not None and record.get("room") != room:
+                    continue
+                if (since is not None or until is not None) and not record.get("audio_range"):
+                    continue
+                start, end = _wall_range(record) if record.get("audio_range") else (0.0, 0.0)
+                if (since is not None and end < since) or (until is not None and start > until):
+                    continue
+                yield record
+
+
+def apply_corrections(records: list[dict]) -> list[dict]:
+    """
+    The transcribed records, with the drafts the cascade corrected replaced by their corrections
+    """
+    transcribed = {}
+    for record in records:
+        if record.get("status") not in ("ok", "corrected"):
+            continue
+        # A correction has the index, audio range and wall offset of its draft, the wall offset tells runs apart
+        key = (record.get("room"), record.get("index"), tuple(record.get("audio_range") or ()),
+               record.get("wall_offset"))
+        if record["status"] == "corrected" or key not in transcribed:
+            transcribed[key] = record
+    return list(transcribed.values())
+
+
+def _wall_range(record: dict) -> tuple[float, float]:
+    start, end = record["audio_range"]
+    offset = record.get("wall_offset") or 0.0
+    return start + offset, end + offset
+
+
+def _format_timestamp(seconds: float, separator: str) -> str:
+    milliseconds = max(0, round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+def to_subtitles(records: list[dict], fmt: str = "srt", time_base: str = "wall",
+                 origin: Optional[float] = None) -> str:
+    """
+    Turn the transcribed segments of journal records into subtitles
+    :param records: Journal records
+    :param fmt: "srt" or "vtt"
+    :param time_base: "wall" places the cues by when their audio was received, relative to origin.
+        "stream" uses the stream time, which restarts with every run of the program
+    :param origin: Wall clock time of 00:00:00, defaults to the start of the first record's audio
+    :return: Subtitle file content
+    """
+    if time_base == "wall" and origin is None:
+        origin = min((_wall_range(r)[0] for r in records if r.get("audio_range")), default=0.0)
+    cues = []
+    for record in records:
+        offset = (record.get("wall_offset") or 0.0) - origin if time_base == "wall" else 0.0
+        for start, end, text in record.get("segments", []):
+            if text.strip():
+                cues.append((start + offset, max(end, start + 0.1) + offset, text.strip()))
+    cues.sort(key=lambda cue: cue[0])
+    separator = "," if fmt == "srt" else "."
+    lines = ["WEBVTT", ""] if fmt == "vtt" else []
+    for i, (start, end, text) in enumerate(cues, 1):
+        if fmt == "srt":
+            lines.append(str(i))
+        lines.append(f"{_format_timestamp(start, separator)} --> {_format_timestamp(end, separator)}")
+        lines += [text, ""]
+    return "\n".join(lines)
+
+
+def export_audio(records: list[dict], folder: Path, output: Path, time_base: str = "wall",
+                 origin: Optional[float] = None) -> float:
+    """
+    Write the archived audio of journal records to a 16 kHz mono WAV, on the same timeline as to_subtitles(),
+    with silence where no audio was archived. The WAV can be replayed by tests/replay_benchmark.py
+    :return: Seconds of audio written
+    """
+    import soundfile as sf
+
+    records = [r for r in records if r.get("audio_file") and r.get("audio_range")]
+    if len({r.get("room") for r in records}) > 1:
+        raise ValueError(_("The records are from several rooms, select one of them"))
+    if time_base == "wall" and origin is None:
+        origin = min((_wall_range(r)[0] for r in records), default=0.0)
+    placed = sorted(((record["audio_range"][0] + ((record.get("wall_offset") or 0.0) - origin
+                                                  if time_base == "wall" else 0.0), record) for record in records),
+                    key=lambda item: item[0])
+    position = 0
+    with wave.open(str(output), "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        for start, record in placed:
+            pcm, _rate = sf.read(folder / record["audio_file"], frames=record["audio_samples"],
+                                 start=record["audio_offset"], dtype="int16")
+            skip = position - int(start * SAMPLE_RATE)
+            if skip < 0:
+                out.writeframes(bytes(-skip * 2))
+                position -= skip
+                skip = 0
+            # Audio overlapping what was written already is cut off
+            pcm = pcm[skip:]
+            out.writeframes(pcm.tobytes())
+            position += pcm.size
+    return position / SAMPLE_RATE
@@ -0,0 +1,338 @@
+"""
+Per-chunk latency traces, aggregated into histograms and exported in the Prometheus text format
+"""
+import bisect
+import contextvars
+import json
+import re
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Optional, Type, TypeVar
+
+import loguru
+
+from ..locales.i18n import gettext as _
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = loguru.logger
+
+T = TypeVar('T')
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Trace of the chunk being processed by the current task, read by the hooks which don't get it passed
+current_trace: contextvars.ContextVar[Optional["ChunkTrace"]] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    """
+    Cumulative bucket counts for Prometheus, plus a window of recent samples for the quantiles
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                 window: int = 1024):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._recent: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+            self._recent.append(value)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    def quantiles(self, qs: tuple[float, ...] = QUANTILES) -> dict[float, float]:
+        """
+        Quantiles of the recent samples, nearest-rank
+        """
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return {}
+        return {q: recent[min(len(recent) - 1, int(q * len(recent)))] for q in qs}
+
+    def render(self) -> list[str]:
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f'{self.name}_bucket{{le="+Inf"}} {count}', f"{self.name}_sum {total}", f"{self.name}_count {count}"]
+        if quantiles := self.quantiles():
+            lines += [f"# HELP {self.name}_recent {self.description}, over the recent samples",
+                      f"# TYPE {self.name}_recent gauge"]
+            lines += [f'{self.name}_recent{{quantile="{q}"}} {v}' for q, v in quantiles.items()]
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Histograms observed by the pipeline, and gauges / counters read from the components on export
+    """
+    __instance = None
+
+    def __init__(self):
+        self._histograms: dict[str, Histogram] = {}
+        # name -> (description, type, {labels: value getter})
+        self._callbacks: dict[str, tuple[str, str, dict[tuple[tuple[str, str], ...], Callable[[], float]]]] = {}
+        self.window = 1024
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not MetricsRegistry.__instance:
+            MetricsRegistry.__instance = MetricsRegistry()
+        return MetricsRegistry.__instance
+
+    def histogram(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(name, description, buckets, self.window)
+        return self._histograms[name]
+
+    def gauge(self, name: str, description: str, getter: Callable[[], float], labels: dict[str, str] = None):
+        self._register(name, description, "gauge", getter, labels)
+
+    def counter(self, name: str, description: str, getter: Callable[[], float], labels: dict[str, str] = None):
+        self._register(name, description, "counter", getter, labels)
+
+    def _register(self, name: str, description: str, kind: str, getter: Callable[[], float],
+                  labels: dict[str, str] = None):
+        _description, _kind, getters = self._callbacks.setdefault(name, (description, kind, {}))
+        getters[tuple(sorted((labels or {}).items()))] = getter
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for histogram in self._histograms.values():
+            lines += histogram.render()
+        for name, (description, kind, getters) in self._callbacks.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for labels, getter in getters.items():
+                try:
+                    value = float(getter())
+                except Exception as e:
+                    logger.debug(repr(e))
+                    continue
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """
+        Recent p50/p95/p99 of every histogram
+        """
+        return {name: {f"p{int(q * 100)}": round(v, 4) for q, v in h.quantiles().items()}
+                for name, h in self._histograms.items()}
+
+
+class ChunkTrace:
+    """
+    Timestamps of one chunk passing through the pipeline.
+
+    Stages, in order: captured, enqueued, inference_start, inference_end, handlers_start, handlers_end,
+    then sender_enqueued and sent for every danmaku made from the chunk. The text handlers run once per segment,
+    so their time is summed per handler instead of stamped.
+    """
+
+    def __init__(self, index: int = -1, audio_duration: float = 0.0):
+        """
+        :param index: Chunk index, assigned by the scheduler
+        :param audio_duration: Seconds of audio in the chunk
+        """
+        self.index = index
+        self.audio_duration = audio_duration
+        # Room the chunk was captured from, in multi-room mode
+        self.room: Optional[int] = None
+        self.stamps: dict[str, float] = {}
+        # Text handler name -> seconds spent in it, over all segments of the chunk
+        self.handler_seconds: dict[str, float] = {}
+        self._handler_clock: Optional[float] = None
+        self.status = "ok"
+        # Stream time range of the audio, in seconds
+        self.audio_range: Optional[tuple[float, float]] = None
+        # Wall clock time minus stream time, maps the stream time to when the audio was received
+        self.wall_offset: Optional[float] = None
+        # Transcribed text as (start, end, text), stream time
+        self.segments: list[tuple[float, float, str]] = []
+        # Transcribed text after the text handlers, before it's split into danmaku
+        self.text = ""
+        self.danmaku: list[str] = []
+        self.sent = 0
+        self.dropped = 0
+        # int16 PCM kept for the audio archive of the transcript journal, until the trace finishes
+        self.audio: Optional["np.ndarray"] = None
+        # Danmaku made from the chunk which are still queued for sending
+        self._pending = 0
+        self._delivered = False
+        self._finished = False
+
+    def mark(self, stage: str, t: Optional[float] = None):
+        self.stamps[stage] = time.time() if t is None else t
+
+    def enter_handlers(self):
+        """
+        A text handler chain is entered, its first handler starts now
+        """
+        self._handler_clock = time.time()
+
+    def handler_done(self, name: str):
+        """
+        A text handler is done with a text, the next one of the chain starts now
+        """
+        now = time.time()
+        if self._handler_clock is not None:
+            self.handler_seconds[name] = self.handler_seconds.get(name, 0.0) + now - self._handler_clock
+        self._handler_clock = now
+
+    def stage(self, start: str, end: str) -> Optional[float]:
+        """
+        Seconds between two stages, None if either hasn't happened
+        """
+        if start in self.stamps and end in self.stamps:
+            return self.stamps[end] - self.stamps[start]
+        return None
+
+    def hold(self):
+        """
+        A danmaku made from the chunk was queued for sending
+        """
+        self._pending += 1
+        self.stamps.setdefault("sender_enqueued", time.time())
+
+    def danmaku_done(self, sent: bool):
+        """
+        A queued danmaku was sent or dropped
+        """
+        self._pending -= 1
+        if sent:
+            self.sent += 1
+            self.stamps.setdefault("sent", time.time())
+        else:
+            self.dropped += 1
+        if self._delivered and self._pending <= 0:
+            self.finish()
+
+    def delivered(self):
+        """
+        Every danmaku made from the chunk has been queued, the trace finishes once they are sent
+        """
+        self._delivered = True
+        if self._pending <= 0:
+            self.finish()
+
+    def finish(self, status: Optional[str] = None):
+        if self._finished:
+            return
+        self._finished = True
+        if status:
+            self.status = status
+        Tracer.get_instance().finish(self)
+
+    def to_dict(self) -> dict:
+        return {"room": self.room, "index": self.index, "status": self.status, "audio_duration": self.audio_duration,
+                "stamps": self.stamps, "handler_seconds": self.handler_seconds}
+
+
+class Tracer:
+    """
+    Aggregates the finished traces into per-stage histograms, and optionally appends them to a JSONL file
+    """
+    __instance = None
+
+    # Histogram name -> (description, start stage, end stage)
+    STAGES = {
+        "submaku_capture_to_enqueue_seconds": ("Chunk captured until submitted to the scheduler",
+                                               "captured", "enqueued"),
+        "submaku_queue_wait_seconds": ("Chunk waiting in the transcription backlog", "enqueued", "inference_start"),
+        "submaku_inference_seconds": ("Transcription of a chunk", "inference_start", "inference_end"),
+        "submaku_handlers_seconds": ("Text handler chain", "handlers_start", "handlers_end"),
+        "submaku_sender_queue_seconds": ("First danmaku of a chunk waiting to be sent", "sender_enqueued", "sent"),
+        "submaku_end_to_end_seconds": ("Chunk captured until its first danmaku is sent", "captured", "sent"),
+    }
+
+    def __init__(self):
+        self.registry = MetricsRegistry.get_instance()
+        self._histograms = {name: self.registry.histogram(name, description)
+                            for name, (description, _start, _end) in self.STAGES.items()}
+        self._rtf = self.registry.histogram("submaku_real_time_factor", "Inference time divided by audio duration",
+                                            RATIO_BUCKETS)
+        self._handler_histograms: dict[str, Histogram] = {}
+        self._sink = None
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[ChunkTrace], None]] = []
+        self.finished = {"ok": 0, "dropped": 0}
+        self.registry.counter("submaku_chunks_traced_total", "Chunks whose trace finished",
+                              lambda: self.finished["ok"])
+        self.registry.counter("submaku_chunks_dropped_total", "Chunks dropped before transcription",
+                              lambda: self.finished["dropped"])
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not Tracer.__instance:
+            Tracer.__instance = Tracer()
+        return Tracer.__instance
+
+    def open_sink(self, path: str):
+        """
+        Append every finished trace as a JSON line to the file
+        """
+        self.close_sink()
+        self._sink = open(path, "a", encoding="utf-8", buffering=1)
+        logger.info(_("Writing chunk traces to {}").format(path))
+
+    def close_sink(self):
+        if self._sink:
+            self._sink.close()
+            self._sink = None
+
+    def subscribe(self, listener: Callable[[ChunkTrace], None]):
+        """
+        Call the listener with every finished trace
+        """
+        self._listeners.append(listener)
+
+    def finish(self, trace: ChunkTrace):
+        self.finished[trace.status] = self.finished.get(trace.status, 0) + 1
+        for name, (_description, start, end) in self.STAGES.items():
+            if (dt := trace.stage(start, end)) is not None:
+                self._histograms[name].observe(dt)
+        inference = trace.stage("inference_start", "inference_end")
+        if inference is not None and trace.audio_duration > 0:
+            self._rtf.observe(inference / trace.audio_duration)
+        for handler, seconds in trace.handler_seconds.items():
+            self._handler_histogram(handler).observe(seconds)
+        if self._sink:
+            with self._lock:
+                self._sink.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+        for listener in self._listeners:
+            listener(trace)
+
+    def _handler_histogram(self, handler: str) -> Histogram:
+        if handler not in self._handler_histograms:
+            # Handler names come from the config, only some characters are allowed in metric names
+            self._handler_histograms[handler] = self.registry.histogram(
+                f"submaku_handler_{re.sub(r'[^a-z0-9_]', '_', handler.lower())}_seconds", f"Text handler {handler}")
+        return self._handler_histograms[handler]
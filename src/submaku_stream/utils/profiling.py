@@ -0,0 +1,72 @@
+"""
+Startup timing breakdown, printed with --startup-profile
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Type, TypeVar
+
+T = TypeVar('T')
+
+
+class StartupProfile:
+    """
+    Wall-clock timings of the startup phases, relative to the program start
+    """
+    __instance = None
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        # (phase name, start, end) in seconds since t0
+        self._phases: list[tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not StartupProfile.__instance:
+            StartupProfile.__instance = StartupProfile()
+        return StartupProfile.__instance
+
+    def record(self, name: str, start: float, end: float):
+        """
+        Record a phase from perf_counter() timestamps
+        """
+        with self._lock:
+            self._phases.append((name, start - self.t0, end - self.t0))
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time the enclosed block as a phase. Phases may overlap and may run in other threads.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def mark(self, name: str):
+        """
+        Record a milestone, i.e. a phase without duration
+        """
+        now = time.perf_counter()
+        self.record(name, now, now)
+
+    def mark_once(self, name: str) -> bool:
+        """
+        Record a milestone unless it has been recorded already
+        :return: Whether it was recorded now
+        """
+        with self._lock:
+            if any(phase[0] == name for phase in self._phases):
+                return False
+        self.mark(name)
+        return True
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self._phases, key=lambda p: p[1])
+        lines = [f"{'phase':<24}{'start':>10}{'end':>10}{'duration':>10}"]
+        for name, start, end in phases:
+            lines.append(f"{name:<24}{start * 1000:>8.0f}ms{end * 1000:>8.0f}ms{(end - start) * 1000:>8.0f}ms")
+        return "\n".join(lines)
@@ -0,0 +1,161 @@
+"""
+Adaptive decoding quality: trade beam search for speed while transcription falls behind
+"""
+import threading
+import time
+from typing import Callable, Optional, Type, TypeVar
+
+import loguru
+
+from ..config_models import Config, QualityConfig
+from ..locales.i18n import gettext as _
+from .storage import ConfigStorage
+
+logger = loguru.logger
+
+T = TypeVar('T')
+
+
+class QualityController:
+    """
+    Tracks the real-time factor and the backlog, and steps through the quality tiers:
+    tier 0 is whisper_params as configured, every following tier overrides some of them with cheaper settings.
+
+    Under pressure it steps down at most once per step_down_interval. It steps back up only once the load
+    has stayed low for step_up_after seconds, so it doesn't oscillate around the thresholds.
+
+    It also remembers the language whisper detected, so in auto-language mode the detection doesn't run
+    on every chunk.
+    """
+    __instance = None
+
+    def __init__(self):
+        storage = ConfigStorage.get_instance()
+        config = storage.config
+        self.tiers: list[dict] = [{}] + [dict(tier) for tier in config.quality.tiers]
+        self.tier = 0
+        self.changes = 0
+        # Smoothed inference time / audio duration, per inference slot
+        self.rtf = 0.0
+        self._concurrency = max(1, config.scheduler.concurrency)
+        self._backlogs: list[Callable[[], int]] = []
+        self._last_change = 0.0
+        self._relaxed_since: Optional[float] = None
+        self._auto_language = not config.whisper_params.get("language")
+        self._language: Optional[str] = None
+        self._language_at = 0.0
+        # Languages are reported from inference threads
+        self._lock = threading.Lock()
+        storage.subscribe(self._on_config_change)
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not QualityController.__instance:
+            QualityController.__instance = QualityController()
+        return QualityController.__instance
+
+    @property
+    def params(self) -> QualityConfig:
+        return ConfigStorage.get_instance().config.quality
+
+    def _on_config_change(self, old: Config, new: Config):
+        if new.quality.tiers != old.quality.tiers:
+            self.tiers = [{}] + [dict(tier) for tier in new.quality.tiers]
+            self.tier = min(self.tier, len(self.tiers) - 1)
+        if not new.quality.adaptive:
+            self.tier = 0
+        if new.whisper_params.get("language") != old.whisper_params.get("language"):
+            self._auto_language = not new.whisper_params.get("language")
+            with self._lock:
+                self._language = None
+
+    def add_backlog(self, getter: Callable[[], int]):
+        """
+        Watch a backlog, e.g. the chunks waiting in a scheduler. The longest one counts
+        """
+        self._backlogs.append(getter)
+
+    @property
+    def backlog(self) -> int:
+        return max((getter() for getter in self._backlogs), default=0)
+
+    @property
+    def language(self) -> Optional[str]:
+        """
+        The cached detected language, None if it has to be detected
+        """
+        with self._lock:
+            if not self._language:
+                return None
+            if self.params.language_ttl and time.monotonic() - self._language_at > self.params.language_ttl:
+                return None
+            return self._language
+
+    @property
+    def overrides(self) -> dict:
+        """
+        whisper_params overrides of the current tier, plus the cached language
+        """
+        overrides = dict(self.tiers[self.tier])
+        if self._auto_language and (language := self.language):
+            overrides["language"] = language
+        return overrides
+
+    def observe_language(self, language: Optional[str]):
+        """
+        A transcription detected this language
+        """
+        if not (self._auto_language and self.params.language_cache and language):
+            return
+        with self._lock:
+            if language != self._language:
+                logger.info(_("Detected language: {}").format(language))
+            self._language = language
+            self._language_at = time.monotonic()
+
+    def observe(self, inference_seconds: float, audio_seconds: float):
+        """
+        A chunk was transcribed, re-evaluate the tier
+        :param inference_seconds: Time the transcription took
+        :param audio_seconds: Seconds of audio that had to be transcribed meanwhile to keep up
+        """
+        if audio_seconds <= 0:
+            return
+        rtf = inference_seconds / audio_seconds / self._concurrency
+        alpha = self.params.rtf_smoothing
+        self.rtf = rtf if self.rtf == 0 else alpha * rtf + (1 - alpha) * self.rtf
+        if self.params.adaptive:
+            self._evaluate(time.monotonic())
+
+    def _evaluate(self, now: float):
+        backlog = self.backlog
+        if self.rtf > self.params.rtf_high or backlog >= self.params.backlog_high:
+            self._relaxed_since = None
+            if self.tier < len(self.tiers) - 1 and now - self._last_change >= self.params.step_down_interval:
+                self._set_tier(self.tier + 1, now, backlog)
+        elif self.rtf <= self.params.rtf_low and backlog <= self.params.backlog_low:
+            if self._relaxed_since is None:
+                self._relaxed_since = now
+            elif self.tier > 0 and now - self._relaxed_since >= self.params.step_up_after:
+                self._set_tier(self.tier - 1, now, backlog)
+                # The next step up needs another calm period
+                self._relaxed_since = now
+        else:
+            self._relaxed_since = None
+
+    def _set_tier(self, tier: int, now: float, backlog: int):
+        message = _("Decoding quality tier {} -> {} {}, real-time factor {:.2f}, backlog {}").format(
+            self.tier, tier, self.tiers[tier], self.rtf, backlog)
+        if tier > self.tier:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        self.tier = tier
+        self.changes += 1
+        self._last_change = now
+
+    def set_tier(self, tier: int):
+        """
+        Follow a tier chosen elsewhere, e.g. by the main process in an inference worker
+        """
+        self.tier = min(max(0, tier), len(self.tiers) - 1)
@@ -0,0 +1,71 @@
+"""
+Token bucket rate limiting
+"""
+import asyncio
+import math
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average, and bursts of up to `capacity` operations after idling.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        :param rate: Tokens added per second
+        :param capacity: Max number of tokens the bucket holds. It starts full.
+        """
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if math.isinf(self.rate):
+            self._tokens = self.capacity
+        else:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def delay(self, n: float = 1) -> float:
+        """
+        Seconds until n tokens are available
+        """
+        missing = n - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def try_consume(self, n: float = 1) -> bool:
+        if self.tokens < n:
+            return False
+        self._tokens -= n
+        return True
+
+    def drain(self):
+        """
+        Empty the bucket, e.g. after the server reported that the rate limit was hit anyway
+        """
+        self._refill()
+        self._tokens = 0.0
+
+    async def wait(self, n: float = 1):
+        """
+        Wait until n tokens are available, without taking them
+        """
+        while (delay := self.delay(n)) > 0:
+            await asyncio.sleep(delay)
+
+    async def acquire(self, n: float = 1):
+        """
+        Wait until n tokens are available and take them
+        """
+        while not self.try_consume(n):
+            await self.wait(n)
@@ -0,0 +1,89 @@
+"""
+Preallocated PCM buffers for the ingest path
+"""
+import threading
+from collections import deque
+
+import loguru
+import numpy as np
+
+from ..locales.i18n import gettext as _
+
+logger = loguru.logger
+
+# int16 PCM -> float32 in [-1.0, 1.0)
+INT16_SCALE = np.float32(1 / 32768)
+
+
+class PcmRingBuffer:
+    """
+    A ring of preallocated int16 slots, each holding one chunk.
+
+    The ingest fills a free slot with ffmpeg's output, and the slot is handed out as a view,
+    so the int16 chunk itself is never reallocated until it is released back into the ring.
+    """
+
+    def __init__(self, slot_samples: int, n_slots: int):
+        """
+        :param slot_samples: Samples per slot, i.e. the chunk size
+        :param n_slots: Number of preallocated slots, should cover the backlog and the chunks being transcribed
+        """
+        self.slot_samples = slot_samples
+        self._slots = [np.empty(slot_samples, dtype=np.int16) for _i in range(max(1, n_slots))]
+        self._free = deque(range(len(self._slots)))
+        self._lock = threading.Lock()
+
+    @property
+    def n_slots(self) -> int:
+        return len(self._slots)
+
+    @property
+    def free_slots(self) -> int:
+        return len(self._free)
+
+    def acquire(self) -> int:
+        """
+        Take a free slot. The ring grows by one slot if all of them are in use.
+        :return: Slot index
+        """
+        with self._lock:
+            if self._free:
+                return self._free.popleft()
+            self._slots.append(np.empty(self.slot_samples, dtype=np.int16))
+            logger.debug(_("PCM ring buffer is full, grows to {} slots.").format(len(self._slots)))
+            return len(self._slots) - 1
+
+    def release(self, slot: int):
+        with self._lock:
+            self._free.append(slot)
+
+    def view(self, slot: int) -> np.ndarray:
+        return self._slots[slot]
+
+    def buffer(self, slot: int) -> memoryview:
+        """
+        Writable byte view of a slot
+        """
+        return memoryview(self._slots[slot]).cast("B")
+
+
+class Float32BufferPool:
+    """
+    Reusable float32 buffers the int16 chunks are converted into right before inference
+    """
+
+    def __init__(self, buffer_samples: int, n_buffers: int = 0):
+        self.buffer_samples = buffer_samples
+        self._free = [np.empty(buffer_samples, dtype=np.float32) for _i in range(n_buffers)]
+        self._lock = threading.Lock()
+
+    def acquire(self, n_samples: int) -> np.ndarray:
+        with self._lock:
+            for i, buffer in enumerate(self._free):
+                if buffer.size >= n_samples:
+                    return self._free.pop(i)
+        return np.empty(max(n_samples, self.buffer_samples), dtype=np.float32)
+
+    def release(self, buffer: np.ndarray):
+        with self._lock:
+            self._free.append(buffer)
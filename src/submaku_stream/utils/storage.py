@@ -1,21 +1,49 @@
 from dataclasses import dataclass
-from typing import Type, TypeVar
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional, Type, TypeVar
 
-import bilibili_api
-from bilibili_api.live import LiveRoom
+import loguru
 
-from ..config_models import Credential, Config
+from ..config_models import Credential, Config, RoomConfig
 from ..constants import CONFIG_PATH, CREDENTIAL_PATH
+from ..locales.i18n import gettext as _
+
+if TYPE_CHECKING:
+    import bilibili_api
+    from bilibili_api.live import LiveRoom
+
+logger = loguru.logger
 
 T = TypeVar('T')
 
+# Settings which the running program was set up with, changes to them are only applied after a restart
+RESTART_FIELDS = frozenset({
+    "program_display_language", "platform", "room_id", "rooms", "transcription_mode", "segmentation_mode",
+    "segment_time_length", "scheduler", "ingest", "streaming", "transport", "metrics", "feed", "should_send_danmaku",
+    "frontend", "cascade", "journal", "reload",
+})
+
+# Receives the previous and the new config
+ConfigSubscriber = Callable[[Config, Config], None]
+
 
 class ConfigStorage:
     __instance = None
 
-    def __init__(self):
-        self.config = Config.load_from_json(CONFIG_PATH)
-        self.credential = Credential.load_from_json(CREDENTIAL_PATH)
+    def __init__(self, config_path: Path = CONFIG_PATH, credential_path: Path = CREDENTIAL_PATH):
+        self.config_path = config_path
+        self.credential_path = credential_path
+        self.config = Config.load_from_json(config_path)
+        self.credential = Credential.load_from_json(credential_path)
+        self._subscribers: list[ConfigSubscriber] = []
+
+    @classmethod
+    def load(cls: Type[T], config_path: Path = CONFIG_PATH, credential_path: Path = CREDENTIAL_PATH) -> T:
+        """
+        Load the config and the credential explicitly, replacing the current instance
+        """
+        ConfigStorage.__instance = ConfigStorage(config_path, credential_path)
+        return ConfigStorage.__instance
 
     @classmethod
     def get_instance(cls: Type[T]) -> T:
@@ -23,12 +51,101 @@ class ConfigStorage:
             ConfigStorage.__instance = ConfigStorage()
         return ConfigStorage.__instance
 
+    def subscribe(self, callback: ConfigSubscriber):
+        """
+        Call back on every config change, with the previous and the new config.
+        Components which derive state from the config at construction keep it up to date this way,
+        everything else reads ConfigStorage.get_instance().config when it needs it.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: ConfigSubscriber):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
 
-_config = ConfigStorage.get_instance()
+    def reload(self) -> bool:
+        """
+        Read the config file again and publish it if it is valid, otherwise keep the current config
+        :return: Whether anything changed
+        """
+        try:
+            config = Config.load_from_json(self.config_path)
+        except (OSError, ValueError) as e:
+            # pydantic's ValidationError is a ValueError
+            logger.error(_("Invalid config, keeping the current one: {}").format(e))
+            return False
+        return self.publish(config)
+
+    def publish(self, config: Config) -> bool:
+        """
+        Replace the config and notify the subscribers. The config object is swapped in one assignment,
+        so readers see either the old or the new config, never a mix.
+        :return: Whether anything changed
+        """
+        old = self.config
+        if kept := sorted(f for f in RESTART_FIELDS if getattr(config, f) != getattr(old, f)):
+            logger.warning(_("Changes to {} take effect after a restart").format(", ".join(kept)))
+            config = config.model_copy(update={f: getattr(old, f) for f in kept})
+        changed = [f for f in Config.model_fields if getattr(config, f) != getattr(old, f)]
+        if not changed:
+            return False
+        self.config = config
+        logger.success(_("Config reloaded: {}").format(", ".join(changed)))
+        for callback in list(self._subscribers):
+            try:
+                callback(old, config)
+            except Exception as e:
+                logger.error(repr(e))
+        return True
+
+
+@dataclass
+class Room:
+    """
+    A live room the subtitles are made for, with its overrides of the global settings
+    """
+    room_id: int
+    live_room: "LiveRoom"
+    # None follows the global setting
+    danmaku_text_format: Optional[str]
+    danmaku_display_mode: Optional[str]
+    max_lag: float
+    weight: float = 1.0
+    # Handler chain replacing config.text_handlers
+    text_handlers: Optional[list] = None
 
 
 @dataclass
 class Constants:
-    credential: bilibili_api.Credential = bilibili_api.Credential(_config.credential.SESSDATA,
-                                                                  _config.credential.bili_jct)
-    live_room: LiveRoom = LiveRoom(_config.config.room_id, credential)
+    """
+    Platform objects shared by the whole program, created by setup() at startup
+    """
+    credential: Optional["bilibili_api.Credential"] = None
+    live_room: Optional["LiveRoom"] = None
+    # Every room the program runs, the first one is live_room
+    rooms: list[Room] = None
+
+    @classmethod
+    def setup(cls, storage: ConfigStorage):
+        import bilibili_api
+
+        config = storage.config
+        if config.transport.pooled:
+            from .transport import PooledLiveRoom as LiveRoom
+        else:
+            from bilibili_api.live import LiveRoom
+        cls.credential = bilibili_api.Credential(storage.credential.SESSDATA, storage.credential.bili_jct)
+        cls.live_room = LiveRoom(config.room_id, cls.credential)
+        cls.rooms = []
+        for params in config.rooms or [RoomConfig(room_id=config.room_id)]:
+            if params.credential_path:
+                cred = Credential.load_from_json(storage.config_path.parent / params.credential_path)
+                live_room = LiveRoom(params.room_id, bilibili_api.Credential(cred.SESSDATA, cred.bili_jct))
+            elif params.room_id == config.room_id:
+                live_room = cls.live_room
+            else:
+                live_room = LiveRoom(params.room_id, cls.credential)
+            # Without an override the room follows the global setting, also when it's changed while running
+            cls.rooms.append(Room(params.room_id, live_room, params.danmaku_text_format, params.danmaku_display_mode,
+                                  config.scheduler.max_lag if params.max_lag is None else params.max_lag,
+                                  params.weight, params.text_handlers))
@@ -1,17 +1,175 @@
 import re
 
+# Kana, CJK ideographs and Hangul
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+# A CJK character is a token on its own, other word characters form words, every punctuation mark is a token
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]|[^\W{_CJK}]+|[^\w\s]")
+_WORD_CHAR_PATTERN = re.compile(rf"[^\W{_CJK}]")
+_CJK_PATTERN = re.compile(rf"[{_CJK}]")
 
-def remove_redundant_repeats(text):
+
+def is_word_char(c: str) -> bool:
+    """
+    Whether the character belongs to a word of several characters, CJK characters are words on their own
+    """
+    return _WORD_CHAR_PATTERN.match(c) is not None
+
+
+def join_texts(left: str, right: str) -> str:
+    """
+    Join two pieces of text, with a space only between words and after punctuation that isn't CJK
+    """
+    if not left or not right or left[-1].isspace() or right[0].isspace() or not is_word_char(right[0]):
+        return left + right
+    if is_word_char(left[-1]) or (left[-1].isascii() and not left[-1].isalnum()):
+        return f"{left} {right}"
+    return left + right
+
+
+def tokenize(text: str) -> list[tuple[int, int]]:
+    """
+    Split text into CJK characters, words and punctuation marks, whitespace is skipped
+    :return: (start, end) character spans of the tokens
+    """
+    return [m.span() for m in _TOKEN_PATTERN.finditer(text)]
+
+
+def _collapse_period(text: str, tokens: list[tuple[int, int]], period: int,
+                     min_repeats: int, min_unit_chars: int) -> str:
+    """
+    One linear pass collapsing the runs of a repeated unit of `period` tokens
     """
-    Remove redundant repeats
+    # Same token -> same id, so tokens compare in O(1)
+    ids = {}
+    keys = [ids.setdefault(text[s:e].casefold(), len(ids)) for s, e in tokens]
+    n = len(tokens)
+    pieces = []
+    copied = 0
+    i = 0
+    while i < n - period:
+        if keys[i] != keys[i + period]:
+            i += 1
+            continue
+        # Tokens i..end+period-1 repeat with this period
+        end = i
+        while end < n - period and keys[end] == keys[end + period]:
+            end += 1
+        repeats = (end - i + period) // period
+        unit_chars = sum(e - s for s, e in tokens[i:i + period])
+        if repeats >= min_repeats and unit_chars >= min_unit_chars:
+            # Keep the first copy, remove the following ones together with the whitespace before them.
+            # A doubled CJK character is a word of its own (谢谢, 哈哈), a run of them keeps two copies
+            kept = 2 if period == 1 and _CJK_PATTERN.fullmatch(text[slice(*tokens[i])]) else 1
+            cut_start = tokens[i + kept * period - 1][1]
+            last = i + repeats * period - 1
+            cut_end = tokens[last][1]
+            pieces.append(text[copied:cut_start])
+            copied = cut_end
+            i = last + 1
+        else:
+            i = end + 1
+    if not pieces:
+        return text
+    pieces.append(text[copied:])
+    return "".join(pieces)
 
-    Such as Hello world REPEAT A REPEAT A REPEAT A REPEAT B REPEAT B AA REPEAT B REPEAT B
 
-    -> Such as Helo world REPEAT A REPEAT B A REPEAT B
+def remove_redundant_repeats(text: str, min_repeats: int = 3, min_unit_chars: int = 1,
+                             max_unit_tokens: int = 32) -> str:
+    """
+    Collapse runs of a repeated word, character or phrase into a single occurrence, e.g. looping whisper output
+
+    Such as Hello world REPEAT A REPEAT A REPEAT A REPEAT B REPEAT B 哈哈哈哈
 
+    -> Such as Hello world REPEAT A REPEAT B REPEAT B 哈哈
+
+    Repeats are searched token-wise, one linear pass per unit length,
+    so the cost is O(len(text) * max_unit_tokens) even for long hallucinated loops.
     :param text: original text
+    :param min_repeats: A unit is only collapsed if it occurs at least this many times in a row
+    :param min_unit_chars: Units shorter than this (without whitespace) are kept
+    :param max_unit_tokens: Longest repeated unit searched for, in tokens
     :return: processed text
     """
-    pattern = r"(.*?)(\1+)"
-    result = re.sub(pattern, r"\1", text)
-    return result
+    tokens = tokenize(text)
+    for period in range(1, max_unit_tokens + 1):
+        if len(tokens) < period * max(2, min_repeats):
+            break
+        collapsed = _collapse_period(text, tokens, period, max(2, min_repeats), min_unit_chars)
+        if collapsed != text:
+            text = collapsed
+            tokens = tokenize(text)
+    return text
+
+
+# Clause-ending punctuation, a danmaku preferably ends right after one of these
+_CLAUSE_PUNCTUATION = frozenset(",.!?;:，。！？；：、…")
+
+
+def split_text(text: str, max_chars: int) -> list[tuple[int, int]]:
+    """
+    Split text into pieces of at most max_chars characters without dropping any character.
+    Pieces end at clause punctuation if possible, otherwise at whitespace, and only words longer than
+    max_chars are cut in the middle.
+    :param text: Text to split
+    :param max_chars: Max characters per piece, 0 means unlimited
+    :return: (start, end) character spans of the pieces, without surrounding whitespace
+    """
+    spans = []
+    n = len(text)
+    start = 0
+    while start < n:
+        while start < n and text[start].isspace():
+            start += 1
+        if start >= n:
+            break
+        if not max_chars or n - start <= max_chars:
+            cut = n
+        else:
+            limit = start + max_chars
+            punctuation = whitespace = None
+            # Scan the window backwards for the last boundary of each kind
+            for i in range(limit, start, -1):
+                if whitespace is None and (i == n or text[i].isspace()):
+                    whitespace = i
+                if text[i - 1] in _CLAUSE_PUNCTUATION:
+                    punctuation = i
+                    break
+            # Prefer the punctuation unless it would leave a very short piece
+            if punctuation is not None and (punctuation - start >= max_chars // 2 or whitespace is None):
+                cut = punctuation
+            else:
+                cut = whitespace or limit
+        end = cut
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        spans.append((start, end))
+        start = cut
+    return spans
+
+
+# Punctuation marks are the only tokens which aren't word characters
+_PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+
+def _words(text: str) -> list[str]:
+    return [text[s:e].casefold() for s, e in tokenize(text) if not _PUNCTUATION_PATTERN.fullmatch(text[s:e])]
+
+
+def text_distance(a: str, b: str) -> float:
+    """
+    Share of words / CJK characters that differ between two texts: the token-wise edit distance divided by the
+    length of the longer text. Case and punctuation are ignored
+    :return: 0.0 for the same words, 1.0 for nothing in common
+    """
+    words_a, words_b = _words(a), _words(b)
+    if not words_a and not words_b:
+        return 0.0
+    # Levenshtein distance, one row at a time
+    previous = list(range(len(words_b) + 1))
+    for i, word_a in enumerate(words_a, 1):
+        current = [i]
+        for j, word_b in enumerate(words_b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (word_a != word_b)))
+        previous = current
+    return previous[-1] / max(len(words_a), len(words_b))
@@ -0,0 +1,143 @@
+"""
+Danmaku and room API calls over one persistent, pooled HTTP client
+"""
+import time
+from typing import TYPE_CHECKING, Optional, Type, TypeVar
+
+import httpx
+import loguru
+from bilibili_api import ResponseCodeException
+
+from ..config_models import TransportConfig
+from ..locales.i18n import gettext as _
+from .storage import ConfigStorage
+
+if TYPE_CHECKING:
+    import bilibili_api
+    from bilibili_api import Danmaku
+    from bilibili_api.live import ScreenResolution
+
+logger = loguru.logger
+
+T = TypeVar('T')
+
+_USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+               "Chrome/124.0 Safari/537.36")
+
+
+class HttpTransport:
+    """
+    One keep-alive connection pool shared by every room, so sending a danmaku doesn't pay a connection setup
+    and TLS handshake. Credentials are sent per request, rooms with different accounts share the pool as well.
+    """
+    __instance = None
+
+    def __init__(self, params: Optional[TransportConfig] = None):
+        self.params = params or ConfigStorage.get_instance().config.transport
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @classmethod
+    def get_instance(cls: Type[T]) -> T:
+        if not HttpTransport.__instance:
+            HttpTransport.__instance = HttpTransport()
+        return HttpTransport.__instance
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            params = self.params
+            http2 = params.http2
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning(_("HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1"))
+                    http2 = False
+            self._client = httpx.AsyncClient(
+                base_url=params.api_base,
+                http2=http2,
+                limits=httpx.Limits(max_connections=params.max_connections,
+                                    max_keepalive_connections=params.max_keepalive_connections,
+                                    keepalive_expiry=params.keepalive_expiry),
+                timeout=httpx.Timeout(connect=params.connect_timeout, read=params.read_timeout,
+                                      write=params.write_timeout, pool=params.pool_timeout),
+                headers={"User-Agent": _USER_AGENT, "Referer": "https://live.bilibili.com/"},
+            )
+        return self._client
+
+    async def request(self, method: str, path: str, credential: "bilibili_api.Credential" = None,
+                      **kwargs) -> dict:
+        """
+        Call a bilibili API
+        :param method: HTTP method
+        :param path: Path below api_base
+        :param credential: Account the request is made with
+        :param kwargs: httpx request arguments, e.g. params or data
+        :return: The data field of the response
+        :raise ResponseCodeException: The API returned an error code
+        :raise httpx.HTTPError: Network errors and HTTP error statuses
+        """
+        headers = kwargs.pop("headers", {})
+        if credential is not None:
+            # A header instead of the client's cookie jar, which would mix the accounts of the rooms
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in credential.get_cookies().items() if v)
+        resp = await self.client.request(method, path, headers=headers, **kwargs)
+        resp.raise_for_status()
+        payload = resp.json()
+        if payload.get("code", 0) != 0:
+            raise ResponseCodeException(payload["code"], payload.get("message") or payload.get("msg", ""), payload)
+        return payload.get("data")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class PooledLiveRoom:
+    """
+    Stands in for bilibili_api.live.LiveRoom on the hot paths (sending danmaku, resolving the stream),
+    sending the requests through the shared HttpTransport
+    """
+
+    def __init__(self, room_display_id: int, credential: "bilibili_api.Credential",
+                 transport: Optional[HttpTransport] = None):
+        """
+        :param room_display_id: Room id as shown in the room URL
+        :param credential: Account the danmaku are sent with
+        :param transport: Defaults to the shared transport
+        """
+        self.room_display_id = room_display_id
+        self.credential = credential
+        self.transport = transport or HttpTransport.get_instance()
+        self._room_id: Optional[int] = None
+
+    async def get_room_id(self) -> int:
+        """
+        Real room id, the display id may be a short alias. Resolved once
+        """
+        if self._room_id is None:
+            data = await self.transport.request("GET", "/room/v1/Room/room_init", params={"id": self.room_display_id})
+            self._room_id = data["room_id"]
+        return self._room_id
+
+    async def send_danmaku(self, danmaku: "Danmaku") -> dict:
+        self.credential.raise_for_no_sessdata()
+        csrf = self.credential.bili_jct
+        return await self.transport.request("POST", "/msg/send", credential=self.credential, data={
+            "mode": danmaku.mode,
+            "msg": danmaku.text,
+            "roomid": await self.get_room_id(),
+            "bubble": 0,
+            "rnd": int(time.time()),
+            "color": int(danmaku.color, 16),
+            "fontsize": danmaku.font_size,
+            "csrf": csrf,
+            "csrf_token": csrf,
+        })
+
+    async def get_room_play_url(self, screen_resolution: "ScreenResolution") -> dict:
+        return await self.transport.request("GET", "/xlive/web-room/v1/playUrl/playUrl", credential=self.credential,
+                                            params={"cid": await self.get_room_id(), "platform": "web",
+                                                    "qn": screen_resolution.value, "https_url_req": "1",
+                                                    "ptype": "16"})
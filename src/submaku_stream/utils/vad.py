@@ -0,0 +1,195 @@
+"""
+Energy / zero-crossing voice activity detection used to cut the PCM stream at speech boundaries
+"""
+from collections import deque
+from typing import Optional
+
+import loguru
+import numpy as np
+
+from .ring_buffer import INT16_SCALE
+from ..config_models import VadConfig
+from ..locales.i18n import gettext as _
+
+logger = loguru.logger
+
+
+def frame_features(frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute per-frame energy and zero-crossing rate.
+
+    Args:
+        frames (np.ndarray): 2-D array shaped (n_frames, frame_length),
+            either int16 PCM or float32 normalized to [-1.0, 1.0].
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: RMS energy in dBFS and zero-crossing rate (0.0 ~ 1.0) of every frame.
+    """
+    if frames.dtype == np.int16:
+        frames = frames * INT16_SCALE
+    energy_db = 10.0 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frames.shape[1] - 1)
+    return energy_db, zcr
+
+
+class VoiceActivitySegmenter:
+    """
+    Turn a continuous PCM stream into utterance-sized chunks.
+
+    A chunk is closed at the first silence (after the hangover) once it is longer than the minimum utterance length,
+    or forcibly at the quietest frame near the end once it reaches the maximum utterance length.
+    Silent spans between utterances are dropped instead of being transcribed.
+    """
+
+    # Frames louder than threshold + this margin count as speech regardless of their zero-crossing rate
+    LOUD_MARGIN_DB = 10.0
+
+    def __init__(self, params: VadConfig, sample_rate: int = 16000):
+        self.params = params
+        self.sample_rate = sample_rate
+        self.frame_length = sample_rate * params.frame_ms // 1000
+        self._derive_frame_counts()
+
+        # Samples that do not fill a whole frame yet
+        self._remainder = np.empty(0, dtype=np.int16)
+        # Stream position (in samples) of the next frame, and of the first frame of the utterance in progress
+        self._position = 0
+        self._start = 0
+        # Stream position right after the last buffered frame
+        self._frames_end = 0
+        # Silent frames kept right before an utterance starts, so the first syllable isn't clipped
+        self._pre_roll: deque[np.ndarray] = deque(maxlen=self._pre_roll_frames)
+        self._frames: list[np.ndarray] = []
+        self._energies: list[float] = []
+        self._speech_frames = 0
+        self._silence_run = 0
+
+    def set_params(self, params: VadConfig):
+        """
+        Apply new parameters while running. The frame length stays, the audio is read in blocks of frames
+        """
+        if params.frame_ms != self.params.frame_ms:
+            logger.warning(_("Changes to vad.frame_ms take effect after a restart"))
+            params = params.model_copy(update={"frame_ms": self.params.frame_ms})
+        self.params = params
+        self._derive_frame_counts()
+        self._pre_roll = deque(self._pre_roll, maxlen=self._pre_roll_frames)
+
+    def _derive_frame_counts(self):
+        params = self.params
+        frame_seconds = self.frame_length / self.sample_rate
+        self._hangover_frames = max(1, round(params.hangover / frame_seconds))
+        self._min_frames = round(params.min_utterance_length / frame_seconds)
+        self._max_frames = max(self._min_frames + 1, round(params.max_utterance_length / frame_seconds))
+        self._min_speech_frames = round(params.min_speech_length / frame_seconds)
+        self._pre_roll_frames = round(params.pre_roll / frame_seconds)
+        # Longest utterance that can be emitted, in samples
+        self.max_samples = self._max_frames * self.frame_length
+
+    @property
+    def in_utterance(self) -> bool:
+        return bool(self._frames)
+
+    def classify(self, frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Classify frames as speech or non-speech.
+
+        :return: Boolean speech mask and energy (dBFS) of every frame
+        """
+        energy_db, zcr = frame_features(frames)
+        threshold = self.params.energy_threshold_db
+        is_speech = ((energy_db > threshold) & (zcr < self.params.zcr_threshold)) | (
+                energy_db > threshold + self.LOUD_MARGIN_DB)
+        return is_speech, energy_db
+
+    def feed(self, pcm: np.ndarray) -> list[tuple[int, int, np.ndarray]]:
+        """
+        Feed PCM samples into the segmenter. The samples are copied, so the caller may reuse the buffer.
+        :param pcm: int16 PCM samples
+        :return: Utterances completed by these samples, as (stream position of the first sample, stream position
+            right after the last sample, int16 PCM)
+        """
+        pcm = np.concatenate((self._remainder, pcm))
+        n_frames = pcm.size // self.frame_length
+        usable = n_frames * self.frame_length
+        self._remainder = pcm[usable:]
+        if not n_frames:
+            return []
+
+        frames = pcm[:usable].reshape(n_frames, self.frame_length)
+        is_speech, energy_db = self.classify(frames)
+
+        utterances = []
+        for frame, speech, energy in zip(frames, is_speech, energy_db):
+            if (utterance := self._step(frame, bool(speech), float(energy))) is not None:
+                utterances.append(utterance)
+            self._position += self.frame_length
+        return utterances
+
+    def flush(self) -> Optional[tuple[int, int, np.ndarray]]:
+        """
+        Close the utterance in progress, e.g. when the stream ends.
+        :return: The pending utterance or None
+        """
+        self._remainder = np.empty(0, dtype=np.int16)
+        return self._close(len(self._frames))
+
+    def _step(self, frame: np.ndarray, speech: bool, energy: float) -> Optional[tuple[int, int, np.ndarray]]:
+        if not self._frames:
+            if not speech:
+                self._pre_roll.append(frame)
+                return None
+            self._start = self._position - len(self._pre_roll) * self.frame_length
+            self._frames.extend(self._pre_roll)
+            self._energies.extend([self.params.energy_threshold_db] * len(self._pre_roll))
+            self._pre_roll.clear()
+
+        if speech:
+            self._silence_run = 0
+            self._speech_frames += 1
+        else:
+            self._silence_run += 1
+
+        # Silent frames are buffered as well, so the utterance stays contiguous stream audio if speech resumes
+        self._frames.append(frame)
+        self._energies.append(energy)
+        self._frames_end = self._position + self.frame_length
+        if self._silence_run > self._hangover_frames:
+            pause = self._silence_run - self._hangover_frames
+            # Closed at the first silence once long enough. Too short ones wait for more speech,
+            # but not once the pause is as long as a whole minimum utterance
+            if len(self._frames) - pause >= self._min_frames or pause >= self._min_frames:
+                return self._close_at_pause(pause)
+            return None
+        if len(self._frames) >= self._max_frames:
+            # Cut at the quietest frame of the last fifth, so a word is less likely to be split in half
+            tail = max(1, len(self._frames) // 5)
+            cut = len(self._frames) - tail + int(np.argmin(self._energies[-tail:])) + 1
+            return self._close(cut)
+        return None
+
+    def _close_at_pause(self, pause: int) -> Optional[tuple[int, int, np.ndarray]]:
+        """
+        Close the utterance before the last `pause` frames, the silence beyond the hangover
+        """
+        utterance = self._close(len(self._frames) - pause)
+        # The pause belongs to no utterance, its end is the pre-roll of the next one
+        self._pre_roll.extend(self._frames)
+        self._frames = []
+        self._energies = []
+        self._speech_frames = 0
+        return utterance
+
+    def _close(self, n_frames: int) -> Optional[tuple[int, int, np.ndarray]]:
+        start = self._start
+        end = self._frames_end - (len(self._frames) - n_frames) * self.frame_length
+        self._start += n_frames * self.frame_length
+        frames, self._frames = self._frames[:n_frames], self._frames[n_frames:]
+        self._energies = self._energies[n_frames:]
+        speech_frames = self._speech_frames
+        self._speech_frames = 0 if not self._frames else self._speech_frames
+        self._silence_run = 0
+        if not frames or speech_frames < self._min_speech_frames:
+            return None
+        return start, end, np.concatenate(frames)
@@ -0,0 +1,131 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import loguru
+import numpy as np
+
+from submaku_stream.base.transcriber import BaseTranscriber, TranscriptSegment
+from submaku_stream.locales.i18n import gettext as _
+from submaku_stream.utils.metrics import ChunkTrace
+from submaku_stream.utils.ring_buffer import INT16_SCALE
+from submaku_stream.utils.text import text_distance
+
+logger = loguru.logger
+
+
+class CascadeRefiner:
+    """
+    Second tier of the cascade: transcribes the chunks of the draft tier again with the larger model, one at a
+    time in the background, and hands over a correction wherever the two transcriptions differ enough.
+
+    Refinements are best effort. Only the newest max_pending chunks wait, older ones keep their draft.
+    """
+
+    def __init__(self, model_task: "asyncio.Task[BaseTranscriber]",
+                 on_correction: Callable[[ChunkTrace, list[TranscriptSegment]], Awaitable[None]],
+                 threshold: float = 0.3, max_pending: int = 4,
+                 draft_busy: Optional[Callable[[], bool]] = None,
+                 on_kept: Optional[Callable[[ChunkTrace], None]] = None):
+        """
+        :param model_task: Task loading the larger transcriber
+        :param on_correction: Coroutine function receiving (trace of the draft, segments of the larger model)
+        :param threshold: Share of differing words from which the draft is corrected, see text_distance()
+        :param max_pending: Chunks waiting to be refined
+        :param draft_busy: Refinements don't start while this returns True, e.g. while the draft tier has chunks
+            to transcribe and both tiers share the CPU
+        :param on_kept: Called with the trace of a draft which stays as it is, because the larger model agrees,
+            is behind or failed
+        """
+        self._model_task = model_task
+        self._on_correction = on_correction
+        self.threshold = threshold
+        self._draft_busy = draft_busy
+        self._on_kept = on_kept
+        # (int16 samples, draft text, trace of the draft)
+        self._pending: deque[tuple[np.ndarray, str, ChunkTrace]] = deque(maxlen=max(1, max_pending))
+        self._wakeup = asyncio.Event()
+        self._running = False
+        # Set once the worker has ended, e.g. because the larger model failed to load
+        self._stopped = False
+
+        self.refined = 0
+        self.corrected = 0
+        self.skipped = 0
+
+    def submit(self, pcm: np.ndarray, trace: ChunkTrace):
+        """
+        Queue a transcribed chunk
+        :param pcm: int16 samples of the chunk, owned by the refiner from now on
+        :param trace: Trace of the chunk, with the segments of the draft
+        """
+        if self._stopped:
+            self._kept(trace)
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.skipped += 1
+            logger.debug(_("Chunk {} left uncorrected, the larger model is behind.").format(
+                self._pending[0][2].index))
+            self._kept(self._pending[0][2])
+        self._pending.append((pcm, "".join(text for _start, _end, text in trace.segments), trace))
+        self._wakeup.set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    async def join(self):
+        """
+        Wait until every queued chunk has been refined, or the worker has ended
+        """
+        while (self._pending or self._running) and not self._stopped:
+            await asyncio.sleep(0.05)
+
+    async def __call__(self):
+        try:
+            await self._run()
+        except Exception as e:
+            # Loading the larger model failed, which main() reports once for every room
+            logger.debug(_("Cascade refiner stopped: {}").format(repr(e)))
+        finally:
+            self._stopped = True
+            # The queued drafts stay as they are
+            while self._pending:
+                self._kept(self._pending.popleft()[2])
+
+    async def _run(self):
+        model = await self._model_task
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                while self._draft_busy and self._draft_busy():
+                    await asyncio.sleep(0.05)
+                if not self._pending:
+                    break
+                pcm, draft, trace = self._pending.popleft()
+                self._running = True
+                try:
+                    await self._refine(model, pcm, draft, trace)
+                except Exception as e:
+                    logger.error(_("Refinement of chunk {} failed: {}").format(trace.index, repr(e)))
+                    self._kept(trace)
+                finally:
+                    self._running = False
+
+    def _kept(self, trace: ChunkTrace):
+        if self._on_kept:
+            self._on_kept(trace)
+
+    async def _refine(self, model: BaseTranscriber, pcm: np.ndarray, draft: str, trace: ChunkTrace):
+        segments = await model.transcribe_segments(pcm.astype(np.float32) * INT16_SCALE)
+        self.refined += 1
+        text = "".join(s.text for s in segments)
+        distance = text_distance(draft, text)
+        if distance < self.threshold or not text.strip():
+            self._kept(trace)
+            return
+        logger.info(_("Chunk {} corrected ({:.0%} differs): {} -> {}").format(
+            trace.index, distance, draft.strip(), text.strip()))
+        self.corrected += 1
+        await self._on_correction(trace, segments)
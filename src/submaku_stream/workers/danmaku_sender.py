@@ -1,93 +1,480 @@
 import asyncio
+import copy
+import heapq
+import itertools
+import json
+import random
 import time
-from asyncio import Queue
-from typing import Union
+from enum import Enum, IntEnum
+from typing import IO, Callable, Optional, Union
 
 import loguru
 from bilibili_api import ResponseCodeException, Danmaku, DmMode
-from httpx import NetworkError
+from bilibili_api.exceptions import ApiException
+from bilibili_api.live import LiveRoom
+from httpx import HTTPStatusError, TransportError
 
+from submaku_stream.config_models import Config
 from submaku_stream.locales.i18n import gettext as _
+from submaku_stream.utils.circuit_breaker import CircuitBreaker
+from submaku_stream.utils.metrics import ChunkTrace
+from submaku_stream.utils.rate_limit import TokenBucket
 from submaku_stream.utils.storage import ConfigStorage, Constants
+from submaku_stream.utils.text import join_texts
 
 logger = loguru.logger
-config = ConfigStorage.get_instance().config
+
+# Error codes of the danmaku API
+CODE_NOT_LOGGED_IN = -101
+CODE_CSRF = -111
+CODE_TOO_FAST = 10030
+CODE_TOO_FAST_REPEATED = 10031
+CODE_TOO_LONG = 1003212
+
+
+class SendFailure(Enum):
+    """
+    What a failed send means for the danmaku
+    """
+    # Transient, the same danmaku is sent again after a backoff
+    RETRY = "retry"
+    # The danmaku itself was rejected, sending it again won't help
+    DROP = "drop"
+    # Nothing can be sent until the cause is fixed, e.g. the credential, sending pauses
+    FATAL = "fatal"
+
+
+def classify_send_error(e: Exception) -> SendFailure:
+    if isinstance(e, ResponseCodeException):
+        if e.code == CODE_TOO_LONG:
+            # Can never succeed, and says nothing about the health of the API
+            return SendFailure.DROP
+        if e.code in (CODE_TOO_FAST, CODE_TOO_FAST_REPEATED):
+            return SendFailure.RETRY
+        if e.code in (CODE_NOT_LOGGED_IN, CODE_CSRF):
+            return SendFailure.FATAL
+        # Blocked words and other rejections of the message
+        return SendFailure.DROP
+    if isinstance(e, HTTPStatusError):
+        status = e.response.status_code
+        if status >= 500 or status == 429:
+            return SendFailure.RETRY
+        # 412 is the platform's risk control blocking the requests for a while
+        return SendFailure.FATAL if status in (401, 403, 412) else SendFailure.DROP
+    if isinstance(e, (TransportError, asyncio.TimeoutError)):
+        return SendFailure.RETRY
+    if isinstance(e, ApiException):
+        # Missing credential fields
+        return SendFailure.FATAL
+    return SendFailure.RETRY
+
+
+class Priority(IntEnum):
+    """
+    Lower values are sent first
+    """
+    PINNED = 0
+    MANUAL = 1
+    SUBTITLE = 2
 
 
 class DanmakuMessage:
-    def __init__(self, danmaku: Danmaku, msg_position: int):
+    def __init__(self, danmaku: Danmaku, msg_position: int, priority: Priority = Priority.SUBTITLE,
+                 max_age: Optional[float] = None, trace: Optional[ChunkTrace] = None,
+                 release_at: Optional[float] = None, raw_text: Optional[str] = None,
+                 text_format: Optional[Callable[[str], str]] = None):
+        """
+        :param danmaku: Danmaku to be sent
+        :param msg_position: Position of the message in the order of creation
+        :param priority: Messages with a higher priority (lower value) are sent first
+        :param max_age: Seconds after which the message is dropped instead of sent, None never expires
+        :param trace: Trace of the chunk the message was made from
+        :param release_at: time.monotonic() before which the message is held back, None sends it right away
+        :param raw_text: Text before formatting
+        :param text_format: Formats raw_text into the danmaku text. Only messages with both can be merged
+        """
         self.danmaku = danmaku
         self.msg_position = msg_position
+        self.priority = priority
+        self.created_at = time.monotonic()
+        self.release_at = release_at
+        # Staleness is counted from the time the message is due
+        self.due_at = max(self.created_at, release_at or 0.0)
+        self.expires_at = self.due_at + max_age if max_age else None
+        # Merged messages carry the traces of every chunk they were made from
+        self.traces: list[ChunkTrace] = [trace] if trace else []
+        self.raw_text = raw_text
+        self.text_format = text_format
+
+    @property
+    def age(self) -> float:
+        """
+        Seconds since the message is due, negative while it's held back
+        """
+        return time.monotonic() - self.due_at
+
+    @property
+    def is_stale(self) -> bool:
+        return self.expires_at is not None and time.monotonic() > self.expires_at
 
     def __str__(self):
         return self.danmaku.text
 
     def __repr__(self):
-        return f"DanmakuMessage(danmaku={self.danmaku}, msg_position={self.msg_position})"
+        return (f"DanmakuMessage(danmaku={self.danmaku}, msg_position={self.msg_position}, "
+                f"priority={self.priority.name})")
+
+
+class DanmakuQueue:
+    """
+    Priority queue of danmaku messages, FIFO within the same priority.
+    Messages with a release time are held back until then.
+    """
+
+    def __init__(self):
+        # Messages that are due: (priority, sequence, message)
+        self._heap: list[tuple[int, int, DanmakuMessage]] = []
+        # Messages held back: (release time, sequence, message)
+        self._delayed: list[tuple[float, int, DanmakuMessage]] = []
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap) + len(self._delayed)
+
+    def put(self, msg: DanmakuMessage):
+        if msg.release_at and msg.release_at > time.monotonic():
+            heapq.heappush(self._delayed, (msg.release_at, next(self._seq), msg))
+        else:
+            heapq.heappush(self._heap, (msg.priority, next(self._seq), msg))
+        self._changed.set()
+
+    def _release_due(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _release_at, seq, msg = heapq.heappop(self._delayed)
+            heapq.heappush(self._heap, (msg.priority, seq, msg))
+
+    def peek(self) -> Optional[DanmakuMessage]:
+        """
+        The next due message, None if there is none
+        """
+        self._release_due()
+        return self._heap[0][2] if self._heap else None
+
+    def pop(self) -> DanmakuMessage:
+        self._release_due()
+        return heapq.heappop(self._heap)[2]
+
+    async def wait(self):
+        """
+        Wait until a message is due
+        """
+        while self.peek() is None:
+            self._changed.clear()
+            timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def oldest_age(self) -> float:
+        """
+        Seconds the most overdue message has been waiting
+        """
+        return max((msg.age for *_rest, msg in self._heap), default=0.0)
 
 
 class DanmakuSendingWorker:
     """
     A worker class that manages danmaku sending process.
+
+    Messages are sent by priority, as fast as the platform's rate limit (a token bucket) allows.
+    Short adjacent subtitles are merged into one danmaku, and subtitles that waited too long are dropped,
+    a late subtitle is worse than a missing one.
+
+    A failed danmaku is retried with a jittered exponential backoff, or given up on right away if the platform
+    rejected the message itself. Sustained failures open a circuit breaker which pauses sending, while new
+    subtitles are shed and the queue stays bounded. Sending resumes by itself once a trial danmaku goes through.
+    Danmaku given up on are written to the dead-letter file.
     """
 
-    def __init__(self):
-        # A queue storing danmaku that await to be sent
-        # TODO priority queue
-        self._msg_queue: Queue[DanmakuMessage] = asyncio.Queue()
+    def __init__(self, live_room: Optional[LiveRoom] = None, display_mode: Optional[str] = None):
+        """
+        :param live_room: Room the danmaku are sent to, defaults to Constants.live_room
+        :param display_mode: Defaults to config.danmaku_display_mode
+        """
+        config = ConfigStorage.get_instance().config
+        self._live_room = live_room
+        self._display_mode = display_mode
+        # Danmaku that await to be sent
+        self._msg_queue = DanmakuQueue()
+        self._bucket = TokenBucket(self._rate(config), config.sender.burst)
+        self._breaker = CircuitBreaker(config.sender.breaker_threshold, config.sender.breaker_cooldown,
+                                       config.sender.breaker_max_cooldown)
+        ConfigStorage.get_instance().subscribe(self._on_config_change)
+        self._dead_letters: Optional[IO[str]] = None
         self._sent_danmaku_amount = 0
-        self._prev_sending_timestamp = 0
+        self._dropped_danmaku_amount = 0
+        self._coalesced_danmaku_amount = 0
+        self._retried_danmaku_amount = 0
+        self._shed_danmaku_amount = 0
+        self._dead_letter_amount = 0
+        self._last_queue_age = 0.0
         self._cur_danmaku_position = 0
 
+    @staticmethod
+    def _rate(config: Config) -> float:
+        return config.sender.rate_limit or (1 / config.sending_delay if config.sending_delay > 0 else float("inf"))
+
+    def _on_config_change(self, _old: Config, new: Config):
+        self._bucket.rate = self._rate(new)
+        self._bucket.capacity = max(1.0, new.sender.burst)
+        self._breaker.threshold = max(1, new.sender.breaker_threshold)
+        self._breaker.cooldown = new.sender.breaker_cooldown
+        self._breaker.max_cooldown = new.sender.breaker_max_cooldown
+        if new.sender.dead_letter_path != _old.sender.dead_letter_path and self._dead_letters:
+            self._dead_letters.close()
+            self._dead_letters = None
+
+    @property
+    def _room_id(self) -> Optional[int]:
+        return getattr(self._live_room or Constants.live_room, "room_display_id", None)
+
     async def _send_danmaku(self, msg: DanmakuMessage):
-        dt = time.time() - self._prev_sending_timestamp
-        if dt < config.sending_delay:
-            time_to_sleep = config.sending_delay - dt
-            logger.info(_("Postpone {:.4f} seconds before sending due to sending delay.").format(time_to_sleep))
-            await asyncio.sleep(time_to_sleep)
-        resp = await Constants.live_room.send_danmaku(msg.danmaku)
-        # Generate a random sleep time to simulate the sending process
-        self._prev_sending_timestamp = time.time()
+        resp = await (self._live_room or Constants.live_room).send_danmaku(msg.danmaku)
+        self._last_queue_age = msg.age
+        for trace in msg.traces:
+            trace.danmaku_done(sent=True)
         logger.success(_("Sent: {}").format(msg))
         logger.debug(resp)
 
+    def _drop(self, msg: DanmakuMessage):
+        self._dropped_danmaku_amount += 1
+        for trace in msg.traces:
+            trace.danmaku_done(sent=False)
+        logger.warning(_("Dropped a danmaku which has waited {:.1f}s: {}").format(msg.age, msg))
+
+    def _give_up(self, msg: DanmakuMessage, reason: str, error: Optional[Exception] = None, attempts: int = 0):
+        """
+        Drop a danmaku which couldn't be sent, and append it to the dead-letter file
+        """
+        self._dropped_danmaku_amount += 1
+        self._dead_letter_amount += 1
+        for trace in msg.traces:
+            trace.danmaku_done(sent=False)
+        logger.warning(_("Gave up on a danmaku ({}): {}").format(reason, msg))
+        path = ConfigStorage.get_instance().config.sender.dead_letter_path
+        if not path:
+            return
+        record = {"time": time.time(), "room": self._room_id, "text": msg.danmaku.text, "priority": msg.priority.name,
+                  "reason": reason, "error": repr(error) if error else None, "attempts": attempts,
+                  "age": round(msg.age, 3)}
+        try:
+            if self._dead_letters is None:
+                self._dead_letters = open(path, "a", encoding="utf-8", buffering=1)
+            self._dead_letters.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(_("Failed to write the dead-letter file: {}").format(repr(e)))
+
+    def _backoff(self, retry: int) -> float:
+        """
+        Seconds before a retry, exponential with jitter so rooms don't retry in lockstep
+        """
+        params = ConfigStorage.get_instance().config.sender
+        delay = min(params.retry_backoff_max, params.retry_backoff_base * 2 ** (retry - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _next_message(self) -> Optional[DanmakuMessage]:
+        """
+        Take the next message to be sent, dropping stale ones and merging the following short subtitles into it
+        """
+        while self._msg_queue.peek() is not None:
+            msg = self._msg_queue.pop()
+            if not msg.is_stale:
+                break
+            self._drop(msg)
+        else:
+            return None
+
+        config = ConfigStorage.get_instance().config
+        if not config.sender.coalesce or not config.max_chars_per_danmaku or msg.priority != Priority.SUBTITLE \
+                or msg.raw_text is None or msg.text_format is None:
+            return msg
+        # The raw texts are merged and formatted as a whole, the format of the first message applies
+        raw_text, text = msg.raw_text, msg.danmaku.text
+        while (following := self._msg_queue.peek()) and following.priority == msg.priority:
+            if following.is_stale:
+                self._drop(self._msg_queue.pop())
+                continue
+            if following.raw_text is None:
+                break
+            merged_raw = join_texts(raw_text, following.raw_text)
+            merged = msg.text_format(merged_raw)
+            if len(merged) > config.max_chars_per_danmaku:
+                break
+            raw_text, text = merged_raw, merged
+            msg.traces += self._msg_queue.pop().traces
+            self._coalesced_danmaku_amount += 1
+        if text != msg.danmaku.text:
+            msg.danmaku = copy.copy(msg.danmaku)
+            msg.danmaku.text = text
+            msg.raw_text = raw_text
+        return msg
+
     async def __call__(self):
+        config = ConfigStorage.get_instance().config
         if not config.should_send_danmaku:
             return
         while True:
-            # Include the normal sending process
-            for t in range(0, config.max_retry_times + 1):
-                if t > 0:
-                    logger.info(_("Retry times: {}").format(t))
-                try:
-                    await self._send_danmaku(await self._msg_queue.get())
-                    break
-                except ResponseCodeException as e:
-                    logger.error(str(e))
-                    # 超出限制长度
-                    if e.code == 1003212:
-                        return
-                except NetworkError as e:
-                    logger.error(str(e))
-                    logger.warning(_("Network error occurred, retrying..."))
-                except Exception as e:
-                    logger.error(repr(e))
-            else:  # If the loop is not broken
-                logger.warning(_("Retry times exceed max_retry_times, so current task is given up."))
+            await self._msg_queue.wait()
+            # Paused while the circuit breaker is open
+            await self._breaker.wait()
+            # Wait for the rate limit before picking the message, so it's as fresh as possible,
+            # and the subtitles arriving meanwhile can be merged into it
+            await self._bucket.wait()
+            msg = self._next_message()
+            if msg is None:
+                continue
+            logger.debug(self.stats())
+            await self._deliver(msg)
+
+    async def _deliver(self, msg: DanmakuMessage):
+        """
+        Send a danmaku, retrying it until it's sent, given up on or stale
+        """
+        max_retry_times = ConfigStorage.get_instance().config.max_retry_times
+        error = None
+        for attempt in range(max_retry_times + 1):
+            if attempt > 0:
+                delay = self._backoff(attempt)
+                logger.info(_("Retry times: {}").format(attempt) + f" ({delay:.1f}s)")
+                self._retried_danmaku_amount += 1
+                await asyncio.sleep(delay)
+                await self._breaker.wait()
+                if msg.is_stale:
+                    self._drop(msg)
+                    return
+            await self._bucket.acquire()
+            try:
+                await self._send_danmaku(msg)
+            except Exception as e:
+                error = e
+                failure = classify_send_error(e)
+                logger.error(_("Failed to send a danmaku ({}): {}").format(failure.value, repr(e)))
+                if failure == SendFailure.DROP:
+                    self._give_up(msg, "rejected", e, attempt + 1)
+                    return
+                if isinstance(e, ResponseCodeException) and e.code in (CODE_TOO_FAST, CODE_TOO_FAST_REPEATED):
+                    # The platform's limit was hit anyway, e.g. by danmaku sent from elsewhere
+                    self._bucket.drain()
+                if self._breaker.failure(fatal=failure == SendFailure.FATAL):
+                    logger.warning(_("Sending paused for {:.1f}s after {} failures in a row.").format(
+                        self._breaker.remaining, self._breaker.failures))
+                if failure == SendFailure.FATAL:
+                    self._give_up(msg, "fatal", e, attempt + 1)
+                    return
+            else:
+                self._sent_danmaku_amount += 1
+                if self._breaker.success():
+                    logger.success(_("Sending resumed."))
                 return
-            self._sent_danmaku_amount += 1
+        logger.warning(_("Retry times exceed max_retry_times, so current task is given up."))
+        self._give_up(msg, "retries_exhausted", error, max_retry_times + 1)
 
-    async def put_danmaku(self, msg: Union[DanmakuMessage, str]):
+    async def put_danmaku(self, msg: Union[DanmakuMessage, str], priority: Priority = Priority.SUBTITLE,
+                          trace: Optional[ChunkTrace] = None, spoken_at: Optional[float] = None,
+                          raw_text: Optional[str] = None, text_format: Optional[Callable[[str], str]] = None):
         """
         Put a danmaku message into the queue, and the message will be sent later.
+        Nothing is queued if sending danmaku is disabled.
         :param msg: A DanmakuMessage object or a string.
+        :param priority: Priority of a string message. Only subtitles expire after sender.max_age seconds.
+        :param trace: Trace of the chunk a string message was made from
+        :param spoken_at: Wall clock time (time.time()) the audio of a subtitle was received.
+            The subtitle is released sender.release_offset seconds later, paced with the speech.
+        :param raw_text: Text of a string message before formatting
+        :param text_format: Formats raw_text into the string message. Subtitles with both may be merged into one
+            danmaku with the adjacent ones
         """
+        config = ConfigStorage.get_instance().config
+        if not config.should_send_danmaku:
+            return
         if isinstance(msg, str):
-            sematic_code = ConfigStorage.get_instance().config.danmaku_display_mode
-            msg = DanmakuMessage(Danmaku(text=msg, mode=DmMode[sematic_code].value), self._cur_danmaku_position)
+            sematic_code = self._display_mode or config.danmaku_display_mode
+            max_age = config.sender.max_age if priority == Priority.SUBTITLE else None
+            release_at = None
+            if spoken_at is not None and config.sender.release_offset > 0:
+                release_at = time.monotonic() + spoken_at + config.sender.release_offset - time.time()
+            msg = DanmakuMessage(Danmaku(text=msg, mode=DmMode[sematic_code].value), self._cur_danmaku_position,
+                                 priority, max_age, trace, release_at, raw_text, text_format)
             self._cur_danmaku_position += 1
-        await self._msg_queue.put(msg)
+        for t in msg.traces:
+            t.hold()
+        # Shed new subtitles rather than piling them up while nothing can be sent
+        if len(self._msg_queue) >= config.sender.max_queue > 0 or (
+                msg.priority == Priority.SUBTITLE and self._breaker.state == CircuitBreaker.OPEN):
+            self._shed_danmaku_amount += 1
+            self._give_up(msg, "shed")
+            return
+        self._msg_queue.put(msg)
 
     @property
     def sent_danmaku_amount(self):
         return self._sent_danmaku_amount
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._msg_queue)
+
+    @property
+    def dropped_danmaku_amount(self):
+        return self._dropped_danmaku_amount
+
+    @property
+    def retried_danmaku_amount(self):
+        return self._retried_danmaku_amount
+
+    @property
+    def shed_danmaku_amount(self):
+        return self._shed_danmaku_amount
+
+    @property
+    def dead_letter_amount(self):
+        return self._dead_letter_amount
+
+    @property
+    def circuit_open(self) -> bool:
+        """
+        Whether sending is paused by the circuit breaker
+        """
+        return self._breaker.state != CircuitBreaker.CLOSED
+
+    @property
+    def queue_age(self) -> float:
+        """
+        Seconds the oldest queued danmaku has been waiting
+        """
+        return self._msg_queue.oldest_age
+
+    @property
+    def last_queue_age(self) -> float:
+        """
+        Seconds the last sent danmaku waited in the queue
+        """
+        return self._last_queue_age
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self._msg_queue),
+            "queue_age": round(self.queue_age, 3),
+            "last_queue_age": round(self._last_queue_age, 3),
+            "sent": self._sent_danmaku_amount,
+            "dropped": self._dropped_danmaku_amount,
+            "coalesced": self._coalesced_danmaku_amount,
+            "retried": self._retried_danmaku_amount,
+            "shed": self._shed_danmaku_amount,
+            "dead_letters": self._dead_letter_amount,
+            "circuit": self._breaker.state,
+        }
@@ -0,0 +1,309 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Literal, Optional
+
+import loguru
+
+from submaku_stream.locales.i18n import gettext as _
+from submaku_stream.utils.audio import AudioChunk
+
+logger = loguru.logger
+
+OverloadPolicy = Literal["block", "drop_oldest", "drop_newest"]
+
+# Marks a chunk index whose result will never come, so the reorder buffer can skip it
+_DROPPED = object()
+
+
+class FairGate:
+    """
+    Shares a limited number of slots (e.g. concurrent inferences on one model) between several queues,
+    with deficit round robin: each queue is credited weight * quantum per round and pays the cost of each request,
+    so busy queues can't starve the others and weights set the share of each queue.
+    """
+
+    def __init__(self, capacity: int = 1, quantum: float = 1.0):
+        """
+        :param capacity: Number of slots
+        :param quantum: Credit per round for a queue of weight 1, in the unit of the request costs
+        """
+        self._capacity = max(1, capacity)
+        self._quantum = quantum
+        self._in_use = 0
+        self._queues: dict[Hashable, deque[tuple[float, asyncio.Future]]] = {}
+        self._weights: dict[Hashable, float] = {}
+        self._deficits: dict[Hashable, float] = {}
+        # Keys of the queues with waiting requests, in round robin order
+        self._active: deque[Hashable] = deque()
+
+    def set_weight(self, key: Hashable, weight: float):
+        self._weights[key] = max(weight, 1e-3)
+
+    def waiting(self, key: Hashable) -> int:
+        return len(self._queues.get(key, ()))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key: Hashable, cost: float = 1.0) -> AsyncIterator[None]:
+        """
+        Hold a slot for the enclosed block
+        :param key: Queue the request belongs to
+        :param cost: Cost of the request, e.g. seconds of audio
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(key, deque())
+        queue.append((cost, future))
+        if key not in self._active:
+            self._active.append(key)
+            self._deficits[key] = 0.0
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted in the meantime
+                self._release()
+            elif (cost, future) in queue:
+                queue.remove((cost, future))
+                if not queue:
+                    self._active.remove(key)
+                self._dispatch()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self._in_use -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._in_use < self._capacity and self._active:
+            key = self._active[0]
+            queue = self._queues[key]
+            cost, future = queue[0]
+            if self._deficits[key] < cost:
+                self._deficits[key] += self._quantum * self._weights.get(key, 1.0)
+                self._active.rotate(-1)
+                continue
+            queue.popleft()
+            self._deficits[key] -= cost
+            if not queue:
+                # An idle queue doesn't save up credit
+                self._active.popleft()
+            if future.done():
+                continue
+            self._in_use += 1
+            future.set_result(None)
+
+
+class TranscriptionScheduler:
+    """
+    Runs transcription jobs with bounded concurrency and a bounded backlog,
+    and hands their results over strictly in chunk order.
+    """
+
+    def __init__(self,
+                 job: Callable[[int, AudioChunk], Awaitable[Any]],
+                 on_result: Callable[[int, Any], Awaitable[None]],
+                 concurrency: int = 1,
+                 max_backlog: int = 4,
+                 overload_policy: OverloadPolicy = "block",
+                 gate: Optional[FairGate] = None,
+                 gate_key: Hashable = None,
+                 max_lag: float = 0):
+        """
+        :param job: Coroutine function transcribing one chunk, called with (chunk index, audio chunk)
+        :param on_result: Coroutine function receiving (chunk index, job result), always called in chunk order
+        :param concurrency: Max number of jobs running at the same time
+        :param max_backlog: Max number of chunks waiting for a free job slot
+        :param overload_policy: What to do when the backlog is full.
+            "block" makes submit() wait, "drop_oldest" discards the oldest waiting chunk,
+            "drop_newest" discards the submitted chunk.
+        :param gate: Shared slots the jobs have to acquire first, e.g. when several schedulers use one model
+        :param gate_key: Queue of this scheduler in the gate
+        :param max_lag: Seconds. Chunks which have waited longer than this when their turn comes are dropped,
+            0 means never
+        """
+        self._job = job
+        self._on_result = on_result
+        self._concurrency = max(1, concurrency)
+        self._max_backlog = max(1, max_backlog)
+        self._overload_policy = overload_policy
+        self._gate = gate
+        self._gate_key = gate_key
+        self._max_lag = max_lag
+
+        # Chunks waiting for a job slot: (chunk index, audio chunk, enqueue timestamp)
+        self._backlog: deque[tuple[int, AudioChunk, float]] = deque()
+        self._cond = asyncio.Condition()
+        # Enqueue timestamps of the chunks being transcribed
+        self._in_flight: dict[int, float] = {}
+        # Reorder buffer: finished results waiting for the earlier chunks
+        self._results: dict[int, Any] = {}
+        self._emit_lock = asyncio.Lock()
+        self._next_index = 0
+        self._submitted = 0
+        self._workers: list[asyncio.Task] = []
+
+        self._dropped_chunks = 0
+        self._completed_chunks = 0
+        self._last_lag = 0.0
+
+    def start(self):
+        """
+        Spawn the job workers. Must be called from a running event loop.
+        """
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _i in range(self._concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def submit(self, chunk: AudioChunk) -> int:
+        """
+        Submit an audio chunk. Depending on the overload policy this may wait for free backlog space.
+        Dropped chunks are released.
+        :return: Index assigned to the chunk
+        """
+        self.start()
+        index = self._submitted
+        self._submitted += 1
+        chunk.trace.index = index
+        chunk.trace.mark("enqueued")
+        async with self._cond:
+            if len(self._backlog) >= self._max_backlog:
+                if self._overload_policy == "block":
+                    await self._cond.wait_for(lambda: len(self._backlog) < self._max_backlog)
+                elif self._overload_policy == "drop_newest":
+                    logger.warning(_("Transcription backlog is full, chunk {} is dropped.").format(index))
+                    self._skip(index)
+                    chunk.trace.finish("dropped")
+                    chunk.release()
+                    return index
+                else:
+                    dropped_index, dropped_chunk, _t = self._backlog.popleft()
+                    logger.warning(_("Transcription backlog is full, chunk {} is dropped.").format(dropped_index))
+                    self._skip(dropped_index)
+                    dropped_chunk.trace.finish("dropped")
+                    dropped_chunk.release()
+            self._backlog.append((index, chunk, time.time()))
+            self._cond.notify_all()
+        return index
+
+    async def join(self):
+        """
+        Wait until every submitted chunk has been handed over or dropped.
+        """
+        while self._next_index < self._submitted:
+            await asyncio.sleep(0.05)
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._backlog)
+                index, chunk, enqueued_at = self._backlog.popleft()
+                self._in_flight[index] = enqueued_at
+                # Backlog space is freed, wake up the blocked submitter
+                self._cond.notify_all()
+            try:
+                async with self._gate.slot(self._gate_key, chunk.duration) if self._gate \
+                        else contextlib.nullcontext():
+                    if self._max_lag and (lag := time.time() - enqueued_at) > self._max_lag:
+                        logger.warning(_("Chunk {} has waited {:.1f}s, dropped.").format(index, lag))
+                        self._dropped_chunks += 1
+                        chunk.trace.finish("dropped")
+                        chunk.release()
+                        result = _DROPPED
+                    else:
+                        result = await self._job(index, chunk)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(repr(e))
+                # The job may have failed before giving the samples back, release() is a no-op otherwise
+                chunk.trace.finish("error")
+                chunk.release()
+                result = _DROPPED
+            finally:
+                self._last_lag = time.time() - self._in_flight.pop(index)
+            await self._complete(index, result)
+
+    def _skip(self, index: int):
+        # A backlog only overflows while earlier chunks are unfinished, so finishing them drains this mark as well
+        self._dropped_chunks += 1
+        self._results[index] = _DROPPED
+
+    async def _complete(self, index: int, result):
+        self._results[index] = result
+        async with self._emit_lock:
+            while self._next_index in self._results:
+                ready = self._results.pop(self._next_index)
+                self._next_index += 1
+                if ready is _DROPPED:
+                    continue
+                self._completed_chunks += 1
+                try:
+                    await self._on_result(self._next_index - 1, ready)
+                except Exception as e:
+                    logger.error(repr(e))
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of chunks waiting for a job slot
+        """
+        return len(self._backlog)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of chunks being transcribed
+        """
+        return len(self._in_flight)
+
+    @property
+    def reorder_depth(self) -> int:
+        """
+        Number of finished chunks held back until the earlier chunks are finished
+        """
+        return len(self._results)
+
+    @property
+    def lag(self) -> float:
+        """
+        Seconds since the oldest unfinished chunk was submitted
+        """
+        timestamps = [t for _i, _c, t in self._backlog] + list(self._in_flight.values())
+        return time.time() - min(timestamps) if timestamps else 0.0
+
+    @property
+    def last_lag(self) -> float:
+        """
+        Seconds between submitting and finishing the most recently finished chunk
+        """
+        return self._last_lag
+
+    @property
+    def dropped_chunks(self) -> int:
+        return self._dropped_chunks
+
+    @property
+    def completed_chunks(self) -> int:
+        return self._completed_chunks
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "reorder_depth": self.reorder_depth,
+            "lag": self.lag,
+            "last_lag": self.last_lag,
+            "dropped_chunks": self.dropped_chunks,
+            "completed_chunks": self.completed_chunks,
+        }
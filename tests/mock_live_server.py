@@ -0,0 +1,241 @@
+"""
+Local mock of the bilibili live APIs the program calls: room id resolution, stream URLs and sending danmaku
+
+Run it standalone and point config.transport.api_base at it:
+
+    python tests/mock_live_server.py --port 8099 --error-rate 0.05 --rate-limit 1
+
+or benchmark the send path against it, pooled transport vs a new connection per request,
+and the danmaku sender with its rate limit and retries:
+
+    python tests/mock_live_server.py --bench 200 --latency 0.02 --error-rate 0.1
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from urllib.parse import parse_qs
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from submaku_stream.config_models import TransportConfig  # noqa: E402
+from submaku_stream.constants import CONFIG_PATH, CREDENTIAL_PATH  # noqa: E402
+from submaku_stream.utils.http_server import HttpRequest, HttpResponse, HttpServer  # noqa: E402
+
+# Error codes of the real API
+CODE_CSRF = -111
+CODE_TOO_FAST = 10030
+CODE_TOO_LONG = 1003212
+
+
+class MockLiveServer(HttpServer):
+    """
+    Answers like api.live.bilibili.com, with configurable latency, rate limit and injected failures.
+    Every danmaku received is recorded.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = 0.0, max_length: int = 40, stream_urls: list[str] = None):
+        """
+        :param latency: Seconds every response is delayed by
+        :param error_rate: Share of the sends failing with an HTTP 500 or a server-side error code
+        :param rate_limit: Danmaku per second accepted per room, faster ones get CODE_TOO_FAST. 0 means unlimited
+        :param max_length: Longer danmaku get CODE_TOO_LONG
+        :param stream_urls: Returned by playUrl, after a first URL which the program skips
+        """
+        super().__init__(host, port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_length = max_length
+        self.stream_urls = stream_urls or ["http://127.0.0.1:1/stream.flv"]
+        # (time received, room id, text)
+        self.received: list[tuple[float, int, str]] = []
+        self.rejected: dict[int, int] = {}
+        self.requests = 0
+        self.connections = 0
+        self._last_send: dict[int, float] = {}
+        self.route("/room/v1/Room/room_init", self._room_init)
+        self.route("/xlive/web-room/v1/playUrl/playUrl", self._play_url)
+        self.route("/msg/send", self._send, methods=("POST",))
+        self.route("/mock/stats", self._stats)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        await super()._serve(reader, writer)
+
+    @staticmethod
+    def _json(code: int = 0, data=None, message: str = "0") -> HttpResponse:
+        return HttpResponse(body=json.dumps({"code": code, "message": message, "data": data}).encode(),
+                            content_type="application/json; charset=utf-8")
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _room_init(self, request: HttpRequest) -> HttpResponse:
+        await self._delay()
+        return self._json(data={"room_id": int(request.query.get("id", ["0"])[0])})
+
+    async def _play_url(self, _request: HttpRequest) -> HttpResponse:
+        await self._delay()
+        return self._json(data={"durl": [{"url": url} for url in ["forbidden"] + self.stream_urls]})
+
+    async def _send(self, request: HttpRequest) -> HttpResponse:
+        await self._delay()
+        form = {k: v[0] for k, v in parse_qs(request.body.decode()).items()}
+        cookies = dict(c.strip().split("=", 1) for c in request.headers.get("cookie", "").split(";") if "=" in c)
+        room_id = int(form.get("roomid", 0))
+        code = 0
+        if not form.get("csrf") or form.get("csrf") != cookies.get("bili_jct"):
+            code = CODE_CSRF
+        elif len(form.get("msg", "")) > self.max_length:
+            code = CODE_TOO_LONG
+        elif self.rate_limit and time.monotonic() - self._last_send.get(room_id, -1e9) < 1 / self.rate_limit:
+            code = CODE_TOO_FAST
+        elif random.random() < self.error_rate:
+            if random.random() < 0.5:
+                self.rejected[500] = self.rejected.get(500, 0) + 1
+                return HttpResponse(500)
+            code = CODE_TOO_FAST
+        if code:
+            self.rejected[code] = self.rejected.get(code, 0) + 1
+            return self._json(code, message="mock error")
+        self._last_send[room_id] = time.monotonic()
+        self.received.append((time.time(), room_id, form.get("msg", "")))
+        return self._json(data={"mode_info": {"mode": int(form.get("mode", 1))}})
+
+    async def _stats(self, _request: HttpRequest) -> HttpResponse:
+        return HttpResponse(body=json.dumps(self.stats()).encode(), content_type="application/json")
+
+    def stats(self) -> dict:
+        return {"received": len(self.received), "rejected": self.rejected, "requests": self.requests,
+                "connections": self.connections}
+
+
+def _percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def bench_transport(server: MockLiveServer, n: int, concurrency: int, pooled: bool) -> dict:
+    """
+    Send n danmaku straight through the transport, without the sender's rate limit
+    """
+    import bilibili_api
+    from submaku_stream.utils.transport import HttpTransport, PooledLiveRoom
+
+    credential = bilibili_api.Credential("mock-sessdata", "mock-csrf")
+    params = TransportConfig(api_base=server.url, max_connections=concurrency, max_keepalive_connections=concurrency)
+    connections_before, received_before = server.connections, len(server.received)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    shared = HttpTransport(params)
+
+    async def send_one(i: int):
+        # Without pooling every send gets a new client, as a connection per request
+        transport = shared if pooled else HttpTransport(params)
+        room = PooledLiveRoom(1000 + i % 4, credential, transport)
+        room._room_id = room.room_display_id
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                await room.send_danmaku(bilibili_api.Danmaku(f"bench {i}"))
+            except (bilibili_api.ResponseCodeException, httpx.HTTPError):
+                pass
+            latencies.append(time.perf_counter() - t0)
+        if not pooled:
+            await transport.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(send_one(i) for i in range(n)))
+    wall = time.perf_counter() - t0
+    await shared.close()
+    return {"mode": "pooled" if pooled else "per_request", "sent": len(server.received) - received_before,
+            "sends_per_second": round(n / wall, 1), "p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+            "connections": server.connections - connections_before}
+
+
+async def bench_sender(server: MockLiveServer, n: int, rate: float) -> dict:
+    """
+    Queue n subtitles into the danmaku sender and let it send them to the mock server with its rate limit,
+    coalescing and retries
+    """
+    import bilibili_api
+    from submaku_stream.utils.storage import ConfigStorage, Constants
+    from submaku_stream.utils.transport import HttpTransport, PooledLiveRoom
+    from submaku_stream.workers.danmaku_sender import DanmakuSendingWorker
+
+    config = ConfigStorage.get_instance().config
+    config.should_send_danmaku = True
+    config.sender.rate_limit = rate
+    config.sender.burst = 1
+    config.sender.release_offset = 0
+    config.transport.api_base = server.url
+    Constants.live_room = PooledLiveRoom(2000, bilibili_api.Credential("mock-sessdata", "mock-csrf"),
+                                         HttpTransport(config.transport))
+    worker = DanmakuSendingWorker()
+    task = asyncio.create_task(worker())
+    received_before = len(server.received)
+    t0 = time.perf_counter()
+    for i in range(n):
+        await worker.put_danmaku(f"subtitle {i}")
+    while worker.queue_depth and not task.done():
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - t0
+    task.cancel()
+    return {"mode": "sender", "queued": n, "sent": worker.sent_danmaku_amount,
+            "received": len(server.received) - received_before, "dropped": worker.dropped_danmaku_amount,
+            "rejected": dict(server.rejected), "seconds": round(wall, 2)}
+
+
+async def run(args: argparse.Namespace):
+    server = MockLiveServer(args.host, args.port, args.latency, args.error_rate, args.rate_limit,
+                            stream_urls=args.stream_url)
+    await server.start()
+    if not args.bench:
+        print(f"Mock live API on {server.url}", file=sys.stderr)
+        await asyncio.Event().wait()
+    results = [await bench_transport(server, args.bench, args.concurrency, pooled=True),
+               await bench_transport(server, args.bench, args.concurrency, pooled=False)]
+    if not args.no_sender:
+        from submaku_stream.utils.storage import ConfigStorage
+        ConfigStorage.load(Path(args.config) / CONFIG_PATH.name, Path(args.config) / CREDENTIAL_PATH.name)
+        results.append(await bench_sender(server, min(args.bench, 50), args.sender_rate))
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Defaults to 8099, or any free port for --bench")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the sends that fail")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Danmaku per second accepted per room")
+    parser.add_argument("--stream-url", action="append", help="Stream URL returned by playUrl, repeatable")
+    parser.add_argument("--bench", type=int, default=0, help="Benchmark this many sends and exit")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent sends of the transport benchmark")
+    parser.add_argument("--sender-rate", type=float, default=20.0, help="Rate limit of the sender benchmark")
+    parser.add_argument("--no-sender", action="store_true", help="Skip the sender benchmark")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH.parent), help="Config base folder, for the sender benchmark")
+    args = parser.parse_args()
+    if args.port is None:
+        args.port = 0 if args.bench else 8099
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
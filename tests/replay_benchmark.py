@@ -0,0 +1,275 @@
+"""
+Offline replay benchmark of the full subtitle pipeline
+
+Replays a local recording through process_audio_segments, the scheduler, the real process_worker / text handler chain
+and the danmaku sender, with Constants.live_room replaced by a stub recording the danmaku instead of sending them.
+Every model / backend / segment length combination runs in its own process, so peak RSS is measured per setting.
+
+    python tests/replay_benchmark.py recording.wav --models tiny base --backends torch torch_int8 \\
+        --segment-lengths 3 5 --save-baseline baseline.json
+    python tests/replay_benchmark.py recording.wav --models tiny --compare baseline.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+from anyio import EndOfStream
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from submaku_stream.__main__ import process_worker  # noqa: E402
+from submaku_stream.constants import CONFIG_PATH, CREDENTIAL_PATH  # noqa: E402
+from submaku_stream.handlers.text_handlers import TextFormatterHandler  # noqa: E402
+from submaku_stream.locales.i18n import I18n  # noqa: E402
+from submaku_stream.utils.audio import process_audio_segments  # noqa: E402
+from submaku_stream.utils.metrics import MetricsRegistry, Tracer  # noqa: E402
+from submaku_stream.utils.storage import ConfigStorage, Constants  # noqa: E402
+from submaku_stream.workers.danmaku_sender import DanmakuSendingWorker  # noqa: E402
+from submaku_stream.workers.scheduler import TranscriptionScheduler  # noqa: E402
+
+SAMPLE_RATE = 16000
+# Lower is better for all of them
+COMPARED_METRICS = ("rtf", "e2e_p50", "e2e_p95", "peak_rss_mb")
+
+
+class RecordingLiveRoom:
+    """
+    Stands in for bilibili_api.live.LiveRoom, records the danmaku instead of sending them
+    """
+
+    def __init__(self):
+        self.sent: list[tuple[float, str]] = []
+
+    async def send_danmaku(self, danmaku):
+        self.sent.append((time.time(), danmaku.text))
+        return {"code": 0}
+
+
+class PcmFileIngest:
+    """
+    Reads a WAV or raw s16le mono 16kHz PCM file in place of ffmpeg, optionally paced at real time
+    """
+
+    def __init__(self, path: str, realtime: bool = False):
+        if path.endswith(".pcm"):
+            self.pcm = np.fromfile(path, dtype=np.int16)
+        else:
+            self.pcm = read_wav(path)
+        self.data = self.pcm.tobytes()
+        self.realtime = realtime
+        self.position = 0
+        self.t0 = None
+
+    async def readinto(self, buffer: memoryview) -> int:
+        if self.t0 is None:
+            self.t0 = time.time()
+        n = min(len(buffer), len(self.data) - self.position)
+        buffer[:n] = self.data[self.position:self.position + n]
+        self.position += n
+        if self.realtime:
+            # Hand the chunk over once it would have been fully received from a live stream
+            await asyncio.sleep(max(0.0, self.t0 + self.position / 2 / SAMPLE_RATE - time.time()))
+        return n
+
+    async def close(self):
+        pass
+
+
+def read_wav(path: str) -> np.ndarray:
+    """
+    Read a WAV file as int16 mono 16kHz, downmixing and resampling if necessary
+    """
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit WAV files are supported, use --ffmpeg for other formats")
+        channels, rate = f.getnchannels(), f.getframerate()
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+    audio = pcm.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE:
+        t = np.arange(int(audio.size * SAMPLE_RATE / rate)) * rate / SAMPLE_RATE
+        audio = np.interp(t, np.arange(audio.size), audio)
+    return audio.astype(np.int16)
+
+
+async def run_one(args: argparse.Namespace) -> dict:
+    """
+    Replay the recording once with the settings given on the command line
+    """
+    storage = ConfigStorage.load(Path(args.config) / CONFIG_PATH.name, Path(args.config) / CREDENTIAL_PATH.name)
+    config = storage.config
+    config.model_name = args.models[0]
+    config.inference_backend = args.backends[0]
+    config.segment_time_length = args.segment_lengths[0]
+    config.segmentation_mode = "fixed"
+    config.transcription_mode = "chunked"
+    config.should_send_danmaku = True
+    if args.no_rate_limit:
+        config.sending_delay = 0
+        config.sender.rate_limit = 0
+    # Keep every sample for the percentiles
+    MetricsRegistry.get_instance().window = 1_000_000
+    tracer = Tracer.get_instance()
+    I18n.get_instance().set_locale(config.program_display_language)
+    room = RecordingLiveRoom()
+    Constants.live_room = room
+
+    from submaku_stream.transcribers.factory import load_local_whisper
+    t0 = time.time()
+    model = load_local_whisper(config)
+    load_seconds = time.time() - t0
+    model.transcribe_sync(np.zeros(SAMPLE_RATE, dtype=np.float32))
+    if config.inference_batch_size > 1:
+        from submaku_stream.transcribers.batched import BatchedWhisper
+        model = BatchedWhisper(model, config.inference_batch_size, config.inference_batch_wait_ms)
+
+    sending_worker = DanmakuSendingWorker()
+    sending_task = asyncio.create_task(sending_worker())
+
+    async def deliver(_index, result):
+        danmaku, trace = result
+        text_format = TextFormatterHandler(trace.index).format
+        for text, spoken_at, raw in danmaku:
+            await sending_worker.put_danmaku(text, trace=trace, spoken_at=spoken_at, raw_text=raw,
+                                             text_format=text_format)
+        trace.delivered()
+
+    async def job(index, chunk):
+        return await process_worker(model, chunk, index), chunk.trace
+
+    scheduler = TranscriptionScheduler(job, deliver, concurrency=config.scheduler.concurrency,
+                                       max_backlog=config.scheduler.max_backlog,
+                                       overload_policy=config.scheduler.overload_policy)
+    scheduler.start()
+
+    if args.ffmpeg:
+        config.ingest.realtime = args.realtime
+        config.ingest.max_resolve_attempts = 1
+        ingest = None
+    else:
+        ingest = PcmFileIngest(args.input, args.realtime)
+    t0 = time.time()
+    audio_seconds = 0.0
+    try:
+        async for chunk in process_audio_segments(str(Path(args.input).resolve()),
+                                                  chunk_duration=config.segment_time_length,
+                                                  buffer_slots=config.scheduler.max_backlog
+                                                  + config.scheduler.concurrency + 1,
+                                                  ingest_params=config.ingest, ingest=ingest):
+            audio_seconds += chunk.duration
+            await scheduler.submit(chunk)
+    except EndOfStream:
+        pass
+    await scheduler.join()
+    # Let the sender drain, stale subtitles are dropped on the way
+    while sending_worker.queue_depth and not sending_task.done():
+        await asyncio.sleep(0.05)
+    wall_seconds = time.time() - t0
+    sending_task.cancel()
+
+    e2e = tracer.registry.histogram("submaku_end_to_end_seconds", "").quantiles((0.5, 0.95, 0.99))
+    inference = tracer.registry.histogram("submaku_inference_seconds", "")
+    return {
+        "model": config.model_name,
+        "backend": config.inference_backend,
+        "segment_length": config.segment_time_length,
+        "load_seconds": round(load_seconds, 3),
+        "audio_seconds": round(audio_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "rtf": round(inference.sum / audio_seconds, 4) if audio_seconds else 0.0,
+        "e2e_p50": round(e2e.get(0.5, 0.0), 4),
+        "e2e_p95": round(e2e.get(0.95, 0.0), 4),
+        "e2e_p99": round(e2e.get(0.99, 0.0), 4),
+        "chunks": scheduler.completed_chunks + scheduler.dropped_chunks,
+        "chunks_dropped": scheduler.dropped_chunks,
+        "danmaku_sent": len(room.sent),
+        "danmaku_dropped": sending_worker.dropped_danmaku_amount,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def setting_key(result: dict) -> str:
+    return f"{result['model']}/{result['backend']}/{result['segment_length']}"
+
+
+def run_matrix(args: argparse.Namespace) -> list[dict]:
+    results = []
+    for model, backend, segment_length in itertools.product(args.models, args.backends, args.segment_lengths):
+        cmd = [sys.executable, __file__, args.input, "--run-one", "-c", args.config,
+               "--models", model, "--backends", backend, "--segment-lengths", str(segment_length)]
+        cmd += [flag for flag, enabled in (("--ffmpeg", args.ffmpeg), ("--realtime", args.realtime),
+                                           ("--no-rate-limit", args.no_rate_limit)) if enabled]
+        print(f"Running {model}/{backend}/{segment_length}s ...", file=sys.stderr)
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            print(f"{model}/{backend}/{segment_length}s failed with exit code {proc.returncode}", file=sys.stderr)
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    :return: Regressions, metrics more than tolerance worse than the baseline
+    """
+    baseline_by_key = {setting_key(b): b for b in baseline}
+    regressions = []
+    for result in results:
+        if (base := baseline_by_key.get(setting_key(result))) is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if base.get(metric) and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{setting_key(result)} {metric}: {base[metric]} -> {result[metric]}")
+    return regressions
+
+
+def print_table(results: list[dict]):
+    columns = ("model", "backend", "segment_length", "rtf", "e2e_p50", "e2e_p95", "e2e_p99",
+               "chunks", "chunks_dropped", "danmaku_sent", "danmaku_dropped", "peak_rss_mb")
+    print(" ".join(f"{c:>15}" for c in columns))
+    for result in results:
+        print(" ".join(f"{result[c]:>15}" for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Recording to replay, WAV or raw s16le 16kHz mono .pcm")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH.parent), help="Config base folder")
+    parser.add_argument("--models", nargs="+", default=["base"])
+    parser.add_argument("--backends", nargs="+", default=["torch"], choices=["torch", "torch_int8"])
+    parser.add_argument("--segment-lengths", nargs="+", type=int, default=[5])
+    parser.add_argument("--ffmpeg", action="store_true", help="Decode the input with ffmpeg instead of reading it")
+    parser.add_argument("--realtime", action="store_true", help="Feed the audio at real-time pace (ffmpeg -re)")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Send danmaku without the rate limit")
+    parser.add_argument("--save-baseline", help="Save the results as the JSON baseline")
+    parser.add_argument("--compare", help="Compare with a JSON baseline, exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(asyncio.run(run_one(args))))
+        return
+
+    results = run_matrix(args)
+    print_table(results)
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=2))
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""
+Soak test of the full pipeline against a fake live room on localhost
+
+Serves a local media file in a loop as a live FLV (or HLS) stream, plus the mock live APIs of
+tests/mock_live_server.py, and runs the __main__ pipeline against them for a set duration: ffmpeg ingest,
+transcription with the configured model, text handlers and the danmaku sender over the pooled transport.
+RSS, asyncio tasks, open file descriptors, threads, child processes and the queue depths are sampled at intervals.
+Stream outages and send errors are injected, and the danmaku received afterwards show whether throughput recovers.
+
+The run fails if one of the resources grows beyond its limit between the start and the end of the run (after the
+warmup), a queue grows beyond its limit, or no danmaku arrives within --recovery-timeout after an outage.
+
+    python tests/soak_test.py recording.flv --duration 14400 --outage-every 600 --send-error-rate 0.05 \\
+        --report soak.jsonl
+
+The media is sent at its own bitrate: WAV and raw s16le mono 16kHz .pcm files are paced by their sample rate,
+other formats by --bitrate, or by the duration ffprobe reports. HLS (--format hls) needs an MPEG-TS file.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from mock_live_server import MockLiveServer  # noqa: E402
+from submaku_stream.constants import CONFIG_PATH, CREDENTIAL_PATH  # noqa: E402
+
+ROOM_ID = 1000
+FLV_HEADER_SIZE = 13
+# Seconds of media sent ahead of real time, like a CDN filling the player's buffer
+LEAD = 1.0
+
+
+class FakeStreamServer:
+    """
+    Serves a media file in a loop as if it was live: /live.flv as one endless HTTP response,
+    /live.m3u8 as a live HLS playlist whose segments all are the file.
+    During an outage the open streams are cut and new requests get a 503.
+    """
+
+    def __init__(self, media: Path, byte_rate: float, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param media: Media file served in a loop
+        :param byte_rate: Bytes per second the file is sent at
+        """
+        self.media = media
+        self.data = media.read_bytes()
+        self.byte_rate = byte_rate
+        self.host = host
+        self.port = port
+        # Repeats start after the container header
+        self.loop_start = _loop_start(media)
+        self.segment_duration = len(self.data) / byte_rate
+        self.requests = 0
+        self.outages = 0
+        self._down_until = 0.0
+        self._streams: set[asyncio.StreamWriter] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._t0 = time.monotonic()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._t0 = time.monotonic()
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+        self._cut_streams()
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=1)
+
+    def outage(self, seconds: float):
+        """
+        Cut the open streams, and refuse new ones for some seconds
+        """
+        self.outages += 1
+        self._down_until = time.monotonic() + seconds
+        self._cut_streams()
+
+    def _cut_streams(self):
+        for writer in list(self._streams):
+            writer.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._tasks.add(asyncio.current_task())
+        try:
+            request_line = (await reader.readline()).decode(errors="replace").split()
+            while (await reader.readline()).strip():
+                pass
+            self.requests += 1
+            path = request_line[1].split("?")[0] if len(request_line) > 1 else "/"
+            if time.monotonic() < self._down_until:
+                await self._respond(writer, 503, b"outage")
+            elif path == "/live.flv":
+                await self._stream(writer)
+            elif path == "/live.m3u8":
+                await self._respond(writer, 200, self._playlist().encode(), "application/vnd.apple.mpegurl")
+            elif path.startswith("/hls/"):
+                await self._respond(writer, 200, self.data, "video/mp2t")
+            else:
+                await self._respond(writer, 404, b"not found")
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+            self._tasks.discard(asyncio.current_task())
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str = "text/plain"):
+        writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def _stream(self, writer: asyncio.StreamWriter):
+        self._streams.add(writer)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: video/x-flv\r\nConnection: close\r\n\r\n")
+            block = max(1, int(self.byte_rate / 10))
+            position, sent, t0 = 0, 0, time.monotonic()
+            while not writer.is_closing():
+                end = min(position + block, len(self.data))
+                writer.write(self.data[position:end])
+                sent += end - position
+                position = end if end < len(self.data) else self.loop_start
+                await writer.drain()
+                await asyncio.sleep(max(0.0, t0 + sent / self.byte_rate - LEAD - time.monotonic()))
+        finally:
+            self._streams.discard(writer)
+
+    def _playlist(self) -> str:
+        duration = self.segment_duration
+        sequence = max(0, int((time.monotonic() - self._t0) / duration) - 2)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{math.ceil(duration)}",
+                 f"#EXT-X-MEDIA-SEQUENCE:{sequence}"]
+        for i in range(sequence, sequence + 3):
+            if i:
+                # Every segment starts the timestamps of the file again
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines += [f"#EXTINF:{duration:.3f},", f"/hls/{i}.ts"]
+        return "\n".join(lines) + "\n"
+
+
+def _loop_start(media: Path) -> int:
+    if media.suffix.lower() == ".flv":
+        return FLV_HEADER_SIZE
+    if media.suffix.lower() == ".wav":
+        # Offset of the samples, after the RIFF chunks before "data"
+        data = media.read_bytes()[:4096]
+        return data.find(b"data") + 8
+    return 0
+
+
+def _byte_rate(media: Path, bitrate: Optional[float]) -> float:
+    """
+    Bytes per second the media has to be sent at to play in real time
+    """
+    if bitrate:
+        return bitrate * 1000 / 8
+    if media.suffix.lower() == ".pcm":
+        return 16000 * 2
+    if media.suffix.lower() == ".wav":
+        with wave.open(str(media), "rb") as f:
+            return f.getframerate() * f.getnchannels() * f.getsampwidth()
+    try:
+        duration = float(subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of",
+                                         "default=noprint_wrappers=1:nokey=1", str(media)],
+                                        capture_output=True, text=True, check=True).stdout)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        raise SystemExit(f"Can't tell the bitrate of {media}, pass --bitrate")
+    return media.stat().st_size / duration
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _open_fds() -> int:
+    for folder in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(folder))
+        except OSError:
+            continue
+    return -1
+
+
+def _child_processes() -> int:
+    """
+    Child processes including zombies, e.g. ffmpeg processes nobody waited for
+    """
+    pid, count = str(os.getpid()), 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return -1
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces, the fields after it don't
+                if f.read().rsplit(")", 1)[1].split()[1] == pid:
+                    count += 1
+        except (OSError, IndexError):
+            continue
+    return count
+
+
+def _gauges(names: tuple[str, ...]) -> dict[str, float]:
+    """
+    Current values of the pipeline's gauges, summed over the rooms
+    """
+    from submaku_stream.utils.metrics import MetricsRegistry
+
+    values = dict.fromkeys(names, 0.0)
+    for line in MetricsRegistry.get_instance().render().splitlines():
+        name = line.split("{", 1)[0].split(" ", 1)[0]
+        if name in values:
+            values[name] += float(line.rsplit(" ", 1)[1])
+    return values
+
+
+QUEUE_GAUGES = ("submaku_scheduler_queue_depth", "submaku_sender_queue_depth", "submaku_scheduler_lag_seconds")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    from submaku_stream.__main__ import main
+    from submaku_stream.config_models import Credential
+    from submaku_stream.locales.i18n import I18n
+    from submaku_stream.utils.storage import ConfigStorage, Constants
+
+    media = Path(args.media)
+    stream = FakeStreamServer(media, _byte_rate(media, args.bitrate))
+    await stream.start()
+    stream_url = f"{stream.url}/live.m3u8" if args.format == "hls" else f"{stream.url}/live.flv"
+    api = MockLiveServer(error_rate=args.send_error_rate, stream_urls=[stream_url])
+    await api.start()
+
+    storage = ConfigStorage.load(Path(args.config) / CONFIG_PATH.name, Path(args.config) / CREDENTIAL_PATH.name)
+    config = storage.config
+    config.room_id = ROOM_ID
+    config.rooms = []
+    config.should_send_danmaku = True
+    config.transport.pooled = True
+    config.transport.api_base = api.url
+    config.reload.enabled = False
+    config.ingest.max_resolve_attempts = 0
+    if args.ffmpeg:
+        config.ingest.ffmpeg_path = args.ffmpeg
+    storage.credential = Credential(SESSDATA="soak-sessdata", bili_jct="soak-csrf")
+    I18n.get_instance().set_locale(config.program_display_language)
+    Constants.setup(storage)
+
+    async def pipeline():
+        try:
+            await main()
+        except SystemExit:
+            pass
+
+    report = open(args.report, "w", encoding="utf-8") if args.report else None
+    samples, outages = [], []
+    t0, wall_t0 = time.monotonic(), time.time()
+    pipeline_task = asyncio.create_task(pipeline())
+    next_outage = args.outage_every or math.inf
+    try:
+        while (elapsed := time.monotonic() - t0) < args.duration and not pipeline_task.done():
+            await asyncio.sleep(min(args.sample_interval, max(0.0, next_outage - elapsed)))
+            elapsed = time.monotonic() - t0
+            if elapsed >= args.duration:
+                break
+            if elapsed >= next_outage:
+                stream.outage(args.outage_length)
+                outages.append(elapsed)
+                next_outage += args.outage_every
+                print(f"[{elapsed:8.1f}s] stream outage of {args.outage_length}s", file=sys.stderr)
+                continue
+            sample = {"t": round(elapsed, 1), "rss_mb": round(_rss_mb(), 1), "tasks": len(asyncio.all_tasks()),
+                      "fds": _open_fds(), "threads": threading.active_count(), "children": _child_processes(),
+                      "received": len(api.received), "stream_requests": stream.requests}
+            sample.update({name.removeprefix("submaku_"): value for name, value in _gauges(QUEUE_GAUGES).items()})
+            samples.append(sample)
+            if report:
+                report.write(json.dumps(sample) + "\n")
+                report.flush()
+            print(json.dumps(sample), file=sys.stderr)
+        stopped_early = pipeline_task.done()
+    finally:
+        pipeline_task.cancel()
+        await asyncio.gather(pipeline_task, return_exceptions=True)
+        await api.stop()
+        await stream.stop()
+        if report:
+            report.close()
+    return evaluate(args, samples, outages, [t - wall_t0 for t, _room, _text in api.received], stopped_early)
+
+
+def evaluate(args: argparse.Namespace, samples: list[dict], outages: list[float], received: list[float],
+             stopped_early: bool = False) -> dict:
+    """
+    Compare the resources at the start and the end of the run with the limits
+    :param samples: Resource samples
+    :param outages: Seconds into the run the stream outages started at
+    :param received: Seconds into the run the danmaku were received at
+    :param stopped_early: The pipeline exited before the end of the run
+    """
+    failures = []
+    if stopped_early:
+        failures.append("the pipeline stopped before the end of the run")
+    steady = [s for s in samples if s["t"] >= args.warmup]
+    growth = {}
+    if len(steady) >= 3:
+        third = max(1, len(steady) // 3)
+        for key, limit in (("rss_mb", args.max_rss_growth_mb), ("tasks", args.max_task_growth),
+                           ("fds", args.max_fd_growth), ("threads", args.max_thread_growth),
+                           ("children", args.max_child_growth)):
+            growth[key] = statistics.median(s[key] for s in steady[-third:]) - \
+                statistics.median(s[key] for s in steady[:third])
+            if growth[key] > limit:
+                failures.append(f"{key} grew by {growth[key]:.1f}, limit {limit}")
+    else:
+        failures.append("too few samples after the warmup to measure growth")
+    for key, limit in (("scheduler_queue_depth", args.max_queue_depth),
+                       ("sender_queue_depth", args.max_queue_depth)):
+        peak = max((s[key] for s in steady), default=0)
+        if peak > limit:
+            failures.append(f"{key} reached {peak:.0f}, limit {limit}")
+    recovered = 0
+    for start in outages:
+        back = start + args.outage_length
+        if back + args.recovery_timeout > (samples[-1]["t"] if samples else 0):
+            # The run ended too soon after this outage to tell
+            continue
+        if any(back < t <= back + args.recovery_timeout for t in received):
+            recovered += 1
+        else:
+            failures.append(f"no danmaku within {args.recovery_timeout}s after the outage at {start:.0f}s")
+    duration = samples[-1]["t"] if samples else 0
+    return {"duration": duration, "samples": len(samples), "danmaku_received": len(received),
+            "danmaku_per_minute": round(len(received) / duration * 60, 2) if duration else 0,
+            "outages": len(outages), "recovered": recovered, "growth": growth, "failures": failures,
+            "passed": not failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("media", help="Media file streamed in a loop")
+    parser.add_argument("--format", choices=("flv", "hls"), default="flv")
+    parser.add_argument("--bitrate", type=float, help="kbit/s the media is sent at, see above")
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds to run")
+    parser.add_argument("--warmup", type=float, default=120, help="Seconds before the growth is measured")
+    parser.add_argument("--sample-interval", type=float, default=30, help="Seconds between two samples")
+    parser.add_argument("--outage-every", type=float, default=600, help="Seconds between stream outages, 0 for none")
+    parser.add_argument("--outage-length", type=float, default=5, help="Seconds new connections are refused")
+    parser.add_argument("--send-error-rate", type=float, default=0.05, help="Share of the sends failing")
+    parser.add_argument("--recovery-timeout", type=float, default=120,
+                        help="Seconds after an outage within which a danmaku has to arrive")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=200)
+    parser.add_argument("--max-task-growth", type=float, default=10)
+    parser.add_argument("--max-fd-growth", type=float, default=10)
+    parser.add_argument("--max-thread-growth", type=float, default=4)
+    parser.add_argument("--max-child-growth", type=float, default=1)
+    parser.add_argument("--max-queue-depth", type=float, default=50)
+    parser.add_argument("--ffmpeg", help="ffmpeg executable, defaults to ingest.ffmpeg_path of the config")
+    parser.add_argument("--report", help="Append every sample as a JSON line to this file")
+    parser.add_argument("-c", "--config", default=str(CONFIG_PATH.parent), help="Config base folder")
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    sys.exit(0 if result["passed"] else 1)
+
+
+if __name__ == '__main__':
+    main()
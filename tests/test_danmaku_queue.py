@@ -0,0 +1,128 @@
+"""
+Offline tests of the danmaku sender: send error classification, priorities, held back and stale messages,
+and merging of short subtitles
+
+    python tests/test_danmaku_queue.py
+
+or with pytest. Nothing is sent, no credential or network is needed.
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import httpx
+from bilibili_api import Danmaku, ResponseCodeException
+from bilibili_api.exceptions import ApiException
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from submaku_stream.utils.storage import ConfigStorage  # noqa: E402
+from submaku_stream.workers.danmaku_sender import (CODE_CSRF, CODE_NOT_LOGGED_IN, CODE_TOO_FAST,  # noqa: E402
+                                                   CODE_TOO_FAST_REPEATED, CODE_TOO_LONG, DanmakuMessage,
+                                                   DanmakuQueue, DanmakuSendingWorker, Priority, SendFailure,
+                                                   classify_send_error)
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://api.live.bilibili.com/msg/send")
+    return httpx.HTTPStatusError(str(status), request=request, response=httpx.Response(status, request=request))
+
+
+def _message(text: str, position: int = 0, priority: Priority = Priority.SUBTITLE, **kwargs) -> DanmakuMessage:
+    return DanmakuMessage(Danmaku(text), position, priority, **kwargs)
+
+
+def test_classify_send_error():
+    cases = [
+        (ResponseCodeException(CODE_TOO_LONG, "too long"), SendFailure.DROP),
+        (ResponseCodeException(CODE_TOO_FAST, "too fast"), SendFailure.RETRY),
+        (ResponseCodeException(CODE_TOO_FAST_REPEATED, "too fast"), SendFailure.RETRY),
+        (ResponseCodeException(CODE_NOT_LOGGED_IN, "not logged in"), SendFailure.FATAL),
+        (ResponseCodeException(CODE_CSRF, "csrf"), SendFailure.FATAL),
+        # Blocked words
+        (ResponseCodeException(10024, "blocked"), SendFailure.DROP),
+        (_status_error(500), SendFailure.RETRY),
+        (_status_error(429), SendFailure.RETRY),
+        (_status_error(412), SendFailure.FATAL),
+        (_status_error(403), SendFailure.FATAL),
+        (_status_error(400), SendFailure.DROP),
+        (httpx.ConnectError("refused"), SendFailure.RETRY),
+        (httpx.ReadTimeout("timeout"), SendFailure.RETRY),
+        (asyncio.TimeoutError(), SendFailure.RETRY),
+        (ApiException("credential"), SendFailure.FATAL),
+        (RuntimeError("unknown"), SendFailure.RETRY),
+    ]
+    for error, expected in cases:
+        assert classify_send_error(error) == expected, (error, classify_send_error(error), expected)
+
+
+def test_priorities():
+    queue = DanmakuQueue()
+    queue.put(_message("subtitle 1", 0))
+    queue.put(_message("manual", 1, Priority.MANUAL))
+    queue.put(_message("subtitle 2", 2))
+    queue.put(_message("pinned", 3, Priority.PINNED))
+    # By priority, FIFO within the same priority
+    assert [queue.pop().danmaku.text for _i in range(4)] == ["pinned", "manual", "subtitle 1", "subtitle 2"]
+
+
+def test_held_back():
+    async def run():
+        queue = DanmakuQueue()
+        queue.put(_message("later", release_at=time.monotonic() + 0.1))
+        assert queue.peek() is None and len(queue) == 1
+        await asyncio.wait_for(queue.wait(), 1)
+        assert queue.pop().danmaku.text == "later"
+
+    asyncio.run(run())
+
+
+def _worker(max_chars: int = 20) -> DanmakuSendingWorker:
+    config = ConfigStorage.get_instance().config
+    config.sender.coalesce = True
+    config.max_chars_per_danmaku = max_chars
+    return DanmakuSendingWorker(live_room=object())
+
+
+def _put(worker: DanmakuSendingWorker, raw_text: str, priority: Priority = Priority.SUBTITLE, **kwargs):
+    def text_format(text: str) -> str:
+        return f"[A]{text}"
+
+    worker._msg_queue.put(_message(text_format(raw_text), priority=priority, raw_text=raw_text,
+                                   text_format=text_format, **kwargs))
+
+
+def test_coalescing():
+    worker = _worker(max_chars=20)
+    _put(worker, "hello")
+    _put(worker, "world")
+    _put(worker, "this one is too long")
+    # Merged as raw text and formatted once
+    assert worker._next_message().danmaku.text == "[A]hello world"
+    assert worker._next_message().danmaku.text == "[A]this one is too long"
+    assert worker._next_message() is None
+
+
+def test_coalescing_keeps_priorities_apart():
+    worker = _worker(max_chars=20)
+    _put(worker, "manual", Priority.MANUAL)
+    _put(worker, "subtitle")
+    assert worker._next_message().danmaku.text == "[A]manual"
+    assert worker._next_message().danmaku.text == "[A]subtitle"
+
+
+def test_stale_messages_are_dropped():
+    worker = _worker(max_chars=20)
+    _put(worker, "stale", max_age=0.01)
+    _put(worker, "fresh")
+    time.sleep(0.05)
+    assert worker._next_message().danmaku.text == "[A]fresh"
+    assert worker.dropped_danmaku_amount == 1
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name} passed")
@@ -0,0 +1,156 @@
+"""
+Offline tests of the TranscriptionScheduler: results in chunk order, overload policies and max_lag
+
+    python tests/test_scheduler.py
+
+or with pytest. No model, stream or network is needed.
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from submaku_stream.utils.audio import AudioChunk  # noqa: E402
+from submaku_stream.workers.scheduler import TranscriptionScheduler  # noqa: E402
+
+
+def _chunk() -> AudioChunk:
+    return AudioChunk(np.zeros(160, dtype=np.int16))
+
+
+def _scheduler(job, **kwargs) -> tuple[TranscriptionScheduler, list[int]]:
+    """
+    :return: Scheduler and the indexes of the results, in the order they were handed over
+    """
+    results = []
+
+    async def on_result(index: int, _result):
+        results.append(index)
+
+    return TranscriptionScheduler(job, on_result, **kwargs), results
+
+
+def test_results_in_chunk_order():
+    async def run():
+        # Later chunks finish first
+        async def job(index, _chunk):
+            await asyncio.sleep(0.05 * (4 - index))
+            return index
+
+        scheduler, results = _scheduler(job, concurrency=4, max_backlog=4)
+        for _i in range(5):
+            await scheduler.submit(_chunk())
+        await scheduler.join()
+        await scheduler.stop()
+        assert results == [0, 1, 2, 3, 4], results
+        assert scheduler.completed_chunks == 5 and scheduler.reorder_depth == 0
+
+    asyncio.run(run())
+
+
+async def _overloaded(policy: str) -> tuple[TranscriptionScheduler, list[int], asyncio.Task, asyncio.Event]:
+    """
+    Submit 3 chunks with room for one job and one waiting chunk, while the first job is blocked
+    :return: Scheduler, results, the task of the third submit(), and the event unblocking the first job
+    """
+    release = asyncio.Event()
+
+    async def job(index, _chunk):
+        if index == 0:
+            await release.wait()
+        return index
+
+    scheduler, results = _scheduler(job, concurrency=1, max_backlog=1, overload_policy=policy)
+    await scheduler.submit(_chunk())
+    # Let the worker take chunk 0 out of the backlog
+    await asyncio.sleep(0.01)
+    await scheduler.submit(_chunk())
+    third = asyncio.create_task(scheduler.submit(_chunk()))
+    await asyncio.sleep(0.05)
+    return scheduler, results, third, release
+
+
+def test_drop_newest():
+    async def run():
+        scheduler, results, third, release = await _overloaded("drop_newest")
+        release.set()
+        assert await third == 2
+        await scheduler.join()
+        await scheduler.stop()
+        assert results == [0, 1], results
+        assert scheduler.dropped_chunks == 1
+
+    asyncio.run(run())
+
+
+def test_drop_oldest():
+    async def run():
+        scheduler, results, third, release = await _overloaded("drop_oldest")
+        release.set()
+        await third
+        await scheduler.join()
+        await scheduler.stop()
+        assert results == [0, 2], results
+        assert scheduler.dropped_chunks == 1
+
+    asyncio.run(run())
+
+
+def test_block():
+    async def run():
+        scheduler, results, third, release = await _overloaded("block")
+        # Ingest waits for backlog space instead of dropping anything
+        assert not third.done() and scheduler.queue_depth == 1
+        release.set()
+        await third
+        await scheduler.join()
+        await scheduler.stop()
+        assert results == [0, 1, 2], results
+        assert scheduler.dropped_chunks == 0
+
+    asyncio.run(run())
+
+
+def test_max_lag():
+    async def run():
+        async def job(index, _chunk):
+            await asyncio.sleep(0.1)
+            return index
+
+        scheduler, results = _scheduler(job, concurrency=1, max_backlog=4, max_lag=0.05)
+        for _i in range(3):
+            await scheduler.submit(_chunk())
+        await scheduler.join()
+        await scheduler.stop()
+        # Chunks 1 and 2 have waited for chunk 0 longer than max_lag
+        assert results == [0], results
+        assert scheduler.dropped_chunks == 2
+
+    asyncio.run(run())
+
+
+def test_failed_job_is_skipped():
+    async def run():
+        async def job(index, _chunk):
+            if index == 1:
+                raise RuntimeError("inference failed")
+            return index
+
+        scheduler, results = _scheduler(job, concurrency=2, max_backlog=4)
+        for _i in range(3):
+            await scheduler.submit(_chunk())
+        await scheduler.join()
+        await scheduler.stop()
+        assert results == [0, 2], results
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name} passed")
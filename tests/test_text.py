@@ -0,0 +1,74 @@
+"""
+Offline tests of the text utilities: collapsing repeats and splitting text into danmaku
+
+    python tests/test_text.py
+
+or with pytest.
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from submaku_stream.utils.text import remove_redundant_repeats, split_text  # noqa: E402
+
+
+def test_repeated_words():
+    assert remove_redundant_repeats("No no no no!") == "No!"
+    assert remove_redundant_repeats("I think I think I think so") == "I think so"
+    # Below min_repeats
+    assert remove_redundant_repeats("go go") == "go go"
+
+
+def test_double_letters_are_kept():
+    assert remove_redundant_repeats("Hello, good morning") == "Hello, good morning"
+
+
+def test_repeated_cjk():
+    # A doubled character is a word of its own
+    assert remove_redundant_repeats("谢谢谢谢大家") == "谢谢大家"
+    assert remove_redundant_repeats("哈哈哈哈哈") == "哈哈"
+    assert remove_redundant_repeats("好好学习") == "好好学习"
+    assert remove_redundant_repeats("我爱你我爱你我爱你") == "我爱你"
+
+
+def test_repeat_parameters():
+    assert remove_redundant_repeats("go go", min_repeats=2) == "go"
+    assert remove_redundant_repeats("No no no no!", min_unit_chars=3) == "No no no no!"
+    assert remove_redundant_repeats("one two three " * 5, max_unit_tokens=2) == "one two three " * 5
+
+
+def test_long_loop_is_fast():
+    text = "Thank you for watching. " * 100
+    t0 = time.time()
+    assert remove_redundant_repeats(text) == "Thank you for watching. "
+    assert time.time() - t0 < 0.5
+
+
+def _pieces(text: str, max_chars: int) -> list[str]:
+    return [text[start:end] for start, end in split_text(text, max_chars)]
+
+
+def test_split_at_punctuation():
+    assert _pieces("今天天气很好，我们去公园散步吧。然后回家吃饭", 10) == ["今天天气很好，", "我们去公园散步吧。", "然后回家吃饭"]
+
+
+def test_split_at_whitespace():
+    assert _pieces("hello world this is a test", 10) == ["hello", "world this", "is a test"]
+
+
+def test_split_long_word():
+    assert _pieces("abcdefghij", 4) == ["abcd", "efgh", "ij"]
+
+
+def test_split_unlimited():
+    assert _pieces("  a b  ", 0) == ["a b"]
+    assert _pieces("", 10) == []
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name} passed")